@@ -0,0 +1,106 @@
+#! /usr/bin/python
+"""
+Manage the backups of the xml files kept in a BackupStore
+
+commands:
+
+    import -- move the old timestamped copies (<book>_<YYYYmmdd_HHMMSS_ffffff>.xml)
+        of the backup folder into the store
+    list -- print the backups per book
+    restore -- write a backup of a book to a file
+    prune -- keep only the last backups of every book (the snapshots of the
+        draft journals, <book>.journal, are left alone)
+    stats -- print the number and size of the backups and of the stored chunks
+
+place this file in applications/<appname>/bin/
+
+run with:
+python <your web2py dir>/web2py.py -S <appname> -R applications/<appname>/bin/backups.py -A [--drafts] command [options]
+
+The script only needs the app's modules folder on the python path, so it can
+also be run directly with python.
+"""
+import argparse
+import glob
+import os
+import re
+import sys
+
+if 'request' in globals():
+    APP_DIR = request.folder
+else:
+    APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+modules_path = os.path.join(APP_DIR, 'modules')
+if modules_path not in sys.path:
+    sys.path.append(modules_path)  # imports from app modules folder
+
+from backup import BackupStore
+from parse import XML_DRAFT_FILE_BACKUP_STORAGE_PATH, XML_FILE_BACKUP_STORAGE_PATH
+
+BACKUP_FILE_RE = re.compile(r'^(?P<book>.+)_(?P<id>\d{8}_\d{6}_\d{6})\.xml$')
+
+
+def import_files(store, folder, keep_files=False):
+    """
+    Store the timestamped backup files of the folder and remove them.
+
+    :return: the number of imported files
+    """
+    imported = 0
+    for path in sorted(glob.glob(os.path.join(folder, '*.xml'))):
+        match = BACKUP_FILE_RE.match(os.path.basename(path))
+        if match is None:
+            continue
+        store.backup_file(match.group('book'), path, match.group('id'))
+        if not keep_files:
+            os.remove(path)
+        imported += 1
+    return imported
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Manage the backups of the xml files.')
+    parser.add_argument('--drafts', action='store_true',
+                        help='use the backups of the drafts instead of the published books')
+    commands = parser.add_subparsers(dest='command')
+    import_parser = commands.add_parser('import', help='move the timestamped backup files into the store')
+    import_parser.add_argument('--keep-files', action='store_true',
+                               help="don't remove the imported files")
+    commands.add_parser('list', help='print the backups per book')
+    restore_parser = commands.add_parser('restore', help='write a backup to a file')
+    restore_parser.add_argument('book')
+    restore_parser.add_argument('backup_id')
+    restore_parser.add_argument('file')
+    prune_parser = commands.add_parser('prune', help='remove all but the last backups of every book')
+    prune_parser.add_argument('--keep', type=int, default=20,
+                              help='backups kept per book (default: 20)')
+    commands.add_parser('stats', help='print the size of the backups and of the store')
+    args = parser.parse_args(argv)
+
+    folder = XML_DRAFT_FILE_BACKUP_STORAGE_PATH if args.drafts else XML_FILE_BACKUP_STORAGE_PATH
+    store = BackupStore(folder)
+    if args.command == 'import':
+        print 'imported {} files'.format(import_files(store, folder, args.keep_files))
+    elif args.command == 'list':
+        for book_name in store.names():
+            for backup_id in store.backups(book_name):
+                print '{:<16} {}'.format(book_name, backup_id)
+    elif args.command == 'restore':
+        store.restore_file(args.book, args.backup_id, args.file)
+    elif args.command == 'prune':
+        for book_name in store.names():
+            if book_name.endswith('.journal'):
+                # the snapshots of the draft journals are dropped by
+                # DraftJournal.compact(), which runs when the draft is saved
+                # with a new snapshot (see parse.BookManager._save)
+                continue
+            removed = store.prune(book_name, args.keep)
+            print '{:<16} removed {} backups'.format(book_name, len(removed))
+    elif args.command == 'stats':
+        stats = store.stats()
+        print '{} backups of {} bytes stored in {} chunks of {} bytes'.format(
+            stats['backups'], stats['size'], stats['chunks'], stats['stored_size'])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,299 @@
+#! /usr/bin/python
+"""
+Benchmark the parse module against the books in static/docs
+
+The books are copied to a temporary folder first and all BookManager storage
+paths point there while the benchmark runs, so nothing is written to the
+corpus or the drafts.
+
+For every book this times:
+
+    parse -- Book() construction from the xml file
+    book_info -- Book.get_book_info() with all version sections computed
+    get_text -- whole-document Book.get_text() per showable manuscript
+    get_readings -- Book.get_readings() for randomly chosen units
+    bookman_get_text -- BookManager.get_text(as_gluon=True) of the whole
+        document per showable manuscript, serialized to html
+    section -- the docs.section render path (cached Book, get_text and
+        _render_text of the docs controller) for randomly chosen top-level
+        divisions, bypassing the rendered section cache
+
+and reports the median and 95th percentile (in ms) per book and stage.
+
+place this file in applications/<appname>/bin/
+
+run with:
+python <your web2py dir>/web2py.py -S <appname> -M -R applications/<appname>/bin/benchmark.py -A [options] [book ...]
+
+The section stage needs the web2py environment with models (-M), since the
+docs controller is executed to get at its rendering code. The other stages
+only need the app's modules folder on the python path, so the script can also
+be run directly with python; the section stage is skipped then.
+"""
+import argparse
+from collections import OrderedDict
+import glob
+import json
+import math
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+if 'request' in globals():
+    APP_DIR = request.folder
+else:
+    APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+modules_path = os.path.join(APP_DIR, 'modules')
+if modules_path not in sys.path:
+    sys.path.append(modules_path)  # imports from app modules folder
+
+from parse import Book, BookManager, BOOK_CACHE
+
+DOCS_DIR = os.path.join(APP_DIR, 'static', 'docs')
+STAGES = ['parse', 'book_info', 'get_text', 'get_readings',
+          'bookman_get_text', 'section']
+
+
+class _Quiet(object):
+    """
+    Swallow the debugging output of the parse module while timing.
+    """
+
+    def write(self, s):
+        pass
+
+    def __enter__(self):
+        self._stdout = sys.stdout
+        sys.stdout = self
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.stdout = self._stdout
+
+
+def _timed(func, *args, **kwargs):
+    """
+    Return the wall time (in ms) of one call of func.
+    """
+    with _Quiet():
+        start = default_timer()
+        func(*args, **kwargs)
+        return (default_timer() - start) * 1000.0
+
+
+class Samples(OrderedDict):
+    """
+    Timings (in ms) per stage, plus the number of calls that raised an error
+    """
+
+    def __init__(self):
+        OrderedDict.__init__(self, ((stage, []) for stage in STAGES))
+        self.errors = dict.fromkeys(STAGES, 0)
+
+    def add(self, stage, func, *args, **kwargs):
+        try:
+            self[stage].append(_timed(func, *args, **kwargs))
+        except Exception:
+            self.errors[stage] += 1
+
+    def stats(self):
+        return OrderedDict((stage, {'n': len(s),
+                                    'errors': self.errors[stage],
+                                    'median': median(s) if s else None,
+                                    'p95': percentile(s, 95) if s else None})
+                           for stage, s in self.items()
+                           if s or self.errors[stage])
+
+
+def percentile(samples, pct):
+    """
+    Return the nearest-rank percentile of a list of numbers.
+    """
+    ordered = sorted(samples)
+    rank = int(math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def median(samples):
+    ordered = sorted(samples)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+def load_docs_controller():
+    """
+    Execute the docs controller in the current web2py environment and return
+    its globals, or None when not running inside web2py with models.
+    """
+    if 'auth' not in globals():
+        return None
+    env = dict(globals())
+    execfile(os.path.join(APP_DIR, 'controllers', 'docs.py'), env)
+    return env
+
+
+def showable_texts(book):
+    """
+    Yield (version title, text type, organisation levels, reference list) for
+    every manuscript with show="yes".
+    """
+    with _Quiet():
+        info = book.get_book_info()
+    for version in info['version']:
+        for mss in version['manuscripts']:
+            for abbrev, ms in mss.iteritems():
+                if ms['attributes']['show'] == 'yes':
+                    yield (version['attributes']['title'], abbrev.strip(),
+                           version['organisation_levels'],
+                           version['reference_list'])
+
+
+def bench_book(path, args, rng, docs_env):
+    """
+    Time all stages for one xml file and return the Samples.
+    """
+    samples = Samples()
+    book_name = os.path.splitext(os.path.basename(path))[0]
+
+    for i in range(args.repeat):
+        samples['parse'].append(_timed(Book, open(path)))
+        book = Book(open(path))
+        samples.add('book_info',
+                    lambda: [v.copy() for v in book.get_book_info()['version']])
+
+    texts = list(showable_texts(book))
+    for version_title, text_type, levels, reflist in texts:
+        samples.add('get_text',
+                    lambda: list(book.get_text(version_title, text_type, None)[0]))
+        samples.add('bookman_get_text',
+                    lambda: [d.xml() for d in BookManager.get_text(
+                        [{"book": book_name, "version": version_title,
+                          "text_type": text_type}])["result"]])
+
+    for version in book.xpath("version"):
+        unit_ids = [u.get("id") for u in version.iter("unit")]
+        for unit_id in rng.sample(unit_ids, min(args.readings, len(unit_ids))):
+            samples.add('get_readings', book.get_readings,
+                        version.get("title"), unit_id)
+
+    if docs_env is not None:
+        bench_sections(samples, path, texts, args, rng, docs_env)
+
+    return samples
+
+
+def bench_sections(samples, path, texts, args, rng, docs_env):
+    """
+    Time the docs.section render path for random top-level divisions.
+    """
+    XML, CAT = docs_env['XML'], docs_env['CAT']
+    render_text = docs_env['_render_text']
+
+    def render(version_title, text_type, levels, start_sel):
+        book = BOOK_CACHE.get(path)
+        book.get_book_info()
+        text_iterator, start_sel, end_sel = book.get_text(version_title, text_type,
+                                                          start_sel, start_sel)
+        return XML(CAT(*render_text(text_iterator, levels))).xml()
+
+    for version_title, text_type, levels, reflist in texts:
+        tops = list(OrderedDict.fromkeys(re.split(r'[:\.,;_-]', ref)[0]
+                                         for ref in reflist))
+        for top in rng.sample(tops, min(args.sections, len(tops))):
+            samples.add('section', render, version_title, text_type, levels, [top])
+
+
+def use_temporary_copy(paths):
+    """
+    Point all BookManager storage paths at a temporary copy of the given xml
+    files, so the benchmark never touches the corpus or the drafts (reading
+    through BookManager takes the book lock and may save a draft).
+
+    :return: the temporary folder, to be removed afterwards
+    """
+    temp_dir = tempfile.mkdtemp(prefix='benchmark-')
+    docs_dir = os.path.join(temp_dir, 'docs')
+    backups_dir = os.path.join(docs_dir, 'backups')
+    os.makedirs(backups_dir)
+    for path in paths:
+        shutil.copy(path, docs_dir)
+    # BookManager reads from the drafts folder, here the published books
+    BookManager.xml_file_storage_path = docs_dir
+    BookManager.xml_file_backup_storage_path = backups_dir
+    BookManager.xml_draft_file_storage_path = docs_dir
+    BookManager.xml_draft_file_backup_storage_path = backups_dir
+    return temp_dir
+
+
+def report(results, out=sys.stdout):
+    """
+    Print the median and p95 (in ms) per book and stage as a table.
+    """
+    out.write('{:<16} {:<18} {:>6} {:>6} {:>12} {:>12}\n'.format(
+        'book', 'stage', 'n', 'errors', 'median ms', 'p95 ms'))
+    for book_name, stages in results.items():
+        if 'error' in stages:
+            out.write('{:<16} {}\n'.format(book_name, stages['error']))
+            continue
+        for stage, stats in stages.items():
+            out.write('{:<16} {:<18} {:>6} {:>6} {:>12} {:>12}\n'.format(
+                book_name, stage, stats['n'], stats['errors'],
+                '-' if stats['median'] is None else '{:.3f}'.format(stats['median']),
+                '-' if stats['p95'] is None else '{:.3f}'.format(stats['p95'])))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the parse module '
+                                     'against the books in static/docs.')
+    parser.add_argument('books', nargs='*',
+                        help='file names of the books to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='parse and book_info runs per book (default: 5)')
+    parser.add_argument('--readings', type=int, default=100,
+                        help='random get_readings lookups per version (default: 100)')
+    parser.add_argument('--sections', type=int, default=10,
+                        help='random top-level sections rendered per text (default: 10)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for choosing units and sections')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results to FILE as json')
+    args = parser.parse_args(argv)
+
+    docs_env = load_docs_controller()
+    if docs_env is None:
+        print 'no web2py environment with models, skipping the section stage'
+
+    paths = sorted(glob.glob(os.path.join(DOCS_DIR, '*.xml')))
+    if args.books:
+        paths = [p for p in paths
+                 if os.path.splitext(os.path.basename(p))[0] in args.books]
+
+    temp_dir = use_temporary_copy(paths)
+    rng = random.Random(args.seed)
+    results = OrderedDict()
+    try:
+        for path in paths:
+            book_name = os.path.splitext(os.path.basename(path))[0]
+            path = os.path.join(BookManager.xml_draft_file_storage_path, os.path.basename(path))
+            try:
+                results[book_name] = bench_book(path, args, rng, docs_env).stats()
+            except Exception, e:
+                # the book itself can't be read
+                results[book_name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+    finally:
+        shutil.rmtree(temp_dir)
+
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
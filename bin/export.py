@@ -0,0 +1,219 @@
+#! /usr/bin/python
+"""
+Pre-render the published books to static html and json files
+
+For every book in static/docs, every version and every manuscript with
+show="yes" the text of each top-level division is written as
+
+    <out>/<book>/<version>/<text type>/<division>.html -- the text pane markup
+        of docs.section
+    <out>/<book>/<version>/<text type>/<division>.json -- the section as
+        returned by docs.section_json
+
+and the variant readings of every unit as
+
+    <out>/<book>/<version>/apparatus/<unit id>.html -- the markup of
+        docs.apparatus
+
+In the names of the folders and files the spaces are replaced by '_' (as in
+the urls of the docs controller) and the rest is url-quoted, so the front-end
+web server can serve the reading traffic straight from these files.
+
+A book is exported only when its xml file has changed since its last export
+(the sha1 of the file is kept in <out>/<book>/manifest.json), so after
+BookManager.publish_book only the republished book is rendered again. The
+files of a book are written to a temporary folder which then replaces the
+folder of the previous export.
+
+place this file in applications/<appname>/bin/
+
+run with:
+python <your web2py dir>/web2py.py -S <appname> -M -R applications/<appname>/bin/export.py -A [options] [book ...]
+
+The script needs the web2py environment with models (-M), since the markup is
+rendered by the docs controller and views.
+"""
+import argparse
+from collections import OrderedDict
+import glob
+import json
+import os
+import shutil
+import sys
+from timeit import default_timer
+import urllib
+
+if 'request' in globals():
+    APP_DIR = request.folder
+else:
+    APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+modules_path = os.path.join(APP_DIR, 'modules')
+if modules_path not in sys.path:
+    sys.path.append(modules_path)  # imports from app modules folder
+
+from kitchen.text.converters import to_unicode
+from parse import BOOK_CACHE, ElementDoesNotExist, InvalidDIVPath, MultipleElementsReturned
+from parse import NotAllowedManuscript, Text
+
+DOCS_DIR = os.path.join(APP_DIR, 'static', 'docs')
+EXPORT_DIR = os.path.join(APP_DIR, 'static', 'export')
+
+
+def load_docs_controller():
+    """
+    Execute the docs controller in the current web2py environment and return
+    its globals, or None when not running inside web2py with models.
+    """
+    if 'auth' not in globals():
+        return None
+    env = dict(globals())
+    execfile(os.path.join(APP_DIR, 'controllers', 'docs.py'), env)
+    return env
+
+
+def quote_name(name):
+    """
+    Return the folder or file name used for a version title, text type,
+    division or unit id.
+    """
+    return urllib.quote(to_unicode(name).strip().replace(u' ', u'_').encode('utf-8'), safe='')
+
+
+def _write(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(data.encode('utf-8') if isinstance(data, unicode) else data)
+
+
+def _section_texts(section):
+    """
+    Turn the compact form of a section (see docs._compact_section) back into
+    Text objects.
+    """
+    for div_path, units in section['divs']:
+        for unit_id, readings_in_unit, linebreak, indent, text in units:
+            yield Text(tuple(div_path), unit_id, section['language'],
+                       readings_in_unit, linebreak, indent, text)
+
+
+def _read_manifest(book_dir):
+    try:
+        with open(os.path.join(book_dir, 'manifest.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def export_book(path, out_dir, docs_env, force=False):
+    """
+    Render the files of one book (see the module docstring) unless it is
+    unchanged since its last export.
+
+    :return: the manifest of the export, None if the book was up to date
+    """
+    XML, CAT = docs_env['XML'], docs_env['CAT']
+    render_text = docs_env['_render_text']
+    compact_section = docs_env['_compact_section']
+    render = docs_env['response'].render
+
+    book_name = os.path.splitext(os.path.basename(path))[0]
+    book_dir = os.path.join(out_dir, book_name)
+    book = BOOK_CACHE.get(path)
+    if not force and _read_manifest(book_dir).get('content_hash') == book.content_hash:
+        return None
+
+    temp_dir = os.path.join(out_dir, '.{}.tmp'.format(book_name))
+    if os.path.isdir(temp_dir):
+        shutil.rmtree(temp_dir)
+    files = 0
+    missing = 0
+    for version in book.get_book_info()['version']:
+        title = version['attributes']['title']
+        version_dir = os.path.join(temp_dir, quote_name(title))
+        levels = version['organisation_levels']
+        tops = OrderedDict.fromkeys(div_path[0] for div_path in book.get_reference_trie(title).paths)
+        text_types = [abbrev.strip() for mss in version['manuscripts']
+                      for abbrev, ms in mss.iteritems() if ms['attributes']['show'] == 'yes']
+        for text_type in text_types:
+            type_dir = os.path.join(version_dir, quote_name(text_type))
+            for top in tops:
+                try:
+                    section = compact_section(book_name, book, version, text_type, [top], [top])
+                except (ElementDoesNotExist, InvalidDIVPath, NotAllowedManuscript):
+                    missing += 1
+                    continue
+                html = XML(CAT(*render_text(_section_texts(section), levels))).xml()
+                _write(os.path.join(type_dir, quote_name(top) + '.html'), html)
+                _write(os.path.join(type_dir, quote_name(top) + '.json'), json.dumps(section))
+                files += 2
+
+        version_element = book._get('version', {'title': title})
+        for unit_id in OrderedDict.fromkeys(unit.get('id') for unit in version_element.iter('unit')):
+            try:
+                readings = book.get_readings(title, unit_id)
+            except (ElementDoesNotExist, MultipleElementsReturned):
+                missing += 1
+                continue
+            html = render('docs/apparatus.load', {'rlist': readings, 'version': title})
+            _write(os.path.join(version_dir, 'apparatus', quote_name(unit_id) + '.html'), html)
+            files += 1
+
+    manifest = {'book': book_name,
+                'content_hash': book.content_hash,
+                'files': files,
+                'missing': missing}
+    _write(os.path.join(temp_dir, 'manifest.json'), json.dumps(manifest, indent=2))
+
+    # replace the previous export
+    old_dir = os.path.join(out_dir, '.{}.old'.format(book_name))
+    if os.path.isdir(book_dir):
+        os.rename(book_dir, old_dir)
+    os.rename(temp_dir, book_dir)
+    if os.path.isdir(old_dir):
+        shutil.rmtree(old_dir)
+    return manifest
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Pre-render the published books '
+                                     'to static html and json files.')
+    parser.add_argument('books', nargs='*',
+                        help='file names of the books to export (default: all)')
+    parser.add_argument('--out', default=EXPORT_DIR,
+                        help='the export folder (default: static/export)')
+    parser.add_argument('--force', action='store_true',
+                        help='export the books even if they are unchanged')
+    args = parser.parse_args(argv)
+
+    docs_env = load_docs_controller()
+    if docs_env is None:
+        print 'the export needs the web2py environment with models (-M)'
+        return 1
+
+    paths = sorted(glob.glob(os.path.join(DOCS_DIR, '*.xml')))
+    if args.books:
+        paths = [p for p in paths
+                 if os.path.splitext(os.path.basename(p))[0] in args.books]
+
+    failed = 0
+    for path in paths:
+        book_name = os.path.splitext(os.path.basename(path))[0]
+        start = default_timer()
+        try:
+            manifest = export_book(path, args.out, docs_env, args.force)
+        except Exception, e:
+            # the book itself can't be read
+            print '{:<16} {}: {}'.format(book_name, type(e).__name__, e)
+            failed += 1
+            continue
+        if manifest is None:
+            print '{:<16} unchanged'.format(book_name)
+        else:
+            print '{:<16} {} files in {:.1f} s'.format(book_name, manifest['files'],
+                                                       default_timer() - start)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
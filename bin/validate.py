@@ -0,0 +1,75 @@
+#! /usr/bin/python
+"""
+Validate the books in static/docs and static/docs/drafts
+
+Every xml file is validated by the DTD and semantically (see BookValidator)
+in parallel on all cores. The report is printed as json:
+
+    {"files": {<path>: {"valid": ..., "errors": [...], "parse_seconds": ...,
+                        "validate_seconds": ..., "error": ...}, ...},
+     "valid": <number of valid files>, "invalid": <number of invalid files>,
+     "seconds": <wall time>}
+
+"error" is the message of a parsing error, "errors" are the validation
+errors. The exit status is 1 when any file is invalid.
+
+place this file in applications/<appname>/bin/
+
+run with:
+python <your web2py dir>/web2py.py -S <appname> -R applications/<appname>/bin/validate.py -A [options] [file ...]
+
+The script only needs the app's modules folder on the python path, so it can
+also be run directly with python.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+from timeit import default_timer
+
+if 'request' in globals():
+    APP_DIR = request.folder
+else:
+    APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+modules_path = os.path.join(APP_DIR, 'modules')
+if modules_path not in sys.path:
+    sys.path.append(modules_path)  # imports from app modules folder
+
+from parse import XML_DRAFT_FILE_STORAGE_PATH, XML_DTD_FILE_PATH, XML_FILE_STORAGE_PATH
+from parse import validate_corpus
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Validate the books in static/docs '
+                                     'and static/docs/drafts.')
+    parser.add_argument('files', nargs='*',
+                        help='xml files to validate (default: all books and drafts)')
+    parser.add_argument('--dtd', default=XML_DTD_FILE_PATH,
+                        help='the DTD file (default: static/docs/grammateus.dtd)')
+    parser.add_argument('--processes', type=int,
+                        help='number of worker processes (default: number of cpus)')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the report to FILE instead of stdout')
+    args = parser.parse_args(argv)
+
+    paths = args.files or sorted(glob.glob(os.path.join(XML_FILE_STORAGE_PATH, '*.xml')) +
+                                 glob.glob(os.path.join(XML_DRAFT_FILE_STORAGE_PATH, '*.xml')))
+    start = default_timer()
+    files = validate_corpus(paths, args.dtd, args.processes)
+    invalid = sum(1 for result in files.values() if not result['valid'])
+    report = {'files': files,
+              'valid': len(files) - invalid,
+              'invalid': invalid,
+              'seconds': default_timer() - start}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    return 1 if invalid else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
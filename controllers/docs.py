@@ -1,17 +1,21 @@
 # -*- coding: utf-8 -*-
 
 from collections import OrderedDict
+from email.utils import formatdate, mktime_tz, parsedate_tz
+import hashlib
 from kitchen.text.converters import to_unicode
 import os
-from parse import Book, ElementDoesNotExist, NotAllowedManuscript
-import cPickle
+from parse import BOOK_CACHE, ElementDoesNotExist, InvalidDIVPath, NotAllowedManuscript
 from plugin_utils import flatten
 from pprint import pprint
 import re
+from search import SEARCH_INDEX
 import traceback
 
 if 0:
-    from gluon import current, URL, A, SPAN, P, BR, redirect
+    from gluon import current, URL, A, SPAN, P, BR, CAT, XML, HTTP, redirect
+    from gluon.cache import Cache
+    cache = Cache()
     auth = current.auth
     request = current.request
     session = current.session
@@ -20,16 +24,28 @@ if 0:
 
 """
 List of session objects used in text display:
-session.filename
-session.info -- dict; parsed results of BookParser class for current doc
-session.title -- string; title of current doc
-session.versions -- list; names of all versions in current doc
-session.refraw -- list; flast list of formatted references in the first version
-session.refhierarch -- OrderedDict;
-session.startref --
-session.endref --
+session.filename -- string; filename of current doc
+session.startref -- string; first formatted reference of the initial section
+session.endref -- string; last formatted reference of the initial section
+
+The session holds only these small keys. The parsed books and the data derived
+from them (book info, versions, references) are kept server-side in the shared
+BOOK_CACHE, addressed by the filename.
 """
 
+# keys of the per-book data formerly stored in the session
+LEGACY_SESSION_KEYS = ('p', 'info', 'refraw', 'versions', 'structure', 'refhierarch')
+
+# seconds to keep a rendered text section in cache.ram; entries of a book are
+# also dropped when it is published (see edit.publish) and its file changes
+SECTION_CACHE_EXPIRE = 24 * 60 * 60
+
+# the json sections may be stored by browsers and proxies, but are revalidated
+# on every use (a 304 response while the book is unchanged, see section_json)
+SECTION_JSON_CACHE_CONTROL = 'public, no-cache'
+# the values listed for each unit of a json section
+SECTION_JSON_FIELDS = ['unit_id', 'readings_in_unit', 'linebreak', 'indent', 'text']
+
 DISPLAY_FIELDS = OrderedDict([('introduction', 'Introduction'),
                             ('provenance', 'Provenance and Cultural Setting'),
                             ('themes', 'Major Themes'),
@@ -373,23 +389,20 @@ def text():
     # get parsed document info
     info, p = _get_bookinfo(filename)
 
+    # sessions created by older versions still carry the parsed book data
+    for key in LEGACY_SESSION_KEYS:
+        session.pop(key, None)
+
     #get title of document
     title = info['book']['title']
     # get structure type for document
     structure = info['book']['textStructure']
-    if session.structure:
-        session.structure[filename] = structure
-    else:
-        session.structure = {filename: structure}
 
     #get names of all versions of current doc
     versions = info['version']
 
     if structure == 'fragmentary':  # find first fragment and set nav values
-        fragments = sorted(list(set([v['attributes']['fragment'] for v in versions])))
-        session.versions = {f: [v['attributes']['title'] for v in versions
-                                if v['attributes']['fragment'] == f]
-                            for f in fragments}
+        fragments = sorted(_book_versions(info).keys())
 
         levels = None
         start_sel = fragments[0]
@@ -397,37 +410,23 @@ def text():
         end_sel = start_sel
         end_sel_str = start_sel_str
 
-        if session.refraw:
-            session.refraw[filename] = None
-        else:
-            session.refraw = {filename: None}
-
     else:  # find starting and ending refs for first text section and set nav values
-        session.versions = [v['attributes']['title'] for v in versions]
         first_v = versions[0]
-        delimiters = first_v['divisions']['delimiters']
         levels = first_v['organisation_levels']
 
-        #build flat list of references
-        refraw = first_v['reference_list']
-        if session.refraw:
-            session.refraw[filename] = refraw
-        else:
-            session.refraw = {filename: refraw}
+        #references of the first version
+        refs = p.get_reference_trie(first_v['attributes']['title'])
 
         #build list for starting ref
         if 'from' in request.vars:
             start_sel = request.vars['from'][:-1]
             start_sel = re.split('-', start_sel)
             #create string ref with proper delimiters
-            startlist = [None] * (len(start_sel) + len(levels))
-            startlist[::2] = start_sel
-            startlist[1::2] = delimiters
-            startref = ''.join(startlist)
+            startref = refs.format(start_sel)
             if vbs: print 'text(): using url ref ', start_sel
         else:
-            startref = refraw[0]
-            start_sel = re.split('[:\.,;_-]', startref)
+            start_sel = list(refs.first())
+            startref = refs.format(start_sel)
             if vbs: print 'text(): using default first ref ', start_sel
 
         #build list for ending ref
@@ -435,24 +434,16 @@ def text():
             end_sel = request.vars['to'][:-1]
             end_sel = re.split('-', end_sel)
             #create string ref with proper delimiters
-            endlist = [None] * (len(end_sel) + len(levels))
-            endlist[::2] = end_sel
-            endlist[1::2] = delimiters
-            endref = ''.join(endlist)
+            endref = refs.format(end_sel)
         else:
-            if vbs: print 'start_sel', start_sel
-            if vbs: print 'delimiters', delimiters
-            my_delimiter = delimiters[0] if len(delimiters) else ''
-            regex = re.compile('^' + start_sel[0] + my_delimiter)
-            #find all refs with the same top-level reference
-            this_div = [ref for ref in refraw if regex.match(ref)]
-            #choose the last one
-            try:
-                endref = this_div[-1]
-                end_sel = re.split('[:\.,;_-]', endref)
-            except IndexError:  # if text with only one level
+            #choose the last ref with the same top-level reference
+            end_sel = refs.last(start_sel[:1])
+            if end_sel is None:  # if the top-level reference doesn't exist
                 endref = startref
                 end_sel = start_sel
+            else:
+                end_sel = list(end_sel)
+                endref = refs.format(end_sel)
 
         session.startref = startref
         session.endref = endref
@@ -472,33 +463,35 @@ def text():
 
 def _get_bookinfo(filename):
     """
-    Retrieve info about the book and parsed book object from session or parser.
+    Retrieve info about the book and parsed book object from the shared book
+    cache. Neither is stored in the session.
 
     """
     vbs = False
-    # FIXME: error when using session values
-    # _element object can't be pickled, and pickling is necessary to store
-    # an object in session
-    print "Getting info"
-    if 0 and ('p' in session.keys()) and (filename in session.p.keys()):
-        p = cPickle.loads(session.p[filename])
-    else:
-        book_file = 'applications/grammateus3/static/docs/{}.xml'.format(filename)
-        p = Book(book_file)
-        if session.p:
-            session.p[filename] = p
-        else:
-            session.p = {filename: p}
+    book_file = 'applications/grammateus3/static/docs/{}.xml'.format(filename)
+    p = BOOK_CACHE.get(book_file)
 
-    if ('info' in session.keys()) and (filename in session.info.keys()):
-        info = session.info[filename]
-    else:
-        info = p.get_book_info()
-        session.info = {filename: info}
+    # the info is memoized (and computed lazily) on the cached Book object
+    info = p.get_book_info()
     if vbs: print "info", pprint(info)
     return info, p
 
 
+def _book_versions(info):
+    """
+    Return the titles of the versions of the book: a list, or for fragmentary
+    books a dictionary with the fragments as keys and lists as values.
+
+    """
+    versions = info['version']
+    if info['book']['textStructure'] == 'fragmentary':
+        fragments = set(v['attributes']['fragment'] for v in versions)
+        return {f: [v['attributes']['title'] for v in versions
+                    if v['attributes']['fragment'] == f]
+                for f in fragments}
+    return [v['attributes']['title'] for v in versions]
+
+
 """
 deprecated
 
@@ -571,6 +564,8 @@ def section():
     #get filename from end of url and parse the file with BookParser class
     filename = get_truename(request.args[0])
     info, p = _get_bookinfo(filename)
+    structure = info['book']['textStructure']
+    versions = _book_versions(info)
 
     def get_version_info(current_version):
         for version in info['version']:
@@ -639,8 +634,8 @@ def section():
     myfrag = None  # default value for non-fragmentary texts
 
     # FRAGMENTARY ==========================================================
-    if session.structure[filename] == 'fragmentary':
-        myfrags = sorted(session.versions.keys())
+    if structure == 'fragmentary':
+        myfrags = sorted(versions.keys())
         myfrag = myfrags[0] if not request.vars['from'] \
             else request.vars['from'].replace('-', '')
 
@@ -658,25 +653,20 @@ def section():
                 fidx = len(myfrags) - 1
             myfrag = myfrags[fidx]
 
-        myversions = session.versions[myfrag]
+        myversions = versions[myfrag]
         current_version, myversions = get_display_version(myversions)
         curv, vlang, levels, mslist = get_version_info(current_version)
         current_ms = get_current_ms(mslist)
 
-        if session.refraw[filename]:
-            reflist = session.refraw[filename]
-        else:
-            reflist = curv['reference_list']
-            session.refraw[filename] = reflist
-
-        startref = reflist[0]
-        start_sel = startref.split(':')
-        endref = reflist[-1]
-        end_sel = endref.split(':')
+        refs = p.get_reference_trie(current_version)
+        startref = refs.references[0]
+        start_sel = list(refs.first())
+        endref = refs.references[-1]
+        end_sel = list(refs.last())
 
     # NON-FRAGMENTARY ==========================================================
     else:
-        myversions = session.versions
+        myversions = versions
         current_version, myversions = get_display_version(myversions)
         curv, vlang, levels, mslist = get_version_info(current_version)
         current_ms = get_current_ms(mslist)
@@ -690,7 +680,6 @@ def section():
             else:
                 end_sel = start_sel
         else:
-            reflist = session.refraw
             startref = session.startref
             start_sel = startref.split(':')
             endref = session.endref
@@ -699,26 +688,34 @@ def section():
     next_level, previous_level, end_sel = get_prev_next_levels(startref, endref,
                                                                 start_sel, end_sel)
 
-    try:
-        # re-set start_sel and end_sel from output in case 'next' or 'back'
+    def get_section(text_type):
+        """
+        Return the start_sel, end_sel and rendered text of the selected range,
+        from cache.ram as long as the book file is unchanged.
+        """
         myargs = [current_version,
-                  current_ms,
+                  text_type,
                   start_sel,
                   end_sel,
                   next_level,
                   previous_level]
-        text_iterator, start_sel, end_sel = p.get_text(*myargs)
-        parsed_text = list(text_iterator)
+
+        def render():
+            # re-set start_sel and end_sel from output in case 'next' or 'back'
+            text_iterator, new_start_sel, new_end_sel = p.get_text(*myargs)
+            mytext = _render_text(text_iterator, levels)
+            return new_start_sel, new_end_sel, [XML(CAT(*mytext))]
+
+        return cache.ram(_section_cache_key(filename, myargs), render,
+                         time_expire=SECTION_CACHE_EXPIRE)
+
+    mytext = []
+    try:
+        start_sel, end_sel, mytext = get_section(current_ms)
     except ElementDoesNotExist, e:
         try:
             print traceback.format_exc()
-            text_iterator, start_sel, end_sel = p.get_text(current_version,
-                                                        current_ms + ' ',
-                                                        start_sel,
-                                                        end_sel,
-                                                        next_level=next_level,
-                                                        previous_level=previous_level)
-            parsed_text = list(text_iterator)
+            start_sel, end_sel, mytext = get_section(current_ms + ' ')
         except ElementDoesNotExist, e:
             print traceback.format_exc()
             response.flash = 'Sorry, no text matched the selected range.'
@@ -727,11 +724,174 @@ def section():
         response.flash = 'Sorry, that text type is not part of the {} version' \
                         ''.format(current_version)
 
-    # build the running display text ----------------------------------------
+    if vbs: print 'sending', '-'.join(start_sel)
+
+    return {'versions': myversions,
+            'current_version': current_version,
+            'version_language': vlang,
+            'mslist': mslist,
+            'start_sel_str': '|'.join(start_sel),
+            'end_sel_str': '|'.join(end_sel),
+            'fragment': myfrag,
+            'sel_text': mytext,
+            'filename': session.filename,
+            'structure': structure}
+
+
+def _section_cache_key(filename, myargs):
+    """
+    Build the cache.ram key of a rendered text section. The mtime and size of
+    the book file are part of the key, so a republished book is never served
+    from stale entries.
+    """
+    book_file = 'applications/grammateus3/static/docs/{}.xml'.format(filename)
+    stat = os.stat(book_file)
+    return 'docs_section:{}:{}:{}:{!r}'.format(filename, stat.st_mtime,
+                                               stat.st_size, myargs)
+
+
+def section_json():
+    """
+    Return a text section (see section()) as compact json for the request
+    variables 'version', 'type', 'from' and 'to' (all optional, as for
+    section(), including 'next<level>' and 'back<level>'):
+
+        {"book": "1En", "version": "Greek", "text_type": "Gizeh", "language": "Greek",
+         "start": ["1", "1"], "end": ["1", "9"],
+         "fields": ["unit_id", "readings_in_unit", "linebreak", "indent", "text"],
+         "divs": [[["1", "1"], [["1", 4, "", "", "..."], ...]], ...]}
+
+    The Text objects returned by Book.get_text() are grouped by their div path
+    and listed as arrays of the values of "fields".
+
+    The response has a strong ETag derived from the content hash of the book
+    file and the requested range, and the Last-Modified date of the file.
+    Conditional requests (If-None-Match, If-Modified-Since) are answered with
+    304 Not Modified while the book is unchanged.
+    """
+    filename = get_truename(request.args[0])
+    info, p = _get_bookinfo(filename)
+    book_file = 'applications/grammateus3/static/docs/{}.xml'.format(filename)
+    mtime = os.stat(book_file).st_mtime
+
+    versions = OrderedDict((v['attributes']['title'], v) for v in info['version'])
+    current_version = (request.vars['version'] or versions.keys()[0]).replace('_', ' ')
+    if current_version not in versions:
+        _json_error('no version {}'.format(current_version))
+    curv = versions[current_version]
+    if request.vars['type']:
+        current_ms = request.vars['type'].replace('_', ' ').strip()
+    else:
+        current_ms = flatten([[to_unicode(k.strip()) for k, c in v.iteritems()
+                               if c['attributes']['show'] == 'yes']
+                              for v in curv['manuscripts']])[0]
+
+    if 'from' in request.vars:
+        start_sel = [s for s in request.vars['from'].split('-') if s]
+    else:
+        start_sel = list(p.get_reference_trie(current_version).first() or ())
+    endref = request.vars['to'] or ''
+    end_sel = [s for s in endref.split('-') if s] or start_sel
+    next_level = None
+    previous_level = None
+    if endref[:4] == 'next':
+        next_level = int(endref[4:])  # expects like next2
+        end_sel = start_sel
+    elif endref[:4] == 'back':
+        previous_level = int(endref[4:])  # expects like back2
+        end_sel = start_sel
+
+    myargs = [current_version, current_ms, start_sel, end_sel, next_level,
+              previous_level]
+    etag = '"{}"'.format(hashlib.sha1(repr((p.content_hash, myargs))).hexdigest())
+    headers = {'ETag': etag,
+               'Last-Modified': formatdate(mtime, usegmt=True),
+               'Cache-Control': SECTION_JSON_CACHE_CONTROL}
+    if _not_modified(etag, mtime):
+        raise HTTP(304, **headers)
+
+    try:
+        section = cache.ram('docs_section_json:{}'.format(etag),
+                            lambda: _compact_section(filename, p, curv, *myargs[1:]),
+                            time_expire=SECTION_CACHE_EXPIRE)
+    except (ElementDoesNotExist, InvalidDIVPath), e:
+        _json_error('no text matched the selected range')
+    except NotAllowedManuscript, e:
+        _json_error('the text type {} is not part of the {} version'.format(current_ms,
+                                                                            current_version))
+    response.headers.update(headers)
+    response.headers['Content-Type'] = 'application/json'
+    return response.json(section)
+
+
+def _compact_section(filename, p, version_info, text_type, start_sel, end_sel=None,
+                     next_level=None, previous_level=None):
+    """
+    Return the text section selected as for Book.get_text() in the compact
+    form of section_json(). The text type is also tried with a trailing
+    space, like in section().
+    """
+    version_title = version_info['attributes']['title']
+    for my_type in (text_type, text_type + ' '):
+        try:
+            text_iterator, new_start_sel, new_end_sel = p.get_text(
+                version_title, my_type, start_sel, end_sel, next_level,
+                previous_level)
+            break
+        except ElementDoesNotExist:
+            if my_type != text_type:
+                raise
+    divs = []
+    for u in text_iterator:
+        if not divs or divs[-1][0] != list(u.div_path):
+            divs.append([list(u.div_path), []])
+        divs[-1][1].append([u.unit_id, u.readings_in_unit, u.linebreak,
+                            u.indent, u.text])
+    return {'book': filename,
+            'version': version_title,
+            'text_type': text_type,
+            'language': version_info['attributes']['language'],
+            'start': list(new_start_sel),
+            'end': list(new_end_sel),
+            'fields': SECTION_JSON_FIELDS,
+            'divs': divs}
+
+
+def _json_error(message, status=404):
+    """
+    Stop the request with a json error response.
+    """
+    raise HTTP(status, response.json({'error': message}),
+               **{'Content-Type': 'application/json'})
+
+
+def _not_modified(etag, mtime):
+    """
+    Evaluate the conditional headers of the request for a resource with the
+    given ETag and modification time: True if the cached copy of the client is
+    still valid. If-Modified-Since is ignored when If-None-Match is present.
+    """
+    if_none_match = request.env.http_if_none_match
+    if if_none_match:
+        # weak comparison, as required for If-None-Match
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag
+                                       for tag in tags]
+    if_modified_since = request.env.http_if_modified_since
+    if if_modified_since:
+        date = parsedate_tz(if_modified_since)
+        if date is not None:
+            return int(mtime) <= mktime_tz(date)
+    return False
+
+
+def _render_text(parsed_text, levels):
+    """
+    Build the running display text (a list of html helpers) from the Text
+    objects of a section.
+    """
     mytext = []
     refcounter = [None] * levels
-    if vbs: print 'PARSED ============================='
-    if vbs: print parsed_text
     for u in parsed_text:
         # insert reference number/label when it changes
         reflist = list(u.div_path)
@@ -763,18 +923,116 @@ def section():
             print 'LINEBREAK PROBLEM'
             print e
 
-    if vbs: print 'sending', '-'.join(start_sel)
+    return mytext
 
-    return {'versions': myversions,
-            'current_version': current_version,
-            'version_language': vlang,
-            'mslist': mslist,
-            'start_sel_str': '|'.join(start_sel),
-            'end_sel_str': '|'.join(end_sel),
-            'fragment': myfrag,
-            'sel_text': mytext,
-            'filename': session.filename,
-            'structure': session.structure[filename]}
+
+def synopsis():
+    """
+    Populates several text panes for the same range via the synopsis.load view
+
+    Expects the book filename as first url argument and the request variables
+    'pane' (one or more '<version>|<text type>' values), 'from' and optionally
+    'to' (as for section(), including 'next<level>' and 'back<level>'). The
+    range is walked once per version, so the panes of a version stay aligned.
+    """
+    filename = get_truename(request.args[0])
+    info, p = _get_bookinfo(filename)
+    levels = dict((v['attributes']['title'], v['organisation_levels'])
+                  for v in info['version'])
+    languages = dict((v['attributes']['title'], v['attributes']['language'])
+                     for v in info['version'])
+
+    panes = request.vars['pane'] or []
+    if isinstance(panes, basestring):
+        panes = [panes]
+    panes = [tuple(pane.replace('_', ' ').split('|', 1)) for pane in panes]
+    valid_panes = [pane for pane in panes if len(pane) == 2 and pane[0] in levels]
+    if len(valid_panes) < len(panes):
+        response.flash = 'Sorry, some of the requested text panes are not valid'
+    panes = valid_panes
+    if not panes:
+        return {'panes': [],
+                'filename': filename}
+
+    if 'from' in request.vars:
+        startref = request.vars['from']
+        start_sel = [s for s in startref.split('-') if s]
+    elif session.startref:
+        startref = session.startref
+        start_sel = startref.split(':')
+    else:
+        # the first reference of the first pane's version
+        start_sel = list(p.get_reference_trie(panes[0][0]).first() or ())
+        startref = '-'.join(start_sel)
+    endref = request.vars['to'] or startref
+    end_sel = [s for s in endref.split('-') if s]
+    next_level = None
+    previous_level = None
+    if endref[:4] == 'next':
+        next_level = int(endref[4:])  # expects like next2
+        end_sel = start_sel
+    elif endref[:4] == 'back':
+        previous_level = int(endref[4:])  # expects like back2
+        end_sel = start_sel
+
+    mypanes = []
+    try:
+        synopsis = p.get_synopsis(panes, start_sel, end_sel, next_level,
+                                  previous_level)
+        for (version, text_type), (texts, start_sel, end_sel) in zip(panes, synopsis):
+            mypanes.append({'version': version,
+                            'text_type': text_type,
+                            'version_language': languages[version],
+                            'start_sel_str': '|'.join(start_sel),
+                            'end_sel_str': '|'.join(end_sel),
+                            'sel_text': _render_text(texts, levels[version])})
+    except (ElementDoesNotExist, InvalidDIVPath), e:
+        print traceback.format_exc()
+        response.flash = 'Sorry, no text matched the selected range.'
+    except NotAllowedManuscript, e:
+        print traceback.format_exc()
+        response.flash = 'Sorry, one of those text types can not be displayed'
+
+    return {'panes': mypanes,
+            'filename': filename}
+
+
+def search():
+    """
+    Full-text search over all published books (see modules/search.py)
+
+    Request variables:
+        q -- the searched words (all of them must occur in a reading)
+        book, version, language, ms -- optional filters, each may be repeated
+        limit -- the maximum number of hits (default 50)
+    """
+    def listvar(name):
+        value = request.vars[name]
+        if not value:
+            return None
+        return value if isinstance(value, list) else [value]
+
+    query = request.vars['q'] or ''
+    try:
+        limit = int(request.vars['limit'] or 50)
+    except ValueError:
+        limit = 50
+    hits = SEARCH_INDEX.search(to_unicode(query),
+                               books=listvar('book'),
+                               versions=listvar('version'),
+                               languages=listvar('language'),
+                               manuscripts=listvar('ms'),
+                               limit=limit)
+    results = []
+    for hit in hits:
+        ref = '-'.join(d.strip() for d in hit.div_path) + '-'
+        results.append({'hit': hit,
+                        'reference': '.'.join(d.strip() for d in hit.div_path),
+                        'url': URL('docs', 'text', args=[hit.book],
+                                   vars={'from': ref, 'to': ref})})
+
+    return {'query': query,
+            'results': results}
 
 
 def apparatus():
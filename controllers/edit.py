@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
-from parse import BookManager, Book
+from parse import BookManager
+import re
+from search import SEARCH_INDEX
 
 if 0:
     from gluon import current, URL, A, SPAN, P
+    from gluon.cache import Cache
+    cache = Cache()
     request = current.request
     session = current.session
     response = current.response
@@ -30,30 +34,12 @@ def index():
 
 def _get_bookinfo(filename):
     """
-    Retrieve info about the book and parsed book object from session or parser.
+    Retrieve info about the draft book and parsed book object from the shared
+    book cache. Neither is stored in the session.
 
     """
-    vbs = True
-    # FIXME: error when using session values
-    # _element object can't be pickled, and pickling is necessary to store
-    # an object in session
-    if 0 and ('info' in session.keys()) and (filename in session.info.keys()) and \
-            ('p' in session.keys()) and (filename in session.p.keys()):
-        info = session.info[filename]
-        p = cPickle.loads(session.p[filename])
-        if vbs: print info
-        if vbs: print 'using session.info'
-    else:
-        book_file = 'applications/grammateus3/static/docs/drafts/{}.xml'.format(filename)
-        p = Book.open(book_file)
-        if vbs: print 'using newly parsed book object'
-        # if session.p:
-        #     session.p[filename] = p
-        # else:
-        #     session.p = {filename: p}
-        info = p.book_info()
-        session.info = {filename: info}
-    # if vbs: print "info", pprint(info)
+    p = BookManager._load(filename)
+    info = p.get_book_info()
     return info, p
 
 @auth.requires_membership('administrators')
@@ -66,7 +52,7 @@ def renumber():
     """
     print 'edit::renumber:'
     filename = session.filename
-    return BookManager.renumber_units(filename)
+    return BookManager.renumber_units(filename, editor=auth.user_id)
 
 @auth.requires_membership('administrators')
 def publish():
@@ -75,4 +61,9 @@ def publish():
     """
     print 'edit::publish:'
     filename = session.filename
-    return BookManager.publish(filename)
+    result = BookManager.publish_book(filename)
+    # drop the text sections rendered by docs.section from the old file
+    cache.ram.clear(regex='^docs_section:{}:'.format(re.escape(filename)))
+    # re-index the published book only, the searches go on with its old index meanwhile
+    SEARCH_INDEX.update(filename)
+    return result
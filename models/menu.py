@@ -99,6 +99,9 @@ response.menu += [
     (T('Documents'), False, A(I(_class='fa fa-book'),
                               SPAN(' Documents', _class="visible-lg-inline"),
                               _href=URL('default', 'index'), _class='documentslink'), []),
+    (T('Search'), False, A(I(_class='fa fa-search'),
+                           SPAN(' Search', _class="visible-lg-inline"),
+                           _href=URL('docs', 'search'), _class='searchlink'), []),
     (T('Help and Information'), False, A(I(_class='fa fa-info-circle'),
                                          SPAN(' Help and Information',  _class="visible-lg-inline"),
                                          _href='#', _class='helplink'), [
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed, deduplicating store for the backups of the xml files
+
+A document is split into chunks at <div> and <unit> boundaries. Every chunk
+is stored once, zlib-compressed, under its sha1 hash; a backup is a small
+json manifest listing the hashes of its chunks. Revisions of the same book
+share all chunks but the edited ones, so a new backup costs little more than
+the size of the changes.
+
+The store folder holds:
+
+    objects/<first 2 hash digits>/<other hash digits> -- the chunks
+    manifests/<name>/<backup id>.json -- the backups
+    lock -- locked while a backup is written or removed and during the
+        garbage collection, by every BackupStore on the folder in any process
+"""
+from contextlib import contextmanager
+from datetime import datetime
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+import zlib
+
+# a chunk ends at a <div>/<unit> boundary when it's at least this long and the
+# hash of its last piece matches CHUNK_MASK (on average every 8 pieces) ...
+CHUNK_MIN_SIZE = 2 * 1024
+CHUNK_MASK = 0x7
+# ... or at the first boundary after this size
+CHUNK_MAX_SIZE = 64 * 1024
+
+_BOUNDARY_RE = re.compile(r"(?=<(?:div|unit)[\s/>])")
+
+
+def split_chunks(data):
+    """
+    Split an xml document into chunks at <div> and <unit> start tags.
+
+    The boundaries depend on the content near them only, so an edit changes
+    the chunk it falls in, while the chunks before and after it stay the same.
+
+    :param data: string
+    :return: list of strings, joined they give data
+    """
+    # re.split() doesn't split at empty matches
+    starts = [m.start() for m in _BOUNDARY_RE.finditer(data)]
+    chunks = []
+    chunk = []
+    size = 0
+    for start, end in zip([0] + starts, starts + [len(data)]):
+        piece = data[start:end]
+        chunk.append(piece)
+        size += len(piece)
+        if size >= CHUNK_MAX_SIZE or \
+                (size >= CHUNK_MIN_SIZE and zlib.crc32(piece) & CHUNK_MASK == 0):
+            chunks.append("".join(chunk))
+            chunk = []
+            size = 0
+    if chunk:
+        chunks.append("".join(chunk))
+    return chunks
+
+
+def _write_file(path, data):
+    """
+    Write a file atomically by renaming a temporary file.
+    """
+    temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.rename(temp_path, path)
+
+
+class BackupDoesNotExist(Exception):
+    pass
+
+
+class BackupStore(object):
+    """
+    Backups of the xml files of one folder (see the module docstring).
+    """
+
+    ID_FORMAT = "%Y%m%d_%H%M%S_%f"
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the exclusive lock of the store folder. A backup stores its new
+        chunks before its manifest, so without the lock a concurrent
+        collect_garbage() could remove a chunk that isn't listed yet.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(os.path.join(self.path, "lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _object_path(self, digest):
+        return os.path.join(self.path, "objects", digest[:2], digest[2:])
+
+    def _manifest_folder(self, name):
+        return os.path.join(self.path, "manifests", name)
+
+    def _manifest_path(self, name, backup_id):
+        return os.path.join(self._manifest_folder(name), "{}.json".format(backup_id))
+
+    def _store_chunk(self, chunk):
+        digest = hashlib.sha1(chunk).hexdigest()
+        object_path = self._object_path(digest)
+        if not os.path.isfile(object_path):
+            if not os.path.isdir(os.path.dirname(object_path)):
+                os.makedirs(os.path.dirname(object_path))
+            _write_file(object_path, zlib.compress(chunk, 9))
+        return digest
+
+    def backup(self, name, data, backup_id=None):
+        """
+        Store a new backup of a document.
+
+        :param name: name of the document, e.g. the book name
+        :param data: string, content of the document
+        :param backup_id: string, default: the current time
+        :return: the backup id
+        """
+        if backup_id is None:
+            backup_id = datetime.now().strftime(self.ID_FORMAT)
+        with self._locked():
+            chunks = [self._store_chunk(chunk) for chunk in split_chunks(data)]
+            if not os.path.isdir(self._manifest_folder(name)):
+                os.makedirs(self._manifest_folder(name))
+            manifest = {"name": name,
+                        "id": backup_id,
+                        "size": len(data),
+                        "sha1": hashlib.sha1(data).hexdigest(),
+                        "chunks": chunks}
+            _write_file(self._manifest_path(name, backup_id), json.dumps(manifest))
+        return backup_id
+
+    def backup_file(self, name, path, backup_id=None):
+        """
+        Store a new backup of the given file (see backup()).
+        """
+        with open(path, "rb") as f:
+            return self.backup(name, f.read(), backup_id)
+
+    def names(self):
+        """
+        Return the names of the documents with backups.
+        """
+        folder = os.path.join(self.path, "manifests")
+        return sorted(os.listdir(folder)) if os.path.isdir(folder) else []
+
+    def backups(self, name):
+        """
+        Return the backup ids of a document in ascending order.
+        """
+        folder = self._manifest_folder(name)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(f[:-len(".json")] for f in os.listdir(folder) if f.endswith(".json"))
+
+    def manifest(self, name, backup_id):
+        try:
+            with open(self._manifest_path(name, backup_id), "r") as f:
+                return json.load(f)
+        except IOError:
+            raise BackupDoesNotExist("There is no backup {} of {}".format(backup_id, name))
+
+    def restore(self, name, backup_id):
+        """
+        Rebuild the content of a document from a backup.
+
+        :return: string
+        """
+        manifest = self.manifest(name, backup_id)
+        chunks = []
+        for digest in manifest["chunks"]:
+            with open(self._object_path(digest), "rb") as f:
+                chunks.append(zlib.decompress(f.read()))
+        data = "".join(chunks)
+        if hashlib.sha1(data).hexdigest() != manifest["sha1"]:
+            raise IOError("Backup {} of {} is corrupt".format(backup_id, name))
+        return data
+
+    def restore_file(self, name, backup_id, path):
+        """
+        Write the content of a backup to the given file.
+        """
+        _write_file(path, self.restore(name, backup_id))
+
+    def delete(self, name, backup_id):
+        """
+        Remove a backup. Its chunks are removed by collect_garbage().
+        """
+        with self._locked():
+            try:
+                os.remove(self._manifest_path(name, backup_id))
+            except OSError:
+                raise BackupDoesNotExist("There is no backup {} of {}".format(backup_id, name))
+
+    def prune(self, name, keep):
+        """
+        Remove all but the last keep backups of a document and the chunks
+        that are no longer used.
+
+        :return: the removed backup ids
+        """
+        backup_ids = self.backups(name)
+        removed = backup_ids[:max(len(backup_ids) - keep, 0)]
+        for backup_id in removed:
+            self.delete(name, backup_id)
+        if removed:
+            self.collect_garbage()
+        return removed
+
+    def _objects(self):
+        objects_folder = os.path.join(self.path, "objects")
+        if not os.path.isdir(objects_folder):
+            return
+        for prefix in os.listdir(objects_folder):
+            for rest in os.listdir(os.path.join(objects_folder, prefix)):
+                if not rest.endswith(".tmp"):
+                    yield prefix + rest
+
+    def collect_garbage(self):
+        """
+        Remove the chunks not listed in any manifest.
+
+        :return: the number of removed chunks
+        """
+        with self._locked():
+            used = set()
+            for name in self.names():
+                for backup_id in self.backups(name):
+                    used.update(self.manifest(name, backup_id)["chunks"])
+            removed = 0
+            for digest in list(self._objects()):
+                if digest not in used:
+                    os.remove(self._object_path(digest))
+                    removed += 1
+            return removed
+
+    def stats(self):
+        """
+        Return the number of backups, their total (restored) size and the
+        number and size of the stored chunks.
+        """
+        backups = 0
+        size = 0
+        for name in self.names():
+            for backup_id in self.backups(name):
+                backups += 1
+                size += self.manifest(name, backup_id)["size"]
+        objects = 0
+        stored_size = 0
+        for digest in self._objects():
+            objects += 1
+            stored_size += os.path.getsize(self._object_path(digest))
+        return {"backups": backups,
+                "size": size,
+                "chunks": objects,
+                "stored_size": stored_size}
@@ -1,14 +1,26 @@
 # -*- coding: utf-8 -*-
+import atexit
+from backup import BackupStore
 from collections import namedtuple
 from collections import OrderedDict
 from copy import deepcopy
-from datetime import datetime
+from datetime import datetime, timedelta
 from gluon import A, DIV, SPAN, TAG
 from kitchen.text.converters import to_unicode
+import fcntl
+import glob
+import hashlib
+import itertools
+import json
 from lxml import etree
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 from plugin_utils import check_path
+import re
+from StringIO import StringIO
 # from pprint import pprint
+import threading
 import time
 import traceback
 
@@ -23,14 +35,34 @@ XML_DRAFT_FILE_STORAGE_PATH = check_path(os.path.join(PROJECT_ROOT, "static",
 XML_DRAFT_FILE_BACKUP_STORAGE_PATH = check_path(os.path.join(PROJECT_ROOT,
                                                              "static", "docs",
                                                              "drafts", "backups"))
+XML_DTD_FILE_PATH = check_path(os.path.join(PROJECT_ROOT, "static", "docs",
+                                            "grammateus.dtd"))
+
+# upper limit for the parsed books kept in memory, measured in bytes of xml source
+BOOK_CACHE_MAX_SIZE = 64 * 1024 * 1024
+# upper limit for the threads of the BookManager batch methods
+BOOK_MANAGER_MAX_THREADS = 4
+# seconds after the first unsaved change until a draft session writes the book
+DRAFT_SESSION_FLUSH_DELAY = 5
+# operations recorded in a draft journal between two snapshots of the whole book
+DRAFT_JOURNAL_SNAPSHOT_INTERVAL = 200
+# days of draft history kept in a draft journal; older history is compacted away
+DRAFT_JOURNAL_RETENTION_DAYS = 90
+# upper limit for the draft journals kept open (in memory) per process
+DRAFT_JOURNAL_MAX_OPEN = 64
 
 XML_DEFAULT_DOCINFO = {"encoding": "UTF-8",
                        "doctype": "<!DOCTYPE book SYSTEM 'grammateus.dtd'>",
                        "standalone": False}
 
+# The result records are namedtuples (tuples without an instance __dict__).
+# They hold only plain strings, tuples and dicts, never lxml proxies, so
+# cached results don't keep the parsed trees alive. The frequently repeated
+# strings (languages, sigla, div numbers, <w> attributes) are interned.
 Text = namedtuple("Text", "div_path, unit_id, language, readings_in_unit, linebreak, indent, text")
 Reading = namedtuple("Reading", "mss, text")
 W = namedtuple("W", "attributes, text")
+LeafDiv = namedtuple("LeafDiv", "div_path, ordinal, first_unit, last_unit, element")
 
 # -------------------------------
 # Common Exception classes
@@ -61,14 +93,46 @@ class NotUniqueDIVName(Exception):
     pass
 
 
+class RevisionDoesNotExist(Exception):
+    pass
+
+
+class StaleRevision(Exception):
+    pass
+
+
 # -------------------------------
 # Common tools
 # -------------------------------
 
 
+def write_file(path, data):
+    """
+    Replace the content of a file atomically: the data is written to a
+    temporary file in the same folder, which is then renamed.
+    """
+    temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+    with open(temp_path, "w") as f:
+        f.write(data)
+    os.rename(temp_path, path)
+
+
 def copy_file(src, dst):
-    with open(dst, "w") as f:
-        f.write(open(src).read())
+    with open(src) as f:
+        write_file(dst, f.read())
+
+
+_INTERNED_STRINGS = {}
+
+
+def _intern(value):
+    """
+    Return the shared copy of an equal (str or unicode) string, None is
+    returned as it is.
+    """
+    if value is None:
+        return None
+    return _INTERNED_STRINGS.setdefault(value, value)
 
 
 def timing(f):
@@ -114,6 +178,10 @@ class BookValidator(object):
     Validates an OCP xml file both by DTD and semantically.
     """
 
+    # key: (path, mtime, size) or sha1 of the DTD data, value: etree.DTD;
+    # per thread, since a DTD object keeps the error log of its last run
+    _dtds = threading.local()
+
     def __init__(self):
         """
         Initializa a BookValidator object.
@@ -130,7 +198,7 @@ class BookValidator(object):
 
         params
         --------
-        dtd_data
+        dtd_data: the DTD in a file-like object or the path of the DTD file
         book (Book): The Book object whose xml file is to be validated.
 
         """
@@ -139,86 +207,228 @@ class BookValidator(object):
         self._validate_by_semantic(book)
         return self._validation_errors == []
 
+    @classmethod
+    def _compiled_dtd(cls, dtd_data):
+        """
+        Return the etree.DTD of the given file-like object or file path. Each
+        DTD is compiled only once (per thread) and reused while the file is
+        unchanged.
+        """
+        dtds = cls._dtds.__dict__.setdefault("dtds", {})
+        if isinstance(dtd_data, basestring):
+            stat = os.stat(dtd_data)
+            key = (os.path.abspath(dtd_data), stat.st_mtime, stat.st_size)
+        else:
+            try:
+                dtd_data = dtd_data.read()
+            except AttributeError:
+                raise TypeError("validate() requires DTD in a file-like object")
+            key = hashlib.sha1(dtd_data).hexdigest()
+        dtd = dtds.get(key)
+        if dtd is None:
+            if isinstance(key, tuple):
+                dtd = etree.DTD(dtd_data)
+            else:
+                dtd = etree.DTD(StringIO(dtd_data))
+            dtds[key] = dtd
+        return dtd
+
     def _validate_by_dtd(self, dtd_data, book):
         """Validate the book structure with DTD"""
-        try:
-            dtd = etree.DTD(dtd_data)
-        except AttributeError:
-            raise TypeError("validate() requires DTD in a file-like object")
-        if not dtd.validate(book):
+        dtd = self._compiled_dtd(dtd_data)
+        if not dtd.validate(book._book):
             self._validation_errors += dtd.error_log.filter_from_errors()
 
     def _validate_by_semantic(self, book):
         """Validate the inner structure and values of the book document"""
-
-        def do_div_name_checking_on_children(parent_element):
-            """Do recursive checking on unique div names under the parent_element"""
-            div_names = set()
-            num_of_div_names = 0
-            for div_element in parent_element.iterchildren("div"):
-                num_of_div_names += 1
-                div_names.add(div_element.get("number"))
-                do_div_name_checking_on_children(div_element)
-            if num_of_div_names != len(div_names):
-                raise NotUniqueDIVName(
-                    "/".join("div number='{}'".format(div_name)
-                             for div_name in book._locate_div_path(parent_element))
-                )
-
-        semantic_errors = []
-
-        # let's run trough the versions
         for version in book.xpath("version"):
+            self._validation_errors += _SemanticChecker(book, version).check(version)
+
+    def validate_subtree(self, book, element):
+        """
+        Validate semantically only the element and its descendants, e.g. the
+        element changed by a BookEditor operation (see BookEditor.touched).
+        The numbering of the units and the div names are checked against the
+        neighbours of the element as well, so after an edit of a valid book
+        the result is the same as of validate() without the DTD validation.
+
+        params
+        --------
+        book (Book): The Book object the element belongs to.
+        element: <version>, <text>, <div>, <unit> or any other element of a
+        version, the <book> for all versions, None for nothing to validate
+        (e.g. a deleted version).
+
+        """
+        self._validation_errors = []
+        if element is not None and element.tag == "book":
+            self._validate_by_semantic(book)
+        elif element is not None:
+            if element.tag == "version":
+                version = element
+            else:
+                version = element.xpath("ancestor::version[1]")[0]
+            self._validation_errors += _SemanticChecker(book, version).check(element)
+        return self._validation_errors == []
+
 
-            # each //reading/@mss in //manuscripts/ms/@abbrev
+class _SemanticChecker(object):
+    """
+    The semantic checks of one <version> done in a single pass over the
+    elements (see BookValidator):
+
+    - each //reading/@mss in //manuscripts/ms/@abbrev
+    - the //unit/@id is unique and consecutive
+    - number of levels of divisions == number of levels of divs
+    - there are no duplicated div/@number at the same level
+    - units are strictly at the deepest level of div structure
+    - correct numbers in reading/@option (0, 1, 2, ... in each unit)
+
+    Like the former separate checks, each check reports its first error only.
+    """
+
+    _TAGS = ("division", "ms", "text", "div", "unit", "reading")
+
+    def __init__(self, book, version):
+        self._book = book
+        self._version = version
+        self._title = version.get("title")
+
+    def _div_path(self, element):
+        if element.tag != "div":
+            return ""
+        return "/".join("div number='{}'".format(div_name)
+                        for div_name in self._book._locate_div_path(element))
+
+    def _neighbour_unit(self, element, axis):
+        """Return the preceding or following unit of the element in the same version"""
+        units = element.xpath("{}::unit[1]".format(axis))
+        if units and units[0].xpath("ancestor::version[1]")[0] == self._version:
+            return units[0]
+        return None
+
+    def check(self, element):
+        """
+        Check the element (the version or a part of it) and its descendants.
+
+        :return: list of error messages
+        """
+        whole_version = element == self._version
+        if whole_version:
+            # <divisions> and <manuscripts> precede <text>
             ms_reg = set()
-            for abbrev in version.xpath("manuscripts/ms/@abbrev"):
-                ms_reg.add(abbrev.strip())
-            ms_in_use = set()
-            for mss in version.xpath(".//reading/@mss"):
-                for ms in mss.split(" "):
+            num_of_divisions = 0
+            depth = 0
+            unit_index = 0
+        else:
+            ms_reg = set(abbrev.strip() for abbrev in self._version.xpath("manuscripts/ms/@abbrev"))
+            num_of_divisions = int(self._version.xpath("count(divisions/division)"))
+            depth = sum(1 for _ in element.iterancestors("div"))
+            preceding_unit = self._neighbour_unit(element, "preceding")
+            if preceding_unit is None:
+                unit_index = 0
+            else:
+                try:
+                    unit_index = int(preceding_unit.get("id"))
+                except ValueError:
+                    # the wrong id is reported when its own subtree is checked
+                    unit_index = None
+        ms_in_use = set()
+        wrong_unit = None
+        deeper_div = None
+        # stack of the names of the child divs of the open <text> and <div> elements
+        div_names = []
+        not_unique_parent = None
+        misplaced_unit = None
+        option_index = 0
+        wrong_option_unit = None
+        unit = None
+
+        for event, elem in etree.iterwalk(element, events=("start", "end"), tag=self._TAGS):
+            tag = elem.tag
+            if event == "end":
+                if tag in ("div", "text"):
+                    names, num_of_div_names = div_names.pop()
+                    if num_of_div_names != len(names) and not_unique_parent is None:
+                        not_unique_parent = elem
+                    if tag == "div":
+                        depth -= 1
+            elif tag == "reading":
+                for ms in elem.get("mss", "").split(" "):
                     if ms.strip():
                         ms_in_use.add(ms.strip())
-            if ms_in_use > ms_reg:
-                semantic_errors.append(
-                    (u"<version title='{}'> has missing manuscript definition(s) "
-                     "which are in use: {}".format(
-                        version.get("title"),
-                        u",".join(ms_in_use - ms_reg))).encode("utf-8"))
-
-            # the //unit/@id is unique and consecutive
-            for index, unit_id in enumerate(version.xpath(".//unit/@id"), 1):
-                if index != int(unit_id):
-                    semantic_errors.append(
-                        "<version title='{}'>//<unit id='{}'> has wrong id. "
-                        "It should be '{}'.".format(version.get("title"), unit_id, index))
-                    break
-
-            # number of levels of divisions == number of levels of divs
-            # I couldn't test it because the _get_book_info() is method too sensitive to this type of error
-            num_of_divisions = int(version.xpath("count(divisions/division)"))
-            xpath_to_deeper_div_than_divisions = "text/{}//div".format("/".join(["div"] * num_of_divisions))
-            deeper_div = version.xpath(xpath_to_deeper_div_than_divisions)
-            if deeper_div:
-                semantic_errors.append(
-                    "<version title='{}'> has deeper <div> structure than in <divisions>. "
-                    "For example: <text/{}>".format(
-                        version.get("title"),
-                        "/".join("div number=''".format(div_name) for div_name in book._locate_div_path(deeper_div))))
-
-            # there are no duplicated div/@number at the same level
-            try:
-                do_div_name_checking_on_children(book._get("text", None, on_element=version))
-            except NotUniqueDIVName as e:
-                semantic_errors.append(
-                    "<version title='{}'/text/{}> has <div> with not unique name (number)".format(
-                        version.get("title"),
-                        e.message))
+                if elem.get("option") != str(option_index) and wrong_option_unit is None:
+                    wrong_option_unit = unit
+                option_index += 1
+            elif tag == "unit":
+                unit = elem
+                option_index = 0
+                if unit_index is not None and wrong_unit is None:
+                    unit_index += 1
+                    if elem.get("id") != str(unit_index):
+                        wrong_unit = elem
+                if depth != num_of_divisions and misplaced_unit is None:
+                    misplaced_unit = elem
+            elif tag == "div":
+                depth += 1
+                if depth > num_of_divisions and deeper_div is None:
+                    deeper_div = elem
+                if div_names:
+                    names = div_names[-1][0]
+                    names.add(elem.get("number"))
+                    div_names[-1][1] += 1
+                div_names.append([set(), 0])
+            elif tag == "text":
+                div_names.append([set(), 0])
+            elif tag == "division":
+                num_of_divisions += 1
+            elif tag == "ms":
+                ms_reg.add(elem.get("abbrev", "").strip())
+
+        if not whole_version:
+            # the neighbours of the checked subtree
+            if unit_index is not None and wrong_unit is None:
+                following_unit = self._neighbour_unit(element, "following")
+                if following_unit is not None and following_unit.get("id") != str(unit_index + 1):
+                    wrong_unit = following_unit
+                    unit_index += 1
+            if element.tag == "div" and not_unique_parent is None:
+                parent = element.getparent()
+                names = [div.get("number") for div in parent.iterchildren("div")]
+                if len(names) != len(set(names)):
+                    not_unique_parent = parent
 
-            # TODO: units are strictly at the deepest level of div structure
-            # TODO: correct numbers in reading/@option
-
-        self._validation_errors += semantic_errors
+        errors = []
+        if ms_in_use - ms_reg:
+            errors.append(
+                (u"<version title='{}'> has missing manuscript definition(s) "
+                 "which are in use: {}".format(
+                    self._title,
+                    u",".join(ms_in_use - ms_reg))).encode("utf-8"))
+        if wrong_unit is not None:
+            errors.append(
+                "<version title='{}'>//<unit id='{}'> has wrong id. "
+                "It should be '{}'.".format(self._title, wrong_unit.get("id"), unit_index))
+        if deeper_div is not None:
+            errors.append(
+                "<version title='{}'> has deeper <div> structure than in <divisions>. "
+                "For example: <text/{}>".format(self._title, self._div_path(deeper_div)))
+        if not_unique_parent is not None:
+            errors.append(
+                "<version title='{}'/text/{}> has <div> with not unique name (number)".format(
+                    self._title, self._div_path(not_unique_parent)))
+        if misplaced_unit is not None:
+            errors.append(
+                "<version title='{}'>//<unit id='{}'> is not at the deepest level of "
+                "the <div> structure: <text/{}>".format(
+                    self._title, misplaced_unit.get("id"),
+                    self._div_path(misplaced_unit.getparent())))
+        if wrong_option_unit is not None:
+            errors.append(
+                "<version title='{}'>//<unit id='{}'> has <reading> with wrong option. "
+                "The options should be numbered from '0'.".format(
+                    self._title, wrong_option_unit.get("id")))
+        return errors
 
 
 class BookEditor(object):
@@ -231,37 +441,70 @@ class BookEditor(object):
         mybook: instance of Book class
         """
         self._book = mybook
+        # the element changed by the last operation, for BookValidator.validate_subtree()
+        self.touched = None
 
-    def _renumber_units(self):
+    def _renumber_units(self, start_unit=None, edited_units=()):
         """
         If we're adding or removing an element that contains units (div or unit),
         all units that follow the affected units must be renumbered since all units
         in a document must be numbered consecutively.
-        """
-        print '_renumber_units'
-        try:
-            print len(self._book.xpath("//unit"))
-            for index, unit in enumerate(self._book.xpath(".//unit"), 1):
-                print index
-                unit.set("id", str(index))
-                for idx, reading in enumerate(unit.xpath(".//reading")):
-                    reading.set("option", str(idx))
-        except Exception as e:
-            traceback.print_exc(e)
+
+        Only the units from start_unit (the first unit whose position may have
+        changed) to the end of the document are visited, and only the ids that
+        actually change are rewritten. The units before start_unit are expected
+        to be numbered correctly already. The options of the readings are
+        renumbered in the edited_units only. Without start_unit every unit and
+        every reading of the book is renumbered (to repair a document).
+
+        The unit id indexes of the versions with changed ids are dropped; the
+        div tables are left to the callers, since they depend on the edit.
+        """
+        if start_unit is None:
+            units = self._book.xpath("//unit")
+            edited_units = units
+            index = 0
+            self.touched = self._book._book
+        else:
+            preceding_unit = start_unit.xpath("preceding::unit[1]")
+            index = int(preceding_unit[0].get("id")) if preceding_unit else 0
+            units = itertools.chain([start_unit], start_unit.xpath("following::unit"))
+
+        first_changed_unit = None
+        for unit in units:
+            index += 1
+            unit_id = str(index)
+            if unit.get("id") != unit_id:
+                unit.set("id", unit_id)
+                if first_changed_unit is None:
+                    first_changed_unit = unit
+        if first_changed_unit is not None:
+            version = first_changed_unit.xpath("ancestor::version[1]")[0]
+            for version in itertools.chain([version], version.itersiblings("version")):
+                self._book._drop_version_index(version, "units")
+
+        for unit in edited_units:
+            for idx, reading in enumerate(unit.iterchildren("reading")):
+                option = str(idx)
+                if reading.get("option") != option:
+                    reading.set("option", option)
 
     def add_bibliography(self, version_title, abbrev, text):
         ms = self._book._get("manuscripts/ms", {"abbrev": abbrev}, self._book._get("version", {"title": version_title}))
         etree.SubElement(ms, "bibliography").text = text
+        self.touched = ms
 
     def update_bibliography(self, version_title, abbrev, bibliography_pos, new_text):
         ms = self._book._get("manuscripts/ms", {"abbrev": abbrev}, self._book._get("version", {"title": version_title}))
         bibliography = self._book._get("bibliography[{}]".format(int(bibliography_pos) + 1), None, ms)
         bibliography.text = new_text
+        self.touched = ms
 
     def del_bibliography(self, version_title, abbrev, bibliography_pos):
         ms = self._book._get("manuscripts/ms", {"abbrev": abbrev}, self._book._get("version", {"title": version_title}))
         bibliography = self._book._get("bibliography[{}]".format(int(bibliography_pos) + 1), None, ms)
         bibliography.getparent().remove(bibliography)
+        self.touched = ms
 
     def add_div(self, version_title, div_name, div_parent_path, preceding_div=None):
         if div_parent_path:
@@ -274,20 +517,28 @@ class BookEditor(object):
             div_sibling.addnext(etree.Element("div", {"number": str(div_name)}))
         else:
             div_parent.append(etree.Element("div", {"number": str(div_name)}))
+        self._book._drop_version_index(self._book._get("version", {"title": version_title}), "divs")
+        self.touched = div_parent
 
     def update_div(self, version_title, div_path, new_div_name):
         div_xpath = "/".join(["text"] + ["div[@number='{}']".format(div_number) for div_number in div_path])
         version = self._book._get("version", {"title": version_title})
         div = self._book._get(div_xpath, attribute=None, on_element=version)
         div.set("number", new_div_name)
-        self._renumber_units()
+        # the order of the units doesn't change, only the div paths
+        self._book._drop_version_index(version, "divs")
+        self.touched = div.getparent()
 
     def del_div(self, version_title, div_path):
         div_xpath = "/".join(["text"] + ["div[@number='{}']".format(div_number) for div_number in div_path])
         version = self._book._get("version", {"title": version_title})
         div = self._book._get(div_xpath, attribute=None, on_element=version)
-        div.getparent().remove(div)
-        self._renumber_units()
+        following_unit = div.xpath("following::unit[1]")
+        self.touched = div.getparent()
+        self.touched.remove(div)
+        self._book._drop_version_index(version, "units", "mss", "divs")
+        if following_unit:
+            self._renumber_units(following_unit[0])
 
     def add_unit(self, version_title, div_path):
         parent_div_xpath = "/".join(["text"] + ["div[@number='{}']".format(div_number) for div_number in div_path])
@@ -295,15 +546,21 @@ class BookEditor(object):
         parent_div = self._book._get(parent_div_xpath,
                                attribute=None,
                                on_element=version)
-        etree.SubElement(parent_div, "unit", {"id": "0"}).append(etree.Element("reading"))
-        self._renumber_units()
+        unit = etree.SubElement(parent_div, "unit", {"id": "0"})
+        unit.append(etree.Element("reading"))
+        self._book._drop_version_index(version, "divs")
+        self._renumber_units(unit, [unit])
+        self.touched = parent_div
 
     def update_unit(self, version_title, unit_id, readings):
-        unit = self._book._get("//unit", {"id": str(unit_id)}, self._book._get("version", {"title": version_title}))
+        version = self._book._get("version", {"title": version_title})
+        unit = self._book._get_unit(version, unit_id)
         unit.clear()
         unit.set("id", unit_id)
         for index, reading in enumerate(readings):
             etree.SubElement(unit, "reading", {"option": str(index), "mss": reading[0]}).text = reading[1]
+        self._book._drop_version_index(version, "mss")
+        self.touched = unit
 
     def _clone_unit(self, unit_element):
         cloned_unit = deepcopy(unit_element)
@@ -313,7 +570,7 @@ class BookEditor(object):
 
     def split_unit(self, version_title, unit_id, reading_pos, split_point):
         version = self._book._get("version", {"title": version_title})
-        unit = self._book._get("//unit", {"id": str(unit_id)}, version)
+        unit = self._book._get_unit(version, unit_id)
         reading_pos = int(reading_pos)
         if -1 < reading_pos < len(unit):
             reading = unit[reading_pos]
@@ -334,13 +591,20 @@ class BookEditor(object):
                 next_unit[reading_pos].text = reading.text[split_point:].strip()
                 unit.addnext(next_unit)
                 reading.text = reading.text[:split_point].strip()
-            # renumber units
-            self._renumber_units()
+            new_units = list(itertools.takewhile(lambda u: u.get("id") == unit.get("id"),
+                                                 unit.itersiblings("unit")))
+            if not new_units:
+                return  # the split point isn't in the reading, nothing changed
+            self._book._drop_version_index(version, "mss", "divs")
+            # renumber the new units and the ones following them
+            self._renumber_units(new_units[0], [unit] + new_units)
+            self.touched = unit.getparent()
         else:
             raise ElementDoesNotExist('<unit id="{}"> has no reading at position {}'.format(unit_id, reading_pos))
 
     def split_reading(self, version_title, unit_id, reading_pos, split_point):
-        unit = self._book._get("//unit", {"id": str(unit_id)}, self._book._get("version", {"title": version_title}))
+        version = self._book._get("version", {"title": version_title})
+        unit = self._book._get_unit(version, unit_id)
         reading_pos = int(reading_pos)
         if -1 < reading_pos < len(unit):
             reading = unit[reading_pos]
@@ -364,19 +628,25 @@ class BookEditor(object):
             # renumber the option attribute
             for index, reading in enumerate(unit):
                 reading.set("option", str(index))
+            self._book._drop_version_index(version, "mss")
+            self.touched = unit
         else:
             raise ElementDoesNotExist('<unit id="{}"> has no reading at position {}'.format(unit_id, reading_pos))
 
     def del_unit(self, version_title, unit_id):
         version = self._book._get("version", {"title": version_title})
-        unit = self._book._get("//unit", {"id": str(unit_id)}, on_element=version)
-        unit.getparent().remove(unit)
-        self._renumber_units()
+        unit = self._book._get_unit(version, unit_id)
+        following_unit = unit.xpath("following::unit[1]")
+        self.touched = unit.getparent()
+        self.touched.remove(unit)
+        self._book._drop_version_index(version, "units", "mss", "divs")
+        if following_unit:
+            self._renumber_units(following_unit[0])
 
     def add_version(self, version_title, language, author, mss=None):
         if self._book.xpath("version[@title='{}']".format(version_title)):
             raise ElementAlreadyExists("<version> element with title='{}' already exists")
-        version = etree.SubElement(self._book,
+        version = etree.SubElement(self._book._book,
                                    "version",
                                    attrib={"title": version_title,
                                            "author": author,
@@ -394,6 +664,7 @@ class BookEditor(object):
                                  "ms",
                                  attrib={"abbrev": ms, "language": "", "show": ""}).append(etree.Element("name"))
         etree.SubElement(version, "text")
+        self.touched = version
 
     def update_version(self, version_title, new_version_title=None, new_language=None, new_author=None):
         version = self._book._get("version", {"title": version_title})
@@ -403,10 +674,13 @@ class BookEditor(object):
             version.set("language", new_language)
         if new_author:
             version.set("author", new_author)
+        self.touched = version
 
     def del_version(self, version_title):
         version = self._book._get("version", {"title": version_title})
         version.getparent().remove(version)
+        self._book._version_indexes.pop(version, None)
+        self.touched = None
 
     def add_manuscript(self, version_title, abbrev, language, show=True):
         manuscripts = self._book._get("manuscripts", None, self._book._get("version", {"title": version_title}))
@@ -414,6 +688,7 @@ class BookEditor(object):
                          "ms", {"abbrev": abbrev,
                                 "language": language,
                                 "show": "yes" if show else "no"}).append(etree.Element("name"))
+        self.touched = manuscripts.getparent()
 
     def update_manuscript(self, version_title, abbrev, new_abbrev, new_language=None, new_show=None):
         ms = self._book._get("manuscripts/ms", {"abbrev": abbrev}, self._book._get("version", {"title": version_title}))
@@ -423,14 +698,16 @@ class BookEditor(object):
             ms.set("language", new_language)
         if new_show is not None:
             ms.set("show", "yes" if new_show else "no")
+        self.touched = ms.getparent().getparent()
 
     def del_manuscript(self, version_title, abbrev):
         ms = self._book._get("manuscripts/ms", {"abbrev": abbrev}, self._book._get("version", {"title": version_title}))
         # ms = self._get("version", {"title": version_title}).xpath("manuscripts/ms[@abbrev='{}'".format(abbrev))
+        self.touched = ms.getparent().getparent()
         ms.getparent().remove(ms)
 
     def serialize(self, pretty=True):
-        return etree.tostring(self._book,
+        return etree.tostring(self._book._book,
                               xml_declaration=True,
                               pretty_print=pretty,
                               **self._book._docinfo)
@@ -439,6 +716,216 @@ class BookEditor(object):
         BookManager._save(self._book)
 
 
+class VersionInfo(OrderedDict):
+    """
+    Structure information of one <version> (see Book.get_book_info()).
+
+    The sections are computed only when they are accessed for the first time
+    and are memoized afterwards. Operations on the whole dictionary (iteration,
+    comparison, pickling, ...) compute all of the remaining sections first, so
+    the key order is always the same.
+    """
+
+    def __init__(self, sections):
+        """
+        :param sections: list of (key, callable) pairs; each callable returns
+        the value of its section
+        """
+        OrderedDict.__init__(self)
+        self._pending = OrderedDict(sections)
+        self._computed = {}
+        self._lock = threading.RLock()
+
+    def _section(self, key):
+        with self._lock:
+            if key not in self._computed:
+                self._computed[key] = self._pending[key]()
+            return self._computed[key]
+
+    def _load_all(self):
+        with self._lock:
+            if self._pending:
+                sections = [(key, self._section(key)) for key in self._pending]
+                self._pending.clear()
+                self._computed.clear()
+                for key, value in sections:
+                    OrderedDict.__setitem__(self, key, value)
+
+    def __getitem__(self, key):
+        if key in self._pending:
+            return self._section(key)
+        return OrderedDict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __contains__(self, key):
+        return key in self._pending or OrderedDict.__contains__(self, key)
+
+    has_key = __contains__
+
+    def __setitem__(self, key, value, *args, **kwargs):
+        self._load_all()
+        OrderedDict.__setitem__(self, key, value, *args, **kwargs)
+
+    def __delitem__(self, key, *args, **kwargs):
+        self._load_all()
+        OrderedDict.__delitem__(self, key, *args, **kwargs)
+
+    def __iter__(self):
+        self._load_all()
+        return OrderedDict.__iter__(self)
+
+    def __reversed__(self):
+        self._load_all()
+        return OrderedDict.__reversed__(self)
+
+    def __len__(self):
+        self._load_all()
+        return OrderedDict.__len__(self)
+
+    def __eq__(self, other):
+        self._load_all()
+        return OrderedDict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self._load_all()
+        return OrderedDict.__repr__(self)
+
+    def pop(self, key, *default):
+        self._load_all()
+        return OrderedDict.pop(self, key, *default)
+
+    def popitem(self, last=True):
+        self._load_all()
+        return OrderedDict.popitem(self, last)
+
+    def setdefault(self, key, default=None):
+        self._load_all()
+        return OrderedDict.setdefault(self, key, default)
+
+    def clear(self):
+        self._load_all()
+        OrderedDict.clear(self)
+
+    def copy(self):
+        self._load_all()
+        return OrderedDict(self.items())
+
+    def __reduce__(self):
+        # pickled (e.g. into the session) as a plain OrderedDict
+        self._load_all()
+        return OrderedDict, (self.items(),)
+
+
+class _TrieNode(object):
+    __slots__ = ("first", "last", "is_reference", "children")
+
+    def __init__(self):
+        self.first = None  # ordinals of the first and the last reference under the node
+        self.last = None
+        self.is_reference = False
+        self.children = {}
+
+
+class ReferenceTrie(object):
+    """
+    The references of a version, i.e. the div paths of its <div>s without
+    child <div>s in document order, in a trie keyed by the div numbers. The
+    first and the last reference under a div path and whether a reference
+    exists are found in O(depth of the path).
+
+    paths (list): the references as tuples of div numbers
+    references (list): the references joined by the delimiters of the
+        divisions, e.g. u'1:1' (the "reference_list" of Book.get_book_info())
+    """
+
+    def __init__(self, paths, delimiters):
+        """
+        :param paths: the div paths (tuples of unicode div numbers) in document order
+        :param delimiters: the delimiters between the levels of the divisions
+        """
+        self._delimiters = delimiters
+        self._root = _TrieNode()
+        self._ordinals = {}
+        self.paths = []
+        self.references = []
+        for ordinal, path in enumerate(paths):
+            self.paths.append(path)
+            reference = self.format(path)
+            self.references.append(reference)
+            self._ordinals.setdefault(reference, ordinal)
+            node = self._root
+            for div_number in (None, ) + path:
+                if div_number is not None:
+                    node = node.children.setdefault(div_number, _TrieNode())
+                if node.first is None:
+                    node.first = ordinal
+                node.last = ordinal
+            node.is_reference = True
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, reference):
+        """
+        Return True if the reference exists. It's either a formatted reference
+        (e.g. u'1:1') or a div path (e.g. ('1', '1')).
+        """
+        if isinstance(reference, basestring):
+            return reference in self._ordinals
+        node = self._find(reference)
+        return node is not None and node.is_reference
+
+    def _find(self, prefix):
+        node = self._root
+        for div_number in prefix:
+            node = node.children.get(to_unicode(div_number))
+            if node is None:
+                return None
+        return node
+
+    def format(self, path):
+        """
+        Join the div numbers of the path by the delimiters of the divisions.
+        """
+        parts = []
+        for level, div_number in enumerate(path):
+            if level:
+                parts.append(self._delimiters[level - 1] if level <= len(self._delimiters) else u'')
+            parts.append(to_unicode(div_number))
+        return u''.join(parts)
+
+    def span(self, prefix=()):
+        """
+        Return the ordinals (positions in paths) of the first and the last
+        reference under the div path prefix, None if there is none.
+        """
+        node = self._find(prefix)
+        if node is None or node.first is None:
+            return None
+        return node.first, node.last
+
+    def first(self, prefix=()):
+        """
+        Return the div path of the first reference under the div path prefix
+        (the first of the version by default), None if there is none.
+        """
+        span = self.span(prefix)
+        return self.paths[span[0]] if span else None
+
+    def last(self, prefix=()):
+        """
+        Return the div path of the last reference under the div path prefix
+        (the last of the version by default), None if there is none.
+        """
+        span = self.span(prefix)
+        return self.paths[span[1]] if span else None
+
+
 class Book(object):
     """
     Parser and manipulator class for OCP XML files
@@ -468,13 +955,21 @@ class Book(object):
         self._docinfo = XML_DEFAULT_DOCINFO
         self._docinfo.update({i: getattr(tree.docinfo, i) for i in XML_DEFAULT_DOCINFO.keys()})
         # dict with keys "doctype", "encoding", and "standalone"
-        self._structure_info = self._find_book_info()
+        self._structure_info = None  # computed on the first get_book_info() call
+        # key: <version> element, value: dict of lookup tables derived from it
+        self._version_indexes = {}
         self.default_delimiter = '.'
+        # sha1 hex digest of the xml file, set by BookCache
+        self.content_hash = None
 
     def get_book_info(self):
         """
         Returns a dictionary with the keys 'book' and 'version'
 
+        The sections of each version dictionary are computed lazily, on first
+        access, so asking only for e.g. the manuscripts of one version does not
+        process the text of the whole book.
+
         Returns
         ----------
 
@@ -583,6 +1078,8 @@ class Book(object):
                         readings (OrderedDict): ???? appears always empty?
 
         """
+        if self._structure_info is None:
+            self._structure_info = self._find_book_info()
         return self._structure_info
 
     def _getattrs(self, element, attrs):
@@ -616,20 +1113,31 @@ class Book(object):
 
         # Parse version tags
         for version in self._book.xpath('/book/version'):
-            version_dict = OrderedDict()
-            version_dict['attributes'] = self._getattrs(version, ('title', 'author', 'fragment', 'language'))
+            info['version'].append(self._find_version_info(version))
+
+        return info
 
-            divisions = version.xpath('divisions/division')
-            version_dict['organisation_levels'] = len(divisions)
+    def _find_version_info(self, version):
+        """
+        Return a VersionInfo for the given <version> element whose sections
+        are only computed when they are first accessed.
+        """
+        attributes = self._getattrs(version, ('title', 'author', 'fragment', 'language'))
 
-            version_dict['divisions'] = self._find_divisions_info(divisions)
-            version_dict['resources'] = self._find_resources_info(version.xpath('resources'))
-            version_dict['manuscripts'] = self._find_manuscripts_info(version.xpath('manuscripts'))
-            version_dict['reference_list'] = self._make_reference_list(version.xpath('text')[0],
-                                                                version_dict['divisions']['delimiters'])
-            info['version'].append(version_dict)
+        def divisions_info():
+            return self._find_divisions_info(version.xpath('divisions/division'))
 
-        return info
+        def reference_list():
+            return list(self._reference_trie(version).references)
+
+        return VersionInfo([
+            ('attributes', lambda: attributes),
+            ('organisation_levels', lambda: int(version.xpath('count(divisions/division)'))),
+            ('divisions', divisions_info),
+            ('resources', lambda: self._find_resources_info(version.xpath('resources'))),
+            ('manuscripts', lambda: self._find_manuscripts_info(version.xpath('manuscripts'))),
+            ('reference_list', reference_list),
+        ])
 
     def _find_divisions_info(self, divisions):
         """
@@ -743,33 +1251,6 @@ class Book(object):
 
         return data
 
-    def _make_reference_list(self, text, delimiters):
-        """Assemble a flat list of references with the proper delimiters.
-
-
-        Arguments:
-            text - the <text> element from which we are extracting data.
-            delimiters - a list of the delimiters used to seperate a document's
-                         divisions
-
-        """
-        refs = []
-        for div in text.xpath('div'):
-            parent_attributes = [self._getattrs(div, ('number', 'fragment'))]
-            parent_key = unicode(parent_attributes[0]['number'])
-            print 'div {}, level {}'.format(parent_key, len(delimiters))
-
-            if len(div.xpath('div')):
-                child_refs = self._make_reference_list(div, delimiters[1:])
-                print 'child refs are {}'.format(child_refs)
-                mydelimiter = delimiters[0] if len(delimiters) else ''
-                for ref in child_refs:
-                    refs.append('{}{}{}'.format(parent_key, mydelimiter, ref))
-            else:
-                refs.append(parent_key)
-
-        return refs
-
     """
     def text_structure_old(self, text, delimiters):
         # Extract the div structure from a given text tag.
@@ -867,6 +1348,176 @@ class Book(object):
 
         return elements[0]
 
+    def xpath(self, *args, **kwargs):
+        """
+        Evaluate an xpath expression on the <book> root element.
+        """
+        return self._book.xpath(*args, **kwargs)
+
+    def _version_index(self, version):
+        """
+        Return the dictionary of lookup tables built for the given <version>
+        element (e.g. "units": the unit id index).
+        """
+        return self._version_indexes.setdefault(version, {})
+
+    def _unit_index(self, version):
+        """
+        Return a dictionary of the <unit> elements of the given version, where
+        key = unit/@id, value = list of the units with that id (more than one
+        only in invalid documents). It is built on first use and kept up to date
+        by BookEditor.
+        """
+        index = self._version_index(version)
+        if "units" not in index:
+            units = {}
+            for unit in version.iter("unit"):
+                units.setdefault(unit.get("id"), []).append(unit)
+            index["units"] = units
+        return index["units"]
+
+    def _manuscript_index(self, version):
+        """
+        Return a dictionary of the <reading> elements of the given version,
+        where key = manuscript siglum (a whitespace separated token of
+        reading/@mss), value = set of the readings attested by it.
+        """
+        index = self._version_index(version)
+        if "mss" not in index:
+            mss = {}
+            for reading in version.iter("reading"):
+                for ms in reading.get("mss", "").split():
+                    mss.setdefault(ms, set()).add(reading)
+            index["mss"] = mss
+        return index["mss"]
+
+    def _div_table(self, version):
+        """
+        Return the flattened <div> structure of the given version as a
+        dictionary with the keys:
+
+            leaves (list): a LeafDiv for each <div> without child <div>s in
+                document order, holding its div path, its ordinal (position in
+                this list) and the positions of its first and last <unit>
+                within the version
+            spans (dict): key = <div> element, value = (first, last) ordinals
+                of the leaves under (or equal to) that <div>
+            elements (dict): key = div path, value = list of the <div>
+                elements on that path (more than one only in invalid documents)
+            refs (ReferenceTrie): added on first use by _reference_trie()
+        """
+        index = self._version_index(version)
+        if "divs" not in index:
+            leaves = []
+            spans = {}
+            elements = {}
+            div_paths = {}
+            unit_count = 0
+            for div in version.xpath("text")[0].iter("div"):
+                div_path = div_paths.get(div.getparent(), ()) + (_intern(div.get("number")),)
+                div_paths[div] = div_path
+                elements.setdefault(div_path, []).append(div)
+                if div.find("div") is None:
+                    ordinal = len(leaves)
+                    num_of_units = len(div.findall("unit"))
+                    leaves.append(LeafDiv(div_path, ordinal, unit_count,
+                                          unit_count + num_of_units - 1, div))
+                    unit_count += num_of_units
+                    spans[div] = (ordinal, ordinal)
+                    for ancestor in div.iterancestors("div"):
+                        spans[ancestor] = (spans.get(ancestor, (ordinal, ))[0], ordinal)
+            index["divs"] = {"leaves": leaves, "spans": spans, "elements": elements}
+        return index["divs"]
+
+    def _reference_trie(self, version):
+        """
+        Return the ReferenceTrie of the given version, built from (and
+        dropped together with) its div table.
+        """
+        table = self._div_table(version)
+        if "refs" not in table:
+            delimiters = self._find_divisions_info(version.xpath('divisions/division'))['delimiters']
+            table["refs"] = ReferenceTrie([leaf.div_path for leaf in table["leaves"]], delimiters)
+        return table["refs"]
+
+    def get_reference_trie(self, version_title):
+        """
+        Return the ReferenceTrie of the references of the version with the
+        given title.
+        """
+        return self._reference_trie(self._get("version", {"title": version_title}))
+
+    def _export_version_indexes(self):
+        """
+        Return the lookup tables of every version (see _version_index()),
+        building them when needed, in a picklable form: the elements are
+        replaced by their positions among the <unit>, <reading> or <div>
+        elements of the version in document order. _import_version_indexes()
+        puts them back on a Book parsed from the same file.
+        """
+        exported = []
+        for version in self.xpath("version"):
+            units = {unit: i for i, unit in enumerate(version.iter("unit"))}
+            readings = {reading: i for i, reading in enumerate(version.iter("reading"))}
+            divs = {div: i for i, div in enumerate(version.iter("div"))}
+            table = self._div_table(version)
+            refs = self._reference_trie(version)
+            exported.append({
+                "units": {unit_id: [units[unit] for unit in unit_list]
+                          for unit_id, unit_list in self._unit_index(version).iteritems()},
+                "mss": {ms: sorted(readings[reading] for reading in reading_set)
+                        for ms, reading_set in self._manuscript_index(version).iteritems()},
+                "leaves": [leaf._replace(element=divs[leaf.element]) for leaf in table["leaves"]],
+                "spans": {divs[div]: span for div, span in table["spans"].iteritems()},
+                "elements": {div_path: [divs[div] for div in div_list]
+                             for div_path, div_list in table["elements"].iteritems()},
+                "refs": refs})
+        return exported
+
+    def _import_version_indexes(self, exported):
+        """
+        Install the lookup tables returned by _export_version_indexes() of a
+        Book parsed from the same file.
+        """
+        for version, tables in zip(self.xpath("version"), exported):
+            units = list(version.iter("unit"))
+            readings = list(version.iter("reading"))
+            divs = list(version.iter("div"))
+            index = self._version_index(version)
+            index["units"] = {unit_id: [units[i] for i in positions]
+                              for unit_id, positions in tables["units"].iteritems()}
+            index["mss"] = {ms: set(readings[i] for i in positions)
+                            for ms, positions in tables["mss"].iteritems()}
+            index["divs"] = {"leaves": [leaf._replace(element=divs[leaf.element])
+                                        for leaf in tables["leaves"]],
+                             "spans": {divs[i]: span for i, span in tables["spans"].iteritems()},
+                             "elements": {div_path: [divs[i] for i in positions]
+                                          for div_path, positions in tables["elements"].iteritems()},
+                             "refs": tables["refs"]}
+
+    def _drop_version_index(self, version, *names):
+        """
+        Forget the given lookup tables of the version after a change in the
+        document, they are rebuilt on next use.
+        """
+        index = self._version_index(version)
+        for name in names:
+            index.pop(name, None)
+
+    def _get_unit(self, version, unit_id):
+        """
+        Get back the <unit> element of the version with the given id if it
+        exists and is unique.
+        """
+        units = self._unit_index(version).get(to_unicode(unit_id))
+        if not units:
+            raise ElementDoesNotExist("<unit> element with id='{}' does not "
+                                      "exist".format(unit_id))
+        elif len(units) > 1:
+            raise MultipleElementsReturned("There are more <unit> elements "
+                                           "with id='{}'".format(unit_id))
+        return units[0]
+
     def _locate_div_path(self, div_element):
         """
         Create a list of div names (div/@number) to the div_element (list of ancestor divs)
@@ -882,14 +1533,17 @@ class Book(object):
     def _div_path_to_element_path(self, version, div_path):
         div_elements = []
         if div_path:
-            base_element = version.xpath("text")[0]
+            elements = self._div_table(version)["elements"]
+            path = ()
             for div_number in div_path:
-                try:
-                    base_element = self._get("div", {"number": div_number},
-                                             base_element)
-                    div_elements.append(base_element)
-                except ElementDoesNotExist:
+                path += (to_unicode(div_number),)
+                found = elements.get(path)
+                if not found:
                     break  # we keep the last correct element
+                elif len(found) > 1:
+                    raise MultipleElementsReturned("There are more <div> elements "
+                                                   "with number='{}'".format(div_number))
+                div_elements.append(found[0])
         return div_elements
 
     def _locate_next_or_prev(self, startelements, level=0, direction=None):
@@ -912,32 +1566,41 @@ class Book(object):
                 return value from _div_path_to_element_path().
 
         """
-        div_elements = []
-        if level > 0:  # top level refs not changing
-            div_elements.extend(startelements[:level])
+        table = self._div_table(next(startelements[level].iterancestors("version")))
+        leaves = table["leaves"]
+        first, last = table["spans"][startelements[level]]
         if direction == 'next':
-            mynext = startelements[level].getnext()  # increment at right level
+            ordinal = last + 1  # first leaf after the current div at that level
         elif direction == 'prev':
-            mynext = startelements[level].getprevious()  # increment at right level
+            ordinal = first - 1  # last leaf before the current div at that level
 
-        if not mynext:  # already at last entity
+        # top level refs must not change
+        parent_first, parent_last = self._locate_leaves(table, startelements[:level])
+        if not parent_first <= ordinal <= parent_last:
             print 'already at doc end'
             return startelements
-        div_elements.append(mynext)
-        if level < (len(startelements) - 1):  # increment is not at lowest level
-            for n in range(len(startelements) - (level + 1)):
-                try:
-                    mynext = mynext[0]
-                    div_elements.append(mynext)
-                except KeyError:
-                    print 'parser._get_next_div:: no child present'
-                    break
+        if direction == 'prev':
+            sibling = self._locate_leaf_ancestors(leaves[ordinal])[level]
+            ordinal = table["spans"][sibling][0]
 
-        return div_elements
+        # the sibling div at the given level and its first descendants down to
+        # the depth of startelements
+        return self._locate_leaf_ancestors(leaves[ordinal])[:len(startelements)]
+
+    def _locate_leaf_ancestors(self, leaf):
+        """
+        Return the list of <div> elements from the top level down to the leaf.
+        """
+        return list(reversed(list(leaf.element.iterancestors("div")))) + [leaf.element]
 
-    def _locate_div_positions(self, div_elements):
-        return [int(div_element.xpath("count(preceding-sibling::div)") + 1)
-                for div_element in div_elements]
+    def _locate_leaves(self, table, div_elements):
+        """
+        Return the (first, last) ordinals of the leaf divs under the div at the
+        end of div_elements (or under the whole <text> if it is empty).
+        """
+        if div_elements:
+            return table["spans"][div_elements[-1]]
+        return 0, len(table["leaves"]) - 1
 
     def get_text(self, version_title, text_type, start_div, end_div=None,
                  next_level=None, previous_level=None):
@@ -975,11 +1638,89 @@ class Book(object):
 
         """
         vbs = True
+        version = self._get_showable_version(version_title, text_type)
+        leaf_range = self._locate_range(version, start_div, end_div,
+                                        next_level, previous_level)
+        if leaf_range is None:  # there is no <div> in the <text> yet
+            return iter([]), (), ()
+        start_leaf, end_leaf = leaf_range
+        current_div = start_leaf.element
+        new_start_sel = start_leaf.div_path
+        last_div = end_leaf.element
+        new_end_sel = end_leaf.div_path
+        if vbs: print "get_text: getting text_iterator"
+        text_iterator = self._find_readings_for_units(current_div,
+                                                     last_div,
+                                                     text_type,
+                                                     version)
+        if vbs: print "get_text: got text_iterator"
+
+        return text_iterator, new_start_sel, new_end_sel
+
+    def get_synopsis(self, panes, start_div, end_div=None, next_level=None,
+                     previous_level=None):
+        """
+        Get back the same text section for several versions and text types
+
+        The range (see get_text()) is located and walked once per version, so
+        the panes of one version get exactly the same units in the same order:
+        the n-th unit of their Text lists is always the same <unit>.
+
+        Arguments
+        ----------
+
+            panes (list): (version title, text type) pairs
+            start_div, end_div, next_level, previous_level: as for get_text()
+
+        Return
+        -------
+            list: a (list of Text objects, start reference, end reference)
+                triple per pane, in the order of the panes
+
+        """
+        versions = OrderedDict()  # key: version title, value: indexes of panes
+        for index, (version_title, text_type) in enumerate(panes):
+            self._get_showable_version(version_title, text_type)
+            versions.setdefault(version_title, []).append(index)
+
+        synopsis = [None] * len(panes)
+        for version_title, indexes in versions.iteritems():
+            version = self._get("version", {"title": version_title})
+            leaf_range = self._locate_range(version, start_div, end_div,
+                                            next_level, previous_level)
+            if leaf_range is None:  # there is no <div> in the <text> yet
+                for index in indexes:
+                    synopsis[index] = ([], (), ())
+                continue
+            start_leaf, end_leaf = leaf_range
+            texts = [[] for index in indexes]
+            for unit_texts in self._find_unit_readings(start_leaf.element,
+                                                       end_leaf.element,
+                                                       [panes[index][1] for index in indexes],
+                                                       version):
+                for pane_texts, pane_unit_texts in zip(texts, unit_texts):
+                    pane_texts.extend(pane_unit_texts)
+            for index, pane_texts in zip(indexes, texts):
+                synopsis[index] = (pane_texts, start_leaf.div_path, end_leaf.div_path)
+        return synopsis
+
+    def _get_showable_version(self, version_title, text_type):
+        """
+        Return the <version> element, making sure that the text type (<ms>) is
+        defined and may be shown in running form.
+        """
         version = self._get("version", {"title": version_title})
         manuscript = self._get("manuscripts/ms", {"abbrev": text_type}, version)
         if manuscript.get("show") == "no":
             raise NotAllowedManuscript
+        return version
 
+    def _locate_range(self, version, start_div, end_div=None, next_level=None,
+                      previous_level=None):
+        """
+        Return the first and the last LeafDiv of the range selected by the
+        arguments of get_text(), or None when the version has no <div> yet.
+        """
         end_div_elements = self._div_path_to_element_path(version, end_div)
         start_div_elements = self._div_path_to_element_path(version, start_div)
         # handle navigating to next text section
@@ -996,43 +1737,21 @@ class Book(object):
                                                         direction='prev')
             end_div_elements = start_div_elements[:(previous_level + 1)]
 
-        # set the absolutely start div element (at full depth)
-        if start_div_elements:
-            current_element = start_div_elements[-1]
-        else:
-            current_element = version.xpath("text")[0]
-        while current_element.xpath("div"):
-            current_element = current_element.xpath("div[1]")[0]
-            start_div_elements.append(current_element)
-
-        # set the absolutely last div element (at full depth)
-        if end_div_elements:
-            current_element = end_div_elements[-1]
-        else:
-            current_element = version.xpath("text")[0]
-        while current_element.xpath("div"):
-            current_element = current_element.xpath("div[last()]")[0]
-            end_div_elements.append(current_element)
+        # set the absolutely start and last div elements (at full depth)
+        table = self._div_table(version)
+        if not table["leaves"]:
+            return None
+        start_leaf = table["leaves"][self._locate_leaves(table, start_div_elements)[0]]
+        end_leaf = table["leaves"][self._locate_leaves(table, end_div_elements)[1]]
 
         # detect invalid start and end position pair
-        if self._locate_div_positions(start_div_elements) > self._locate_div_positions(end_div_elements):
+        if start_leaf.ordinal > end_leaf.ordinal:
             raise InvalidDIVPath("The start position ({}) is after the end "
                                  "position ({}).".format("/".join(map(str,
                                                                       start_div)),
                                                          "/".join(map(str,
                                                                       end_div))))
-        current_div = start_div_elements[-1]
-        new_start_sel = tuple(self._locate_div_path(current_div))
-        last_div = end_div_elements[-1]
-        new_end_sel = tuple(self._locate_div_path(last_div))
-        if vbs: print "get_text: getting text_iterator"
-        text_iterator = self._find_readings_for_units(current_div,
-                                                     last_div,
-                                                     text_type,
-                                                     version)
-        if vbs: print "get_text: got text_iterator"
-
-        return text_iterator, new_start_sel, new_end_sel
+        return start_leaf, end_leaf
 
     def _find_readings_for_units(self, current_div, last_div, text_type, version):
         """
@@ -1041,8 +1760,8 @@ class Book(object):
         Arguments
         ---------
 
-            current_div (Element):
-            last_div (Element):
+            current_div (Element): the first leaf <div> of the range
+            last_div (Element): the last leaf <div> of the range
             text_type (str):
             version ():
 
@@ -1051,58 +1770,71 @@ class Book(object):
             iterator: yielding a series of Text objects for the selected range
 
         """
-        reading_filter = u"reading[re:test(@mss, '^{0} | {0} | {0}$|^{0}$')]" \
-                          "".format(to_unicode(text_type))
-        while True:
-            for unit in current_div.getchildren():
-                readings_in_unit = len(unit.getchildren())
-                readings = unit.xpath(reading_filter,
-                                      namespaces={"re": "http://exslt.org/regular-expressions"})
-                if readings:
-                    for reading in readings:
-                        ws = []
-                        for w in reading.iter("w"):
-                            ws.append(W(attributes=w.attrib,
-                                        text=w.text if w.text else u""))
-                            ws.append(w.tail if w.tail else u"")
-                        if ws:
-                            ws.insert(0, reading.text if reading.text else "")
-                            text = tuple(ws)
-                        else:
-                            text = reading.text if reading.text else ""
-                        yield Text(tuple(self._locate_div_path(unit.getparent())),
-                                   unit.get("id"),
-                                   version.get("language"),
-                                   readings_in_unit,
-                                   reading.get("linebreak", ""),
-                                   reading.get("indent", ""),
-                                   text)
-                else:
-                    yield Text(tuple(self._locate_div_path(unit.getparent())),
-                               unit.get("id"),
-                               version.get("language"),
-                               readings_in_unit,
-                               "",
-                               "",
-                               None)
-            if current_div == last_div:
-                raise StopIteration
-            else:
-                if current_div.getnext() is None:
-                    # go up while there is no sibling (and the tag is not <text>)
-                    while current_div.getnext() is None and current_div.tag != "text":
-                        current_div = current_div.getparent()
-                    if current_div.tag == "text":
-                        raise StopIteration
-
-                    # go along on the current level
-                    current_div = current_div.getnext()
-
-                    # and go down to the deepest <div>
-                    while current_div.getchildren() and current_div.getchildren()[0].tag == "div":
-                        current_div = current_div.getchildren()[0]
-                else:
-                    current_div = current_div.getnext()
+        for unit_texts in self._find_unit_readings(current_div, last_div, [text_type], version):
+            for text in unit_texts[0]:
+                yield text
+
+    def _find_unit_readings(self, current_div, last_div, text_types, version):
+        """
+        iterate through the units of the supplied <div> range once, searching the
+        readings of several text types
+
+        Return
+        -------
+            iterator: yielding a list per unit, with the list of Text objects
+                of every text type (in the order of text_types)
+
+        """
+        manuscript_index = self._manuscript_index(version)
+        attested = [manuscript_index.get(to_unicode(text_type).strip(), frozenset())
+                    for text_type in text_types]
+        language = _intern(version.get("language"))
+        table = self._div_table(version)
+        for leaf in table["leaves"][table["spans"][current_div][0]:table["spans"][last_div][1] + 1]:
+            # every Text of the leaf div shares the div path tuple of the table
+            div_path = leaf.div_path
+            for unit in leaf.element.getchildren():
+                unit_id = unit.get("id")
+                readings_in_unit = len(unit)
+                unit_readings = list(unit.iterchildren("reading"))
+                unit_texts = []
+                for attested_readings in attested:
+                    readings = [reading for reading in unit_readings
+                                if reading in attested_readings]
+                    if readings:
+                        unit_texts.append([Text(div_path,
+                                                unit_id,
+                                                language,
+                                                readings_in_unit,
+                                                _intern(reading.get("linebreak", "")),
+                                                _intern(reading.get("indent", "")),
+                                                self._reading_text(reading))
+                                           for reading in readings])
+                    else:
+                        unit_texts.append([Text(div_path,
+                                                unit_id,
+                                                language,
+                                                readings_in_unit,
+                                                "",
+                                                "",
+                                                None)])
+                yield unit_texts
+
+    def _reading_text(self, reading):
+        """
+        Return the text of a <reading>: a string, or a tuple of strings and W
+        objects when it has <w> children.
+        """
+        ws = []
+        for w in reading.iter("w"):
+            ws.append(W(attributes=dict((_intern(k), _intern(v))
+                                        for k, v in w.attrib.iteritems()),
+                        text=w.text if w.text else u""))
+            ws.append(w.tail if w.tail else u"")
+        if ws:
+            ws.insert(0, reading.text if reading.text else "")
+            return tuple(ws)
+        return reading.text if reading.text else ""
 
     def get_readings(self, version_title, unit_id):
         """
@@ -1115,11 +1847,11 @@ class Book(object):
         readings = []
         try:
             version = self._get("version", {"title": version_title})
-            unit = self._get(".//unit", {"id": unit_id}, on_element=version)
+            unit = self._get_unit(version, unit_id)
 
             raw_readings = OrderedDict([])
             for reading in unit.iter("reading"):
-                mss = reading.get("mss").strip()
+                mss = _intern(reading.get("mss").strip())
                 raw_readings[mss] = reading.text.strip() if reading.text else u""
             # iterate
             readings = [Reading(ms, text) for ms, text in raw_readings.iteritems()]
@@ -1128,9 +1860,29 @@ class Book(object):
             pass
         return readings
 
+    def iter_units(self, version_title):
+        """
+        Iterate over every <unit> of a version in document order (e.g. for
+        indexing)
+
+        Return
+        -------
+            iterator: yielding (div path, unit id, list of Reading objects)
+                triples; the text of a Reading is as in Text.text (a tuple
+                with W objects when the reading has <w> markup)
+
+        """
+        version = self._get("version", {"title": version_title})
+        for leaf in self._div_table(version)["leaves"]:
+            for unit in leaf.element.iterchildren("unit"):
+                yield (leaf.div_path,
+                       unit.get("id"),
+                       [Reading(_intern(reading.get("mss", "").strip()), self._reading_text(reading))
+                        for reading in unit.iterchildren("reading")])
+
     def get_unit_group(self, version_title, unit_id):
         version = self._get("version", {"title": version_title})
-        unit = version.xpath(".//unit[@id={}]".format(unit_id))
+        unit = self._unit_index(version).get(to_unicode(unit_id), [])
         groups = []
         try:
             groups = map(int, unit[0].get("group", "").split(" "))
@@ -1154,6 +1906,722 @@ class Book(object):
         return group
 
 
+def _file_hash(f):
+    """
+    Return the sha1 hex digest of the whole content of an open file.
+    """
+    f.seek(0)
+    digest = hashlib.sha1()
+    for block in iter(lambda: f.read(1024 * 1024), ""):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+class BookCache(object):
+    """
+    Thread-safe, process-wide cache of parsed Book objects.
+
+    Books are keyed by the absolute path of their xml file and a cached Book
+    is reused only while the file's mtime and size are unchanged. When the
+    combined size of the cached xml files exceeds max_size the least recently
+    used books are evicted.
+
+    The cached Book objects are shared between requests, so they must be
+    treated as read-only. Editing has to work on a freshly parsed Book.
+    Their content_hash is the sha1 of the xml file they were parsed from.
+    """
+
+    def __init__(self, max_size=BOOK_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self._books = OrderedDict()  # key: path, value: ((mtime, size), Book)
+        self._size = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path):
+        """
+        Return the parsed Book for the given xml file, parsing it only when
+        it is not cached yet or the file has changed since it was cached.
+
+        :param path: path of the xml file
+        :return: Book object
+        """
+        key = os.path.abspath(path)
+        with open(path, "r") as xml_file:
+            stat = os.fstat(xml_file.fileno())
+            stamp = (stat.st_mtime, stat.st_size)
+            with self._lock:
+                entry = self._books.pop(key, None)
+                if entry is not None:
+                    if entry[0] == stamp:
+                        self._books[key] = entry  # move to most recently used
+                        self.hits += 1
+                        return entry[1]
+                    self._size -= entry[0][1]
+                self.misses += 1
+            # parse outside of the lock so other books can be served meanwhile
+            book = Book(xml_file)
+            book.content_hash = _file_hash(xml_file)
+        self._add(key, stamp, book)
+        return book
+
+    def _add(self, path, stamp, book):
+        with self._lock:
+            old_entry = self._books.pop(path, None)
+            if old_entry is not None:
+                self._size -= old_entry[0][1]
+            self._books[path] = (stamp, book)
+            self._size += stamp[1]
+            while self._size > self.max_size and len(self._books) > 1:
+                evicted_stamp, evicted_book = self._books.popitem(last=False)[1]
+                self._size -= evicted_stamp[1]
+                self.evictions += 1
+
+    def warm_up(self, paths, processes=None):
+        """
+        Parse the given xml files and compute their complete book info and
+        lookup tables in parallel on a process pool, then put the books into
+        the cache.
+
+        The lxml trees can't be passed between processes, so the workers
+        return the book info, the content hash and the lookup tables with the
+        elements replaced by their positions (see
+        Book._export_version_indexes()). Here each book is parsed again and
+        the positions are resolved in one pass over its elements.
+
+        The pool forks the calling process, so call it before the process
+        starts other threads (see warm_up_corpus()).
+
+        :param paths: paths of the xml files
+        :param processes: size of the process pool (default: number of cpus)
+        :return: OrderedDict, key: path, value: dictionary with the keys
+        "seconds" (build time of the book) and "error" (None or error message)
+        """
+        pool = multiprocessing.Pool(processes)
+        try:
+            built = pool.map(_build_book, paths)
+        finally:
+            pool.close()
+            pool.join()
+
+        report = OrderedDict()
+        for path, stamp, content_hash, info, indexes, seconds, error in built:
+            if error is None:
+                start = time.time()
+                with open(path, "r") as xml_file:
+                    stat = os.fstat(xml_file.fileno())
+                    # skip files changed since the worker read them
+                    if (stat.st_mtime, stat.st_size) == stamp:
+                        book = Book(xml_file)
+                        book.content_hash = content_hash
+                        book._structure_info = info
+                        book._import_version_indexes(indexes)
+                        self._add(os.path.abspath(path), stamp, book)
+                seconds += time.time() - start
+            report[path] = {"seconds": seconds, "error": error}
+        return report
+
+    def invalidate(self, path=None):
+        """
+        Drop the given xml file from the cache or, without path, every book.
+        """
+        with self._lock:
+            if path is None:
+                self._books.clear()
+                self._size = 0
+            else:
+                entry = self._books.pop(os.path.abspath(path), None)
+                if entry is not None:
+                    self._size -= entry[0][1]
+
+    def stats(self):
+        """
+        Return a dictionary with the counters and the current size of the cache.
+        """
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "books": len(self._books),
+                    "size": self._size,
+                    "max_size": self.max_size}
+
+
+def _build_book(path):
+    """
+    Parse an xml file and compute its complete book info and lookup tables.
+    This runs in the worker processes of BookCache.warm_up(), so it has to be
+    a module-level function and its return value has to be picklable.
+
+    :return: tuple of path, (mtime, size) of the file, content hash, book
+    info, lookup tables (see Book._export_version_indexes()), build time in
+    seconds and error message (None on success)
+    """
+    start = time.time()
+    try:
+        with open(path, "r") as xml_file:
+            stat = os.fstat(xml_file.fileno())
+            book = Book(xml_file)
+            content_hash = _file_hash(xml_file)
+        info = book.get_book_info()
+        info = dict(info, version=[version.copy() for version in info["version"]])
+        return (path, (stat.st_mtime, stat.st_size), content_hash, info,
+                book._export_version_indexes(), time.time() - start, None)
+    except Exception as e:
+        return path, None, None, None, None, time.time() - start, "{}: {}".format(type(e).__name__, e)
+
+
+BOOK_CACHE = BookCache()
+
+_warm_up_lock = threading.Lock()
+_warmed_up_paths = set()
+
+
+def warm_up_corpus(storage_path=XML_FILE_STORAGE_PATH, processes=None):
+    """
+    Load every book of the given folder into BOOK_CACHE (see
+    BookCache.warm_up()) and print the build time per book and in total.
+
+    This is done only once per process and folder. The app's routes.py
+    calls it when web2py starts, before the server accepts requests and
+    starts its threads (the warm-up forks a process pool).
+
+    :return: the report of BookCache.warm_up() or None if already done
+    """
+    with _warm_up_lock:
+        if storage_path in _warmed_up_paths:
+            return None
+        start = time.time()
+        report = BOOK_CACHE.warm_up(sorted(glob.glob(os.path.join(storage_path, "*.xml"))),
+                                    processes)
+        _warmed_up_paths.add(storage_path)
+    for path, result in report.items():
+        print 'warm-up {}: {:.3f} s{}'.format(os.path.basename(path), result["seconds"],
+                                              " ({})".format(result["error"]) if result["error"] else "")
+    print 'warm-up of {} books took {:.3f} s'.format(len(report), time.time() - start)
+    return report
+
+
+def _validate_file(args):
+    """
+    Parse an xml file and validate it with BookValidator. This runs in the
+    worker processes of validate_corpus(), so it has to be a module-level
+    function and its return value has to be picklable.
+
+    :param args: tuple of the path of the xml file and the path of the DTD
+    :return: tuple of path, list of error messages, parse time and
+    validation time in seconds and the message of the error that stopped the
+    parsing or the validation (None on success)
+    """
+    path, dtd_path = args
+    start = time.time()
+    parsed = None
+    try:
+        with open(path, "r") as xml_file:
+            book = Book(xml_file)
+        parsed = time.time()
+        validator = BookValidator()
+        validator.validate(dtd_path, book)
+        errors = [to_unicode(error) if isinstance(error, str) else unicode(error)
+                  for error in validator.validation_errors]
+        return path, errors, parsed - start, time.time() - parsed, None
+    except Exception as e:
+        if parsed is None:
+            parsed = time.time()
+        return path, [], parsed - start, time.time() - parsed, \
+            u"{}: {}".format(type(e).__name__, to_unicode(str(e)))
+
+
+def validate_corpus(paths, dtd_path=XML_DTD_FILE_PATH, processes=None):
+    """
+    Validate the given xml files by DTD and semantically, in parallel on a
+    process pool.
+
+    :param paths: paths of the xml files
+    :param dtd_path: path of the DTD file
+    :param processes: size of the process pool (default: number of cpus)
+    :return: OrderedDict, key: path, value: dictionary with the keys "valid"
+    (boolean), "errors" (list of error messages), "parse_seconds",
+    "validate_seconds" and "error" (None or the message of the error that
+    stopped the parsing or the validation)
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_validate_file, [(path, dtd_path) for path in paths])
+    finally:
+        pool.close()
+        pool.join()
+    report = OrderedDict()
+    for path, errors, parse_seconds, validate_seconds, error in results:
+        report[path] = {"valid": error is None and not errors,
+                        "errors": errors,
+                        "parse_seconds": parse_seconds,
+                        "validate_seconds": validate_seconds,
+                        "error": error}
+    return report
+
+
+class _BookLock(object):
+    """
+    Exclusive flock on a lock file, reentrant within a thread (see book_lock())
+    """
+
+    _held = threading.local()  # attribute "depths": dict, key: lock file path, value: depth
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        depths = self._held.__dict__.setdefault("depths", {})
+        if depths.get(self.path):
+            depths[self.path] += 1
+            return self
+        self._file = open(self.path, "a")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        depths[self.path] = 1
+        return self
+
+    def __exit__(self, *exc_info):
+        depths = self._held.depths
+        depths[self.path] -= 1
+        if not depths[self.path]:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+
+
+def book_lock(book_name, folder=None):
+    """
+    Return a context manager holding the exclusive lock of a draft book.
+
+    The lock is taken on <book>.lock in the drafts backup folder, so it works
+    across threads and web2py worker processes, while different books can be
+    edited in parallel.
+    """
+    if folder is None:
+        folder = BookManager.xml_draft_file_backup_storage_path
+    return _BookLock(os.path.join(folder, "{}.lock".format(book_name)))
+
+
+class DraftJournal(object):
+    """
+    Append-only history of the edits of one draft book.
+
+    Every BookEditor operation applied in a DraftSession is appended to the
+    journal file as one json line with a sequence number, a timestamp, the
+    editor, the name of the operation and its arguments. The sequence number
+    of the last operation is the revision of the draft. The whole book is
+    stored only in the snapshots, which are written for the state
+    before the first recorded operation and then every snapshot_interval
+    operations when the draft is saved. Any recorded state of the draft can
+    be rebuilt from the nearest snapshot before it and the operations after
+    that snapshot; compact() drops the history that is no longer needed. It
+    runs whenever BookManager._save() writes a snapshot, dropping the history
+    older than retention.
+
+    The journal file <book>.journal and the revision of the saved draft
+    (<book>.rev) are kept in the drafts backup folder, the snapshots are kept
+    in the BackupStore of that folder under the name <book>.journal (apart
+    from the other backups of the book), with the sequence number as backup
+    id. Writing to the journal needs the book_lock() of the book.
+    """
+
+    snapshot_interval = DRAFT_JOURNAL_SNAPSHOT_INTERVAL
+    retention = timedelta(days=DRAFT_JOURNAL_RETENTION_DAYS)
+    TIME_FORMAT = "%Y%m%d_%H%M%S_%f"
+
+    max_open = DRAFT_JOURNAL_MAX_OPEN
+    _journals = OrderedDict()  # key: (folder, book name), value: DraftJournal
+    _journals_lock = threading.Lock()
+
+    def __init__(self, book_name, folder):
+        self.book_name = book_name
+        self.folder = folder
+        self.path = os.path.join(folder, "{}.journal".format(book_name))
+        self.store = BackupStore(folder)
+        self.snapshot_name = "{}.journal".format(book_name)
+        self._lock = threading.RLock()
+        self._position = None  # end of the journal file read so far
+        self.last_seq = 0
+        self.last_snapshot_seq = None
+        self.refresh()
+
+    @classmethod
+    def open(cls, book_name):
+        """
+        Return the journal of the given book in the current drafts backup
+        folder (see BookManager). The max_open most recently used journals
+        are kept; a journal holds no state that isn't in its files, so an
+        evicted one is simply opened again.
+        """
+        key = (BookManager.xml_draft_file_backup_storage_path, book_name)
+        with cls._journals_lock:
+            journal = cls._journals.pop(key, None)
+            if journal is None:
+                journal = cls(book_name, key[0])
+            cls._journals[key] = journal  # move to most recently used
+            while len(cls._journals) > cls.max_open:
+                cls._journals.popitem(last=False)
+            return journal
+
+    def snapshots(self):
+        """
+        Return the sequence numbers of the snapshots in ascending order.
+        """
+        return [int(backup_id) for backup_id in self.store.backups(self.snapshot_name)
+                if backup_id.isdigit()]
+
+    def entries_after(self, seq, position=None):
+        """
+        Return the operations recorded after the given sequence number as a
+        list of dictionaries with the keys "seq", "time", "editor", "op" and
+        "args", plus the position of the end of the journal file. Passing
+        that position to the next call makes it read the new lines only.
+        """
+        if not os.path.isfile(self.path):
+            return [], None
+        entries = []
+        with open(self.path, "r") as journal_file:
+            inode = os.fstat(journal_file.fileno()).st_ino
+            # compact() replaces the file, then the old position is useless
+            offset = position[1] if position and position[0] == inode else 0
+            journal_file.seek(offset)
+            for line in iter(journal_file.readline, ""):
+                if not line.endswith("\n"):
+                    break  # cut short by a crash
+                offset += len(line)
+                entry = json.loads(line)
+                if entry["seq"] > seq:
+                    entries.append(entry)
+        return entries, (inode, offset)
+
+    def entries(self):
+        """
+        Return all recorded operations (see entries_after()).
+        """
+        return self.entries_after(0)[0]
+
+    def refresh(self):
+        """
+        Catch up with the operations and snapshots written by other processes.
+        """
+        with self._lock:
+            entries, self._position = self.entries_after(self.last_seq, self._position)
+            snapshots = self.snapshots()
+            self.last_snapshot_seq = snapshots[-1] if snapshots else None
+            # the operations before a snapshot may have been compacted away
+            self.last_seq = max([self.last_seq] + [e["seq"] for e in entries[-1:]] + snapshots[-1:])
+
+    def record(self, editor, operation, args):
+        """
+        Append an operation to the journal.
+
+        :return: the sequence number of the operation
+        """
+        with self._lock:
+            self.refresh()
+            self.last_seq += 1
+            entry = {"seq": self.last_seq,
+                     "time": datetime.now().strftime(self.TIME_FORMAT),
+                     "editor": editor,
+                     "op": operation,
+                     "args": args}
+            with open(self.path, "a") as journal_file:
+                journal_file.write(json.dumps(entry, sort_keys=True) + "\n")
+            return self.last_seq
+
+    def snapshot(self, xml, seq=None):
+        """
+        Store the serialized book as the state after the given operation
+        (default: the last recorded one).
+        """
+        with self._lock:
+            if seq is None:
+                seq = self.last_seq
+            self.store.backup(self.snapshot_name, xml, "{:08d}".format(seq))
+            self.last_snapshot_seq = max(seq, self.last_snapshot_seq)
+
+    def reset(self, xml, editor=None):
+        """
+        Record that the draft was replaced with the given serialized book.
+
+        :return: the sequence number of the new revision
+        """
+        with self._lock:
+            seq = self.record(editor, "reset", [])
+            self.snapshot(xml, seq)
+            return seq
+
+    def needs_snapshot(self):
+        """
+        Return True when there is no snapshot yet or snapshot_interval
+        operations were recorded since the last one.
+        """
+        return self.last_snapshot_seq is None or \
+            self.last_seq - self.last_snapshot_seq >= self.snapshot_interval
+
+    def saved_revision(self):
+        """
+        Return the revision of the draft file or None if it's unknown.
+        """
+        try:
+            with open(os.path.join(self.folder, "{}.rev".format(self.book_name)), "r") as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def set_saved_revision(self, revision):
+        write_file(os.path.join(self.folder, "{}.rev".format(self.book_name)), str(revision))
+
+    def _target_seq(self, entries, seq=None, until=None):
+        target = self.last_seq if seq is None else min(int(seq), self.last_seq)
+        if until is not None:
+            until = until.strftime(self.TIME_FORMAT)
+            target = max([0] + [e["seq"] for e in entries
+                                if e["seq"] <= target and e["time"] <= until])
+        return target
+
+    def reconstruct(self, seq=None, until=None):
+        """
+        Rebuild the draft as it was after the given operation or at the given
+        time (default: after the last recorded operation).
+
+        :param seq: sequence number of the last operation to apply
+        :param until: datetime, apply the operations recorded until then
+        :return: Book object
+        """
+        with self._lock:
+            self.refresh()
+            entries = self.entries()
+            target = self._target_seq(entries, seq, until)
+            snapshots = [s for s in self.snapshots() if s <= target]
+            if not snapshots:
+                raise RevisionDoesNotExist("The history of {} before operation {} is not "
+                                           "available".format(self.book_name, target))
+            book = Book(StringIO(self.store.restore(self.snapshot_name, "{:08d}".format(snapshots[-1]))))
+        editor = BookEditor(book)
+        for entry in entries:
+            if snapshots[-1] < entry["seq"] <= target:
+                getattr(editor, entry["op"])(*entry["args"])
+        return book
+
+    def catch_up(self, book, revision, position=None):
+        """
+        Bring a book at the given revision up to the last operation read by
+        refresh().
+
+        :param book: Book object, the operations are applied to it in place
+        :param revision: the revision of the book
+        :param position: see entries_after()
+        :return: the Book (a rebuilt one when the operations in between were
+        compacted away or the draft was replaced), its revision and the
+        position for the next call
+        """
+        entries, position = self.entries_after(revision, position)
+        if not entries:
+            if revision < self.last_seq:
+                # compacted up to a snapshot
+                return self.reconstruct(self.last_seq), self.last_seq, position
+            return book, revision, position
+        if entries[0]["seq"] != revision + 1 or \
+                any(entry["op"] == "reset" for entry in entries):
+            book = self.reconstruct(entries[-1]["seq"])
+        else:
+            editor = BookEditor(book)
+            for entry in entries:
+                getattr(editor, entry["op"])(*entry["args"])
+            book._structure_info = None
+        return book, entries[-1]["seq"], position
+
+    def compact(self, seq=None, until=None):
+        """
+        Drop the history before the given operation or time (default: before
+        the last snapshot). The states from the nearest snapshot before that
+        point on can still be reconstructed.
+
+        :return: the number of dropped operations and snapshots
+        """
+        with self._lock, book_lock(self.book_name, self.folder):
+            self.refresh()
+            entries = self.entries()
+            target = self._target_seq(entries, seq, until)
+            snapshots = self.snapshots()
+            kept = [s for s in snapshots if s <= target][-1:]
+            if not kept:
+                return 0
+            dropped_snapshots = [s for s in snapshots if s < kept[0]]
+            kept_entries = [e for e in entries if e["seq"] > kept[0]]
+            if not dropped_snapshots and len(kept_entries) == len(entries):
+                return 0
+            write_file(self.path, "".join(json.dumps(entry, sort_keys=True) + "\n"
+                                          for entry in kept_entries))
+            for seq in dropped_snapshots:
+                self.store.delete(self.snapshot_name, "{:08d}".format(seq))
+            if dropped_snapshots:
+                self.store.collect_garbage()
+            return len(entries) - len(kept_entries) + len(dropped_snapshots)
+
+
+class DraftSession(object):
+    """
+    An editing session on one draft book.
+
+    The session keeps the parsed draft Book in memory between requests and
+    applies the BookEditor operations to it in place. The changes are written
+    to the draft folder (see BookManager._save()) flush_delay seconds after
+    the first unsaved change or on an explicit save(), so a burst of edits
+    costs one parse and a few writes.
+
+    Every operation is applied under the book_lock() of the book and recorded
+    in its DraftJournal. Before that, the operations recorded meanwhile by
+    other sessions (e.g. in other web2py processes) are applied to the book in
+    memory, so the session is always at the latest revision of the draft. An
+    edit based on an older revision is rejected with StaleRevision.
+
+    The sessions are kept in a process-wide registry keyed by book name, so
+    within a process all editors of a book share its session; the editor of
+    every operation is recorded in the journal.
+    """
+
+    flush_delay = DRAFT_SESSION_FLUSH_DELAY
+
+    _sessions = {}  # key: book name, value: DraftSession
+    _sessions_lock = threading.Lock()
+
+    def __init__(self, book_name, flush_delay=None):
+        self.book_name = book_name
+        if flush_delay is not None:
+            self.flush_delay = flush_delay
+        self.path = os.path.join(BookManager.xml_draft_file_storage_path, "{}.xml".format(book_name))
+        self._lock = threading.RLock()
+        self._timer = None
+        self.pending = 0  # number of unsaved operations
+        self.saves = 0
+        with book_lock(book_name):
+            self._load()
+
+    def _load(self):
+        journal = DraftJournal.open(self.book_name)
+        with open(self.path, "r") as xml_file:
+            self.book = Book(xml_file)
+        journal.refresh()
+        saved_revision = journal.saved_revision()
+        self.revision = journal.last_seq if saved_revision is None else saved_revision
+        self._position = None  # end of the journal file read so far
+        self._catch_up(journal)
+
+    def _catch_up(self, journal):
+        """
+        Apply the operations recorded by others since the revision of the
+        book in memory.
+        """
+        self.book, self.revision, self._position = \
+            journal.catch_up(self.book, self.revision, self._position)
+
+    @classmethod
+    def open(cls, book_name):
+        """
+        Return the session on the given book, creating it when needed.
+        """
+        with cls._sessions_lock:
+            session = cls._sessions.get(book_name)
+        if session is None:
+            session = cls(book_name)
+            with cls._sessions_lock:
+                session = cls._sessions.setdefault(book_name, session)
+        return session
+
+    @classmethod
+    def sessions(cls, book_name=None):
+        """
+        Return the open sessions (of the given book).
+        """
+        with cls._sessions_lock:
+            return [s for key, s in cls._sessions.items()
+                    if book_name is None or key == book_name]
+
+    @classmethod
+    def save_all(cls, book_name=None):
+        """
+        Write the unsaved changes of the open sessions (of the given book).
+        """
+        for session in cls.sessions(book_name):
+            session.save()
+
+    @classmethod
+    def close_all(cls, book_name=None):
+        """
+        Save and close the open sessions (of the given book).
+        """
+        for session in cls.sessions(book_name):
+            session.close()
+
+    def apply(self, operation, *args, **kwargs):
+        """
+        Apply the given BookEditor method to the book in memory and schedule
+        saving it.
+
+        :param operation: name of a BookEditor method
+        :param editor: (keyword only) the editor recorded in the journal, e.g.
+        the user id
+        :param revision: (keyword only) the revision of the draft the edit is
+        based on, None for the latest one
+        :return: the return value of the method
+        """
+        revision = kwargs.get("revision")
+        with self._lock, book_lock(self.book_name):
+            journal = DraftJournal.open(self.book_name)
+            journal.refresh()
+            self._catch_up(journal)
+            if revision is not None and int(revision) != self.revision:
+                raise StaleRevision("{} is at revision {}, the edit is based on revision "
+                                    "{}".format(self.book_name, self.revision, revision))
+            book_editor = BookEditor(self.book)
+            if journal.last_snapshot_seq is None:
+                journal.snapshot(book_editor.serialize(), self.revision)
+            if journal.saved_revision() is None:
+                # the draft file is at this revision until it's saved
+                journal.set_saved_revision(self.revision)
+            result = getattr(book_editor, operation)(*args)
+            self.revision = journal.record(kwargs.get("editor"), operation, args)
+            # the book info is recomputed on the next get_book_info() call
+            self.book._structure_info = None
+            self.pending += 1
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_delay, self.save)
+                self._timer.daemon = True
+                self._timer.start()
+            return result
+
+    def save(self):
+        """
+        Write the unsaved changes to the draft folder.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self.pending:
+                BookManager._save(self.book, self.revision)
+                self.pending = 0
+                self.saves += 1
+
+    def close(self):
+        """
+        Save the changes and remove the session from the registry.
+        """
+        with self._sessions_lock:
+            if self._sessions.get(self.book_name) is self:
+                del self._sessions[self.book_name]
+        self.save()
+
+
+# don't lose the changes not written yet when the server stops
+atexit.register(DraftSession.save_all)
+
+
 class BookManager(object):
     """
     Facade class for Books, it can
@@ -1166,36 +2634,185 @@ class BookManager(object):
     xml_draft_file_storage_path = XML_DRAFT_FILE_STORAGE_PATH
     xml_draft_file_backup_storage_path = XML_DRAFT_FILE_BACKUP_STORAGE_PATH
 
+    # the batch methods process different books concurrently on this many threads
+    max_threads = BOOK_MANAGER_MAX_THREADS
+    _pool = None
+    _thread_pool_lock = threading.Lock()
+
     @staticmethod
     def _load(book_name):
         """
-        Load the given book from the draft folder
+        Load the given book from the draft folder through the shared book cache.
+        The returned Book is shared, so it must not be modified.
+        The unsaved changes of the draft sessions on the book are saved first,
+        also those journaled by other processes (see _catch_up_draft()); the
+        book_lock() is taken only when the journal is ahead of the saved draft.
+
+        :param book_name: the name of the book
+        :return: Book object
+        """
+        path = "{}/{}.xml".format(BookManager.xml_draft_file_storage_path, book_name)
+        if os.path.isfile(path):
+            DraftSession.save_all(book_name)
+            journal = DraftJournal.open(book_name)
+            journal.refresh()
+            saved_revision = journal.saved_revision()
+            if saved_revision is not None and saved_revision < journal.last_seq:
+                with book_lock(book_name):
+                    BookManager._catch_up_draft(book_name)
+        return BOOK_CACHE.get(path)
+
+    @staticmethod
+    def _catch_up_draft(book_name):
+        """
+        Write the operations recorded in the journal of the given book but not
+        saved to its draft file yet, e.g. the pending edits of a draft session
+        in another process. Call it under the book_lock() of the book.
+
+        :param book_name: the name of the book
+        """
+        journal = DraftJournal.open(book_name)
+        journal.refresh()
+        saved_revision = journal.saved_revision()
+        if saved_revision is None or saved_revision >= journal.last_seq:
+            return
+        with BookManager._open(book_name) as xml_file:
+            book = Book(xml_file)
+        book, revision, _ = journal.catch_up(book, saved_revision)
+        BookManager._save(book, revision)
+
+    @staticmethod
+    def _open(book_name):
+        """
+        Open the xml file of the given book in the draft folder (for editing)
 
         :param book_name: the name of the book
         :return: file-like object
         """
-        # TODO: add loading from cache option
         return open(("{}/{}.xml".format(BookManager.xml_draft_file_storage_path, book_name)), "r")
 
     @staticmethod
-    def _save(book_object):
+    def _edit(book_name, editor, revision, operation, *args):
+        """
+        Apply a BookEditor operation to the book in its draft session (see
+        DraftSession).
+
+        :param book_name: the name of the book
+        :param editor: the editor recorded in the journal, e.g. the user id
+        :param revision: the revision of the draft the edit is based on, None
+        for the latest one
+        :param operation: name of a BookEditor method
+        :return: the return value of the operation
+        """
+        return DraftSession.open(book_name).apply(operation, *args, editor=editor, revision=revision)
+
+    @staticmethod
+    def get_revision(book_name):
+        """
+        Return the current revision of the draft of the given book; pass it
+        to the editing methods to have an edit rejected with StaleRevision
+        when someone else changed the draft meanwhile.
+        """
+        journal = DraftJournal.open(book_name)
+        with book_lock(book_name):
+            journal.refresh()
+            return journal.last_seq
+
+    @staticmethod
+    def _thread_pool():
+        """
+        Return the process-wide thread pool used by the batch methods; it is
+        created on first use (so after any worker fork).
+        """
+        with BookManager._thread_pool_lock:
+            if BookManager._pool is None:
+                BookManager._pool = ThreadPool(BookManager.max_threads)
+            return BookManager._pool
+
+    @staticmethod
+    def _map_by_book(descriptions, process, expected_errors):
+        """
+        Call process(book, description) for every description of a batch call.
+
+        The descriptions are grouped by their "book" key, so every book is
+        loaded only once, and the groups of different books are processed
+        concurrently on a bounded thread pool.
+
+        :param descriptions: list of dictionaries, each with a "book" key
+        :param process: callable returning the list of result items for one
+        description
+        :param expected_errors: tuple of exception types reported as errors;
+        any other exception is raised
+        :return: list of (result items, exception) pairs in the order of the
+        descriptions, exception is None on success
+        """
+        groups = OrderedDict()  # key: book name, value: indexes of descriptions
+        for index, description in enumerate(descriptions):
+            groups.setdefault(description.get("book"), []).append(index)
+        outcomes = [None] * len(descriptions)
+
+        def process_group(group):
+            book_name, indexes = group
+            try:
+                book = BookManager._load(book_name)
+            except expected_errors as e:
+                for index in indexes:
+                    outcomes[index] = ([], e)
+                return
+            for index in indexes:
+                try:
+                    outcomes[index] = (process(book, descriptions[index]), None)
+                except expected_errors as e:
+                    outcomes[index] = ([], e)
+
+        if len(groups) > 1:
+            BookManager._thread_pool().map(process_group, groups.items())
+        else:
+            map(process_group, groups.items())
+        return outcomes
+
+    @staticmethod
+    def _collect(outcomes, error_message=str):
         """
-        Save the given book to the draft folder with backup
+        Build the {"result": ..., "error": ...} dictionary of a batch call from
+        the outcomes of _map_by_book()
+        """
+        items = []
+        errors = []
+        for book_items, error in outcomes:
+            items += book_items
+            errors.append(None if error is None else error_message(error))
+        return {"result": items, "error": errors}
+
+    @staticmethod
+    def _save(book_object, revision=None):
+        """
+        Save the given book to the draft folder. The file is replaced
+        atomically under the book_lock(). The history of the draft is kept in
+        its DraftJournal, which gets a snapshot of the book when it's due.
 
         :param book_object: a Book instance
+        :param revision: the revision of the book (see DraftSession); it's not
+        saved when a newer revision is saved already
         """
         # TODO: add saving into cache option
         book_name = book_object.get_filename()
         new_file_path = os.path.join(BookManager.xml_draft_file_storage_path, "{}.xml".format(book_name))
-        if os.path.isfile(new_file_path):
-            backup_file_path = os.path.join(BookManager.xml_draft_file_backup_storage_path,
-                                            "{}_{}.xml".format(
-                                                book_name,
-                                                datetime.now().strftime("%Y%m%d_%H%M%S_%f")))
-            os.rename(new_file_path, backup_file_path)
-        f = open(new_file_path, "w")
-        f.write(book_object.serialize())
-        f.close()
+        journal = DraftJournal.open(book_name)
+        with book_lock(book_name):
+            saved_revision = journal.saved_revision()
+            if revision is not None and saved_revision is not None and saved_revision >= revision:
+                return  # the same or a newer revision was saved meanwhile
+            xml = BookEditor(book_object).serialize()
+            write_file(new_file_path, xml)
+            BOOK_CACHE.invalidate(new_file_path)
+            if revision is None:
+                # not an edit of a draft session, the draft is replaced
+                revision = journal.reset(xml)
+            journal.set_saved_revision(revision)
+            if journal.needs_snapshot():
+                journal.snapshot(xml, revision)
+                journal.compact(until=datetime.now() - journal.retention)
 
     @staticmethod
     def get_text(text_positions, as_gluon=True):
@@ -1226,80 +2843,75 @@ class BookManager(object):
                     text_positions has))
 
         """
-        items = []
-        errors = []
-        for text_position in text_positions:
-            try:
-                book = Book.open(BookManager._load(text_position.get("book")))
-                book_items = []
-                last_div_path = []
-                for item in book.get_text(text_position.get("version", ""),
-                                          text_position.get("text_type", ""),
-                                          text_position.get("start"),
-                                          text_position.get("end")):
-                    print 'in BookManager.get_text(): item is'
-                    print item
-                    if as_gluon:
-                        if item.div_path != last_div_path:
-                            same_level = 0
-                            for idp, ldp in zip(item.div_path, last_div_path):
-                                if idp == ldp:
-                                    same_level += 1
-                                else:
-                                    break
-                            level_countdown = len(item.div_path) - same_level
-                            for div_path_item in item.div_path[same_level:-1]:
-                                book_items.append(SPAN(div_path_item,
-                                                       _id=div_path_item,
-                                                       _class="level-{}".format(level_countdown)))
-                                book_items.append(SPAN(".",
-                                                       _id="delimiter-{}-{}".format(level_countdown, div_path_item),
-                                                       _class="delimiter-{}".format(level_countdown)))
-                                level_countdown -= 1
-                            div_path_item = item.div_path[-1]
+        def process(book, description):
+            book_items = []
+            last_div_path = []
+            text = book.get_text(description.get("version", ""),
+                                 description.get("text_type", ""),
+                                 description.get("start"),
+                                 description.get("end"))
+            # wrapped into gluon objects item by item, otherwise returned as
+            # the (text iterator, start div path, end div path) triple
+            for item in text[0] if as_gluon else text:
+                if as_gluon:
+                    if item.div_path != last_div_path:
+                        same_level = 0
+                        for idp, ldp in zip(item.div_path, last_div_path):
+                            if idp == ldp:
+                                same_level += 1
+                            else:
+                                break
+                        level_countdown = len(item.div_path) - same_level
+                        for div_path_item in item.div_path[same_level:-1]:
                             book_items.append(SPAN(div_path_item,
                                                    _id=div_path_item,
                                                    _class="level-{}".format(level_countdown)))
-                            last_div_path = item.div_path
-
-                        # processing text
-                        if isinstance(item.text, tuple):
-                            item_text = []
-                            for w in item.text:
-                                if isinstance(w, basestring):
-                                    item_text.append(w)
-                                else:
-                                    w_class = " ".join("{}_{}".format(k, v) for k, v in w.attributes.items())
-                                    w_class = ("w {}".format(w_class)).strip()
-                                    item_text.append(SPAN(w.text, _class=w_class))
-                            # item_text = SPAN(*item_text)
-                        else:
-                            item_text = [item.text if item.text else u"†" if item.text is None else u"*"]
-                        # add extra style elements
-                        class_extra = ("{} {}".format("linebreak_{}".format(item.linebreak) if item.linebreak else "",
-                                                      "indent" if item.indent.upper() == "YES" else "")).strip()
-                        book_items.append(SPAN(A(item_text, _href=str(item.unit_id))
-                                          if item.readings_in_unit > 1 else item_text,
-                                          _id=item.unit_id,
-                                          _class=("unit {} {} {}".format(item.language,
-                                                                         item.readings_in_unit,
-                                                                         class_extra)).strip()))
+                            book_items.append(SPAN(".",
+                                                   _id="delimiter-{}-{}".format(level_countdown, div_path_item),
+                                                   _class="delimiter-{}".format(level_countdown)))
+                            level_countdown -= 1
+                        div_path_item = item.div_path[-1]
+                        book_items.append(SPAN(div_path_item,
+                                               _id=div_path_item,
+                                               _class="level-{}".format(level_countdown)))
+                        last_div_path = item.div_path
+
+                    # processing text
+                    if isinstance(item.text, tuple):
+                        item_text = []
+                        for w in item.text:
+                            if isinstance(w, basestring):
+                                item_text.append(w)
+                            else:
+                                w_class = " ".join("{}_{}".format(k, v) for k, v in sorted(w.attributes.items()))
+                                w_class = ("w {}".format(w_class)).strip()
+                                item_text.append(SPAN(w.text, _class=w_class))
+                        # item_text = SPAN(*item_text)
                     else:
-                        book_items.append(item)
-                if book_items:
-                    if as_gluon:
-                        items.append(DIV(book_items))
-                    else:
-                        items.append(book_items)
-            except IOError as e:
-                errors.append(str(e).replace("\\\\", "\\"))
-            except ElementDoesNotExist as e:
-                errors.append(e.message)
-            except MultipleElementsReturned as e:
-                errors.append(e.message)
-            else:
-                errors.append(None)
-        return {"result": items, "error": errors}
+                        item_text = [item.text if item.text else u"†" if item.text is None else u"*"]
+                    # add extra style elements
+                    class_extra = ("{} {}".format("linebreak_{}".format(item.linebreak) if item.linebreak else "",
+                                                  "indent" if item.indent.upper() == "YES" else "")).strip()
+                    book_items.append(SPAN(A(item_text, _href=str(item.unit_id))
+                                      if item.readings_in_unit > 1 else item_text,
+                                      _id=item.unit_id,
+                                      _class=("unit {} {} {}".format(item.language,
+                                                                     item.readings_in_unit,
+                                                                     class_extra)).strip()))
+                else:
+                    book_items.append(item)
+            if not book_items:
+                return []
+            return [DIV(book_items)] if as_gluon else [book_items]
+
+        def error_message(e):
+            if isinstance(e, IOError):
+                return str(e).replace("\\\\", "\\")
+            return e.message
+
+        return BookManager._collect(BookManager._map_by_book(
+            text_positions, process, (IOError, ElementDoesNotExist, MultipleElementsReturned)),
+            error_message)
 
     @staticmethod
     def get_readings(unit_descriptions, as_gluon=True):
@@ -1315,27 +2927,17 @@ class BookManager(object):
         {"result": <list of reading fragments based on the arguments in the requested form>,
         "error": <list of error messages (as many items as unit_descriptions has))>}
         """
-        items = []
-        errors = []
-        for unit_description in unit_descriptions:
-            try:
-                book = Book.open(BookManager._load(unit_description.get("book")))
-                book_items = []
-                for item in book.get_readings(unit_description.get("version"), unit_description.get("unit_id")):
-                    if as_gluon:
-                        book_items.append(TAG.dt(item.mss))
-                        book_items.append(TAG.dd(item.text if item.text else u"†" if item.text is None else ""))
-                    else:
-                        book_items.append(item)
+        def process(book, description):
+            book_items = []
+            for item in book.get_readings(description.get("version"), description.get("unit_id")):
                 if as_gluon:
-                    items.append(TAG.dl(book_items))
+                    book_items.append(TAG.dt(item.mss))
+                    book_items.append(TAG.dd(item.text if item.text else u"†" if item.text is None else ""))
                 else:
-                    items += [book_items]
-            except IOError as e:
-                errors.append(str(e))
-            else:
-                errors.append(None)
-        return {"result": items, "error": errors}
+                    book_items.append(item)
+            return [TAG.dl(book_items)] if as_gluon else [book_items]
+
+        return BookManager._collect(BookManager._map_by_book(unit_descriptions, process, (IOError,)))
 
     @staticmethod
     def get_unit_group(unit_descriptions):
@@ -1350,20 +2952,10 @@ class BookManager(object):
         {"result": <list of reading fragments based on the arguments in the requested form>,
         "error": <list of error messages (as many items as unit_descriptions has))>}
         """
-        items = []
-        errors = []
-        for unit_description in unit_descriptions:
-            try:
-                book = Book.open(BookManager._load(unit_description.get("book")))
-                book_items = []
-                for item in book.get_unit_group(unit_description.get("version"), unit_description.get("unit_id")):
-                    book_items.append(item)
-                items += [book_items]
-            except IOError as e:
-                errors.append(str(e))
-            else:
-                errors.append(None)
-        return {"result": items, "error": errors}
+        def process(book, description):
+            return [list(book.get_unit_group(description.get("version"), description.get("unit_id")))]
+
+        return BookManager._collect(BookManager._map_by_book(unit_descriptions, process, (IOError,)))
 
     @staticmethod
     def get_group(group_descriptions, as_gluon=True):
@@ -1379,26 +2971,18 @@ class BookManager(object):
         {"result": <list of reading fragments based on the arguments in the requested form>,
         "error": <list of error messages (as many items as unit_descriptions has))>}
         """
-        items = []
-        errors = []
-        for group_description in group_descriptions:
-            try:
-                book = Book.open(BookManager._load(group_description.get("book")))
-                book_items = book.get_group(group_description.get("version"), group_description.get("unit_group"))
-                if as_gluon:
-                    tmp_items = []
-                    for unit_id, readings in book_items.iteritems():
-                        for reading in readings:
-                            tmp_items.append(TAG.dt(reading.mss))
-                            tmp_items.append(TAG.dd(reading.text if reading.text else u"†" if reading.text is None else ""))
-                    items.append(TAG.dl(tmp_items))
-                else:
-                    items += [book_items]
-            except IOError as e:
-                errors.append(str(e))
-            else:
-                errors.append(None)
-        return {"result": items, "error": errors}
+        def process(book, description):
+            book_items = book.get_group(description.get("version"), description.get("unit_group"))
+            if not as_gluon:
+                return [book_items]
+            tmp_items = []
+            for unit_id, readings in book_items.iteritems():
+                for reading in readings:
+                    tmp_items.append(TAG.dt(reading.mss))
+                    tmp_items.append(TAG.dd(reading.text if reading.text else u"†" if reading.text is None else ""))
+            return [TAG.dl(tmp_items)]
+
+        return BookManager._collect(BookManager._map_by_book(group_descriptions, process, (IOError,)))
 
     @staticmethod
     def create_book(book_name, book_title, frags=False):
@@ -1424,50 +3008,60 @@ class BookManager(object):
         assert os.path.isfile(from_file_path)
         to_file_path = os.path.join(BookManager.xml_draft_file_storage_path, "{}.xml".format(book_name))
         print 'copying', to_file_path
-        if os.path.isfile(to_file_path):
-            backup_to_file_path = os.path.join(BookManager.xml_draft_file_backup_storage_path,
-                                               "{}_{}.xml".format(
-                                                   book_name,
-                                                   datetime.now().strftime("%Y%m%d_%H%M%S_%f")))
-            print ">> copy from_file_path: {}".format(from_file_path)
-            print ">> copy to_file_path: {}".format(to_file_path)
-            print ">> copy backup_to_file_path: {}".format(backup_to_file_path)
-            copy_file(to_file_path, backup_to_file_path)
-            assert os.path.isfile(backup_to_file_path)
-        else:
-            copy_file(from_file_path, to_file_path)
-            assert os.path.isfile(to_file_path)
+        DraftSession.close_all(book_name)
+        journal = DraftJournal.open(book_name)
+        with book_lock(book_name):
+            journal.refresh()
+            if os.path.isfile(to_file_path):
+                # the existing draft is kept; its history is in the journal
+                BookManager._catch_up_draft(book_name)
+                if journal.last_snapshot_seq is None:
+                    with open(to_file_path, "r") as f:
+                        journal.snapshot(f.read())
+            else:
+                copy_file(from_file_path, to_file_path)
+                assert os.path.isfile(to_file_path)
+                # the new draft is the base of the following operations
+                with open(to_file_path, "r") as f:
+                    journal.set_saved_revision(journal.reset(f.read()))
+        BOOK_CACHE.invalidate(to_file_path)
 
     @staticmethod
     def publish_book(book_name):
         """
-        Copy a book from draft folder to the main storage place
+        Copy a book from draft folder to the main storage place, including
+        the edits journaled but not saved yet by the draft sessions of other
+        processes. The replaced version is kept in the BackupStore of the
+        backup folder.
 
         :param book_name:
         :return:
         """
+        DraftSession.save_all(book_name)
         from_file_path = os.path.join(BookManager.xml_draft_file_storage_path, "{}.xml".format(book_name))
         to_file_path = os.path.join(BookManager.xml_file_storage_path, "{}.xml".format(book_name))
-        if os.path.isfile(to_file_path):
-            backup_to_file_path = os.path.join(BookManager.xml_file_backup_storage_path,
-                                               "{}_{}.xml".format(
-                                                   book_name,
-                                                   datetime.now().strftime("%Y%m%d_%H%M%S_%f")))
-            os.rename(to_file_path, backup_to_file_path)
-        copy_file(from_file_path, to_file_path)
+        with book_lock(book_name):
+            BookManager._catch_up_draft(book_name)
+            if os.path.isfile(to_file_path):
+                BackupStore(BookManager.xml_file_backup_storage_path).backup_file(book_name, to_file_path)
+            copy_file(from_file_path, to_file_path)
+        BOOK_CACHE.invalidate(to_file_path)
 
     @staticmethod
-    def renumber_units(book_name):
+    def renumber_units(book_name, editor=None, revision=None):
         """
         Renumber units and readings consecutively throughout the document.
+
+        :param book_name:
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
         print 'BookManager::renumber_units'
-        book = Book.open(BookManager._load(book_name))
-        book._renumber_units()
-        book.save()
+        BookManager._edit(book_name, editor, revision, "_renumber_units")
+        DraftSession.save_all(book_name)
 
     @staticmethod
-    def add_version(book_name, version_title, language, author):
+    def add_version(book_name, version_title, language, author, editor=None, revision=None):
         """
         Add <version> node to the book structure with the given attributes
 
@@ -1475,13 +3069,13 @@ class BookManager(object):
         :param version_title:
         :param language:
         :param author:
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.add_version(version_title, language, author)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "add_version", version_title, language, author)
 
     @staticmethod
-    def update_version(book_name, version_title, new_version_title=None, new_language=None, new_author=None):
+    def update_version(book_name, version_title, new_version_title=None, new_language=None, new_author=None, editor=None, revision=None):
         """
         Update the given <version> node with the given attributes
 
@@ -1490,25 +3084,25 @@ class BookManager(object):
         :param new_version_title:
         :param new_language:
         :param new_author:
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.update_version(version_title, new_version_title, new_language, new_author)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "update_version", version_title, new_version_title, new_language, new_author)
 
     @staticmethod
-    def del_version(book_name, version_title):
+    def del_version(book_name, version_title, editor=None, revision=None):
         """
         Remove the given <version> node
 
         :param book_name:
         :param version_title:
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.del_version(version_title)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "del_version", version_title)
 
     @staticmethod
-    def add_manuscript(book_name, version_title, abbrev, language, show=True):
+    def add_manuscript(book_name, version_title, abbrev, language, show=True, editor=None, revision=None):
         """
         Add <ms> node to the given <version>/<manuscripts> node
 
@@ -1517,13 +3111,13 @@ class BookManager(object):
         :param abbrev:
         :param language:
         :param show:
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.add_manuscript(version_title, abbrev, language, show)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "add_manuscript", version_title, abbrev, language, show)
 
     @staticmethod
-    def update_manuscript(book_name, version_title, abbrev, new_abbrev, new_language=None, new_show=None):
+    def update_manuscript(book_name, version_title, abbrev, new_abbrev, new_language=None, new_show=None, editor=None, revision=None):
         """
         Update <ms> node under the given <version>/<manuscrips> with the given attributes
 
@@ -1533,26 +3127,26 @@ class BookManager(object):
         :param new_abbrev:
         :param new_language:
         :param new_show:
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.update_manuscript(version_title, abbrev, new_abbrev, new_language, new_show)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "update_manuscript", version_title, abbrev, new_abbrev, new_language, new_show)
 
     @staticmethod
-    def del_manuscript(book_name, version_title, abbrev):
+    def del_manuscript(book_name, version_title, abbrev, editor=None, revision=None):
         """
         Remove <ms> node from the given <version>/<manuscrips> node
 
         :param book_name:
         :param version_title:
         :param abbrev:
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.del_manuscript(version_title, abbrev)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "del_manuscript", version_title, abbrev)
 
     @staticmethod
-    def add_bibliography(book_name, version_title, abbrev, text):
+    def add_bibliography(book_name, version_title, abbrev, text, editor=None, revision=None):
         """
         Add <bibliography> node to the given <version>/<manuscrips>/<ms> node
 
@@ -1560,13 +3154,13 @@ class BookManager(object):
         :param version_title:
         :param abbrev:
         :param text:
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.add_bibliography(version_title, abbrev, text)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "add_bibliography", version_title, abbrev, text)
 
     @staticmethod
-    def update_bibliography(book_name, version_title, abbrev, bibliography_pos, new_text):
+    def update_bibliography(book_name, version_title, abbrev, bibliography_pos, new_text, editor=None, revision=None):
         """
         Update <bibliography> node under the given <version>/<manuscrips>/<ms> node with the given attributes
 
@@ -1575,13 +3169,13 @@ class BookManager(object):
         :param abbrev:
         :param bibliography_pos: zero based position of the bibliography node inside <ms> node
         :param new_text:
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.update_bibliography(version_title, abbrev, bibliography_pos, new_text)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "update_bibliography", version_title, abbrev, bibliography_pos, new_text)
 
     @staticmethod
-    def del_bibliography(book_name, version_title, abbrev, bibliography_pos):
+    def del_bibliography(book_name, version_title, abbrev, bibliography_pos, editor=None, revision=None):
         """
         Remove <bibliography> node from the given <version>/<manuscrips>/<ms> node
 
@@ -1589,13 +3183,13 @@ class BookManager(object):
         :param version_title:
         :param abbrev:
         :param bibliography_pos: zero based position of the bibliography node inside <ms> node
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.del_bibliography(version_title, abbrev, bibliography_pos)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "del_bibliography", version_title, abbrev, bibliography_pos)
 
     @staticmethod
-    def add_div(book_name, version_title, div_name, div_parent_path, preceding_div):
+    def add_div(book_name, version_title, div_name, div_parent_path, preceding_div, editor=None, revision=None):
         """
         Add new <div> node to a book under the given <version>/text/<div_parent_path> with the given div_name
 
@@ -1604,13 +3198,13 @@ class BookManager(object):
         :param div_name: string, this is the 'number' attribute of the div
         :param div_parent_path: list, list of ancestor <div> nodes
         :param preceding_div:  string, insert the new <div> node after the <div> node with this name
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.add_div(version_title, div_name, div_parent_path, preceding_div)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "add_div", version_title, div_name, div_parent_path, preceding_div)
 
     @staticmethod
-    def update_div(book_name, version_title, div_path, new_div_name):
+    def update_div(book_name, version_title, div_path, new_div_name, editor=None, revision=None):
         """
         Update the <div> node at the last position of the div_path with the given new_div_name
 
@@ -1618,39 +3212,39 @@ class BookManager(object):
         :param version_title:
         :param div_path: list, list of <div> nodes to the desired <div>
         :param new_div_name:
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.update_div(version_title, div_path, new_div_name)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "update_div", version_title, div_path, new_div_name)
 
     @staticmethod
-    def del_div(book_name, version_title, div_path):
+    def del_div(book_name, version_title, div_path, editor=None, revision=None):
         """
         Remove the <div> node from the end of the given div_path
 
         :param book_name:
         :param version_title:
         :param div_path: list, list of <div> nodes to the desired <div>
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.del_div(version_title, div_path)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "del_div", version_title, div_path)
 
     @staticmethod
-    def add_unit(book_name, version_title, div_path):
+    def add_unit(book_name, version_title, div_path, editor=None, revision=None):
         """
         Add <unit> node to the given <version>/text/<div_path>
 
         :param book_name:
         :param version_title:
         :param div_path: list, list of <div> nodes to the desired <div>
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.add_unit(version_title, div_path)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "add_unit", version_title, div_path)
 
     @staticmethod
-    def update_unit(book_name, version_title, unit_id, readings):
+    def update_unit(book_name, version_title, unit_id, readings, editor=None, revision=None):
         """
         Update <unit> node with the given <readings> elements.
         This method clears the existing <reading> nodes from the given <unit> before popuplates with the new <reading>s.
@@ -1662,13 +3256,13 @@ class BookManager(object):
         Each tuple should contain two items: 
         1) a string representing the "mss” value of the updated <reading>
         2) a string representing the text content of that <reading>
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.update_unit(version_title, unit_id, readings)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "update_unit", version_title, unit_id, readings)
 
     @staticmethod
-    def split_unit(book_name, version_title, unit_id, reading_pos, split_point):
+    def split_unit(book_name, version_title, unit_id, reading_pos, split_point, editor=None, revision=None):
         """
         This actually splits a <reading> node of the given <unit> into 2 or 3 pieces and
         moves the parts into new <unit> nodes.
@@ -1683,13 +3277,13 @@ class BookManager(object):
         :param unit_id: number in integer or string type
         :param reading_pos: number in integer or string type
         :param split_point: integer or string
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.split_unit(version_title, unit_id, reading_pos, split_point)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "split_unit", version_title, unit_id, reading_pos, split_point)
 
     @staticmethod
-    def split_reading(book_name, version_title, unit_id, reading_pos, split_point):
+    def split_reading(book_name, version_title, unit_id, reading_pos, split_point, editor=None, revision=None):
         """
         This actually splits a <reading> node of the given <unit> into 2 or 3 pieces.
         If this split_point argument is an integer, that should be interpreted as the index within 
@@ -1703,21 +3297,21 @@ class BookManager(object):
         :param unit_id: number in integer or string type
         :param reading_pos: number in integer or string type
         :param split_point: integer or string
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.split_reading(version_title, unit_id, reading_pos, split_point)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "split_reading", version_title, unit_id, reading_pos, split_point)
 
     @staticmethod
-    def del_unit(book_name, version_title, unit_id):
+    def del_unit(book_name, version_title, unit_id, editor=None, revision=None):
         """
         Remove <unit> node from the given <version> node
 
         :param book_name:
         :param version_title:
         :param unit_id: number in integer or string type
+        :param editor: the editor recorded in the draft journal
+        :param revision: the revision of the draft the edit is based on (see get_revision())
         """
-        book = Book.open(BookManager._load(book_name))
-        book.del_unit(version_title, unit_id)
-        book.save()
+        BookManager._edit(book_name, editor, revision, "del_unit", version_title, unit_id)
         return 'Done renumbering units'
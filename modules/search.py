@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+Full-text search and <w> concordance over the published books
+
+Every <reading> of every book is tokenized into a per-book inverted index,
+which is pickled into the search index folder next to the book's file stamp.
+The same per-book index maps the @lex and @morph values of the <w> elements
+to their occurrences. SEARCH_INDEX keeps the loaded book indexes in memory
+and rebuilds the index of a book only when its xml file has changed.
+"""
+from collections import namedtuple
+from collections import OrderedDict
+import cPickle
+import glob
+import heapq
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+
+from kitchen.text.converters import to_unicode
+
+from parse import Book, PROJECT_ROOT, XML_FILE_STORAGE_PATH
+
+SEARCH_INDEX_STORAGE_PATH = os.path.join(PROJECT_ROOT, "cache", "search")
+# bumped whenever the format of the pickled book indexes changes
+SEARCH_INDEX_FORMAT = 2
+# seconds between two checks of the xml files for changes
+SEARCH_INDEX_REFRESH_INTERVAL = 60
+
+Hit = namedtuple("Hit", "book, title, version, language, unit_id, div_path, mss, text, score")
+Concordance = namedtuple("Concordance", "book, version, mss, unit_id, div_path, position, "
+                                        "left, keyword, right, lex, morph")
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize(text):
+    """
+    Return the text lowercased and without diacritics (accents, breathings,
+    vowel points), so that searching doesn't depend on them.
+    """
+    decomposed = unicodedata.normalize("NFD", to_unicode(text).lower())
+    return u"".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    """
+    Return the list of normalized words of a text.
+    """
+    return _TOKEN_RE.findall(normalize(text))
+
+
+def _plain_text(text):
+    """
+    Return the text of a Reading as one stripped string (the W objects joined
+    in) and a list of (start, end, W) triples locating the W objects in it.
+    """
+    if not isinstance(text, tuple):
+        return (text or u"").strip(), []
+    parts = []
+    words = []
+    offset = 0
+    for part in text:
+        if isinstance(part, basestring):
+            parts.append(part)
+            offset += len(part)
+        else:
+            parts.append(part.text)
+            words.append((offset, offset + len(part.text), part))
+            offset += len(part.text)
+    plain_text = u"".join(parts)
+    leading = len(plain_text) - len(plain_text.lstrip())
+    return plain_text.strip(), [(start - leading, end - leading, w) for start, end, w in words]
+
+
+class BookIndex(object):
+    """
+    Inverted index of the readings of one book
+
+    readings is a list of (version number, unit id, div path, sigla, text)
+    tuples and postings maps every word to a list of (reading number, term
+    frequency) pairs.
+
+    words is a list of (reading number, start, end, lex, morph) tuples, one
+    per <w> element, start and end locating the word in the reading's text;
+    lemmas and morphs map the @lex and @morph values to word numbers.
+    """
+
+    def __init__(self, book_name, stamp, title, versions, readings, postings,
+                 words=(), lemmas=None, morphs=None):
+        self.book_name = book_name
+        self.stamp = stamp
+        self.title = title
+        self.versions = versions  # list of (title, language) pairs
+        self.readings = readings
+        self.postings = postings
+        self.words = list(words)
+        self.lemmas = lemmas or {}
+        self.morphs = morphs or {}
+
+    @staticmethod
+    def build(xml_path):
+        """
+        Parse the given xml file and index all of its readings.
+        """
+        book_name = os.path.splitext(os.path.basename(xml_path))[0]
+        with open(xml_path, "r") as xml_file:
+            stat = os.fstat(xml_file.fileno())
+            book = Book(xml_file)
+        info = book.get_book_info()
+        versions = [(v["attributes"]["title"], v["attributes"]["language"])
+                    for v in info["version"]]
+        readings = []
+        postings = {}
+        words = []
+        lemmas = {}
+        morphs = {}
+        for version_number, (version_title, language) in enumerate(versions):
+            for div_path, unit_id, unit_readings in book.iter_units(version_title):
+                for reading in unit_readings:
+                    text, reading_words = _plain_text(reading.text)
+                    counts = {}
+                    for token in tokenize(text):
+                        counts[token] = counts.get(token, 0) + 1
+                    if not counts:
+                        continue
+                    reading_number = len(readings)
+                    readings.append((version_number, unit_id, div_path,
+                                     tuple(reading.mss.split()), text))
+                    for token, count in counts.iteritems():
+                        postings.setdefault(token, []).append((reading_number, count))
+                    for start, end, w in reading_words:
+                        lex = w.attributes.get("lex")
+                        morph = w.attributes.get("morph")
+                        if lex:
+                            lemmas.setdefault(lex, []).append(len(words))
+                        if morph:
+                            morphs.setdefault(morph, []).append(len(words))
+                        words.append((reading_number, start, end, lex, morph))
+        return BookIndex(book_name, (stat.st_mtime, stat.st_size),
+                         info["book"]["title"], versions, readings, postings,
+                         words, lemmas, morphs)
+
+    @staticmethod
+    def load(index_path):
+        with open(index_path, "rb") as f:
+            data = cPickle.load(f)
+        if data.get("format") != SEARCH_INDEX_FORMAT:
+            raise ValueError("outdated search index format in {}".format(index_path))
+        return BookIndex(data["book_name"], data["stamp"], data["title"],
+                         data["versions"], data["readings"], data["postings"],
+                         data["words"], data["lemmas"], data["morphs"])
+
+    def save(self, index_path):
+        """
+        Write the index to a temporary file first and rename it, so readers
+        never see a partially written index.
+        """
+        data = {"format": SEARCH_INDEX_FORMAT,
+                "book_name": self.book_name,
+                "stamp": self.stamp,
+                "title": self.title,
+                "versions": self.versions,
+                "readings": self.readings,
+                "postings": self.postings,
+                "words": self.words,
+                "lemmas": self.lemmas,
+                "morphs": self.morphs}
+        temp_path = "{}.{}.tmp".format(index_path, os.getpid())
+        with open(temp_path, "wb") as f:
+            cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, index_path)
+
+
+class SearchIndex(object):
+    """
+    Thread-safe, process-wide full-text index of the books in a folder
+
+    The book indexes are loaded or built outside of the lock of the index and
+    swapped in when they are done, so the searches meanwhile go on with the
+    previous indexes.
+    """
+
+    def __init__(self, xml_path=XML_FILE_STORAGE_PATH,
+                 index_path=SEARCH_INDEX_STORAGE_PATH,
+                 refresh_interval=SEARCH_INDEX_REFRESH_INTERVAL):
+        self.xml_path = xml_path
+        self.index_path = index_path
+        self.refresh_interval = refresh_interval
+        self._books = OrderedDict()  # key: book name, value: BookIndex
+        self._errors = {}  # key: book name, value: (stamp, error message)
+        self._last_refresh = None
+        self._refreshing = False  # a background refresh is running
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._book_locks = {}  # key: book name, value: Lock held while updating the book
+
+    def _xml_file(self, book_name):
+        return os.path.join(self.xml_path, "{}.xml".format(book_name))
+
+    def _index_file(self, book_name):
+        return os.path.join(self.index_path, "{}.idx".format(book_name))
+
+    def update(self, book_name):
+        """
+        Bring the index of one book up to date (e.g. after publishing it),
+        loading it from disk or rebuilding it when its xml file has changed.
+
+        :return: the BookIndex, or None if the book can't be indexed
+        """
+        xml_file = self._xml_file(book_name)
+        with self._lock:
+            book_lock = self._book_locks.setdefault(book_name, threading.Lock())
+        with book_lock:
+            try:
+                stat = os.stat(xml_file)
+            except OSError:
+                with self._lock:
+                    self._books.pop(book_name, None)
+                return None
+            stamp = (stat.st_mtime, stat.st_size)
+            with self._lock:
+                book_index = self._books.get(book_name)
+                if book_index is not None and book_index.stamp == stamp:
+                    return book_index
+                if self._errors.get(book_name, (None,))[0] == stamp:
+                    return None
+            try:
+                book_index = BookIndex.load(self._index_file(book_name))
+            except (IOError, EOFError, ValueError, KeyError, cPickle.UnpicklingError):
+                book_index = None
+            if book_index is None or book_index.stamp != stamp:
+                try:
+                    book_index = BookIndex.build(xml_file)
+                except Exception as e:
+                    # e.g. an empty or invalid xml file, retried once it changes
+                    with self._lock:
+                        self._books.pop(book_name, None)
+                        self._errors[book_name] = (stamp, "{}: {}".format(type(e).__name__, e))
+                    return None
+                if not os.path.isdir(self.index_path):
+                    os.makedirs(self.index_path)
+                book_index.save(self._index_file(book_name))
+            with self._lock:
+                self._errors.pop(book_name, None)
+                self._books[book_name] = book_index
+            return book_index
+
+    def _refresh_due(self):
+        return self._last_refresh is None or \
+            time.time() - self._last_refresh >= self.refresh_interval
+
+    def refresh(self, force=False):
+        """
+        Update the indexes of all books, at most once per refresh_interval
+        unless forced.
+        """
+        with self._refresh_lock:
+            if not force and not self._refresh_due():
+                return
+            now = time.time()
+            book_names = sorted(os.path.splitext(os.path.basename(path))[0]
+                                for path in glob.glob(os.path.join(self.xml_path, "*.xml")))
+            with self._lock:
+                for book_name in set(self._books) - set(book_names):
+                    del self._books[book_name]
+            for book_name in book_names:
+                self.update(book_name)
+            self._last_refresh = now
+
+    def refresh_in_background(self):
+        """
+        Run refresh() on a daemon thread, unless one is running already.
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_for_query(self):
+        """
+        Only the first refresh is waited for, as there is nothing to search
+        before it; later ones run in the background when they are due.
+        """
+        if self._last_refresh is None:
+            self.refresh()
+        elif self._refresh_due():
+            self.refresh_in_background()
+
+    def errors(self):
+        """
+        Return a dictionary of the books which couldn't be indexed and why.
+        """
+        with self._lock:
+            return dict((book_name, error) for book_name, (stamp, error) in self._errors.items())
+
+    def search(self, query, books=None, versions=None, languages=None,
+               manuscripts=None, limit=50):
+        """
+        Return the readings containing every word of the query, best first
+
+        The score of a reading is the sum of tf * idf of the query words, the
+        idf being computed over all readings of the searched books.
+
+        :param query: the searched words
+        :param books: only search these books (file names)
+        :param versions: only search versions with these titles
+        :param languages: only search versions in these languages
+        :param manuscripts: only return readings attested by these sigla
+        :param limit: the maximum number of hits
+        :return: list of Hit objects
+        """
+        terms = list(OrderedDict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        self._refresh_for_query()
+        with self._lock:
+            book_indexes = [b for name, b in self._books.items()
+                            if not books or name in books]
+
+        total = sum(len(b.readings) for b in book_indexes)
+        df = dict((term, sum(len(b.postings.get(term, ())) for b in book_indexes))
+                  for term in terms)
+        if not all(df.values()):
+            return []
+        idf = dict((term, math.log(1.0 + float(total) / df[term])) for term in terms)
+        manuscripts = set(manuscripts) if manuscripts else None
+
+        scored = []
+        for book_number, book_index in enumerate(book_indexes):
+            allowed_versions = set(number for number, (title, language)
+                                   in enumerate(book_index.versions)
+                                   if (not versions or title in versions) and
+                                   (not languages or language in languages))
+            if not allowed_versions:
+                continue
+            # start from the rarest word to keep the candidate set small
+            candidates = None
+            for term in sorted(terms, key=lambda t: len(book_index.postings.get(t, ()))):
+                term_postings = book_index.postings.get(term)
+                if not term_postings:
+                    candidates = {}
+                    break
+                if candidates is None:
+                    candidates = dict((reading, count * idf[term]) for reading, count in term_postings)
+                else:
+                    candidates = dict((reading, candidates[reading] + count * idf[term])
+                                      for reading, count in term_postings if reading in candidates)
+                if not candidates:
+                    break
+            for reading_number, score in candidates.iteritems():
+                version_number, unit_id, div_path, mss, text = book_index.readings[reading_number]
+                if version_number not in allowed_versions:
+                    continue
+                if manuscripts is not None and manuscripts.isdisjoint(mss):
+                    continue
+                scored.append((score, -book_number, -reading_number, book_index, reading_number))
+
+        hits = []
+        for score, x, y, book_index, reading_number in heapq.nlargest(limit, scored):
+            version_number, unit_id, div_path, mss, text = book_index.readings[reading_number]
+            version_title, language = book_index.versions[version_number]
+            hits.append(Hit(book_index.book_name, book_index.title, version_title, language,
+                            unit_id, div_path, mss, text, score))
+        return hits
+
+    def concordance(self, lex=None, morph=None, books=None, versions=None,
+                    manuscripts=None, context=5, limit=None):
+        """
+        Return the occurrences of the <w> elements with the given @lex and/or
+        @morph value in key word in context form, in document order
+
+        :param lex: the lemma (@lex value) of the words
+        :param morph: the morphology (@morph value) of the words
+        :param books: only search these books (file names)
+        :param versions: only search versions with these titles
+        :param manuscripts: only return words of readings attested by these sigla
+        :param context: the number of words shown left and right of the word
+        :param limit: the maximum number of occurrences (default: all)
+        :return: list of Concordance objects
+        """
+        if lex is None and morph is None:
+            return []
+        self._refresh_for_query()
+        with self._lock:
+            book_indexes = [b for name, b in self._books.items()
+                            if not books or name in books]
+        manuscripts = set(manuscripts) if manuscripts else None
+
+        lines = []
+        for book_index in book_indexes:
+            word_numbers = None
+            for values, value in ((book_index.lemmas, lex), (book_index.morphs, morph)):
+                if value is not None:
+                    found = values.get(value, ())
+                    word_numbers = found if word_numbers is None else \
+                        sorted(set(word_numbers).intersection(found))
+            for word_number in word_numbers:
+                reading_number, start, end, word_lex, word_morph = book_index.words[word_number]
+                version_number, unit_id, div_path, mss, text = book_index.readings[reading_number]
+                version_title = book_index.versions[version_number][0]
+                if versions and version_title not in versions:
+                    continue
+                if manuscripts is not None and manuscripts.isdisjoint(mss):
+                    continue
+                left_words = text[:start].split()
+                lines.append(Concordance(book_index.book_name, version_title, mss, unit_id,
+                                         div_path, len(left_words),
+                                         u" ".join(left_words[-context:] if context else []),
+                                         text[start:end],
+                                         u" ".join(text[end:].split()[:context]),
+                                         word_lex, word_morph))
+                if limit is not None and len(lines) >= limit:
+                    return lines
+        return lines
+
+
+SEARCH_INDEX = SearchIndex()
@@ -9,3 +9,15 @@ routes_in = (
 )
 
 routes_out = [(x, y) for (y, x) in routes_in]
+
+# Warm the book cache up with the published books when web2py starts, before
+# the server accepts requests (see parse.warm_up_corpus), and load or build
+# the search index in the background. web2py executes this file at start-up
+# also for shells, scripts, cron jobs and schedulers, which don't serve texts,
+# so those are skipped.
+import sys as _sys
+if not set(_sys.argv[1:]) & {'-S', '--shell', '-K', '--scheduler', '-R', '--run', '-J', '--cronjob'}:
+    from applications.grammateus3.modules.parse import warm_up_corpus
+    from applications.grammateus3.modules.search import SEARCH_INDEX
+    warm_up_corpus()
+    SEARCH_INDEX.refresh_in_background()
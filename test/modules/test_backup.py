@@ -0,0 +1,92 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+"""
+run tests from web2py root directory with:
+
+    python2.7 -m pytest -xvvs applications/grammateus3/test/modules/test_backup.py
+"""
+
+import os
+from plugin_utils import check_path
+import pytest
+import threading
+from backup import BackupDoesNotExist, BackupStore, split_chunks
+
+file_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+PROJECT_ROOT = os.path.join(file_dir, os.pardir)
+
+TEST_XML_FILE = check_path(os.path.join(PROJECT_ROOT, "test", "docs", "drafts",
+                                        "test_parse.xml"))
+
+
+@pytest.fixture
+def xml():
+    return open(TEST_XML_FILE).read()
+
+
+def test_split_chunks(xml):
+    chunks = split_chunks(xml)
+    assert "".join(chunks) == xml
+    assert len(chunks) > 1
+    assert all(chunk.startswith(("<div", "<unit")) for chunk in chunks[1:])
+    # an edit changes only the chunk it falls in
+    edited_chunks = split_chunks(xml.replace("Lorem", "Lorem lorem"))
+    assert len(edited_chunks) == len(chunks)
+    assert len(set(edited_chunks) - set(chunks)) == 1
+
+
+def test_backup_and_restore(xml, tmpdir):
+    store = BackupStore(str(tmpdir))
+    first = store.backup("test_parse", xml, "1")
+    second = store.backup("test_parse", xml.replace("Lorem", "Lorem lorem"))
+    assert store.backups("test_parse") == [first, second]
+    assert store.names() == ["test_parse"]
+    assert store.restore("test_parse", first) == xml
+    restored_file = str(tmpdir.join("restored.xml"))
+    store.restore_file("test_parse", second, restored_file)
+    assert open(restored_file).read() == xml.replace("Lorem", "Lorem lorem")
+    with pytest.raises(BackupDoesNotExist):
+        store.restore("test_parse", "0")
+
+
+def test_backup_stores_new_chunks_only(xml, tmpdir):
+    store = BackupStore(str(tmpdir))
+    store.backup("test_parse", xml, "000")
+    stored_size = store.stats()["stored_size"]
+    for i in range(1, 100):
+        store.backup("test_parse", xml.replace("Lorem", "Lorem {}".format(i)),
+                     "{:03d}".format(i))
+    stats = store.stats()
+    assert (stats["backups"], stats["chunks"]) == (100, len(split_chunks(xml)) + 99)
+    assert stats["size"] > 100 * len(xml)
+    assert stats["stored_size"] < 2 * stored_size
+
+
+def test_prune(xml, tmpdir):
+    store = BackupStore(str(tmpdir))
+    for i in range(3):
+        store.backup("test_parse", xml.replace("Lorem", "Lorem {}".format(i)), str(i))
+    chunks = store.stats()["chunks"]
+    assert store.prune("test_parse", keep=1) == ["0", "1"]
+    assert store.backups("test_parse") == ["2"]
+    assert store.stats()["chunks"] == chunks - 2
+    assert store.restore("test_parse", "2") == xml.replace("Lorem", "Lorem 2")
+
+
+def test_collect_garbage_keeps_chunks_of_concurrent_backups(xml, tmpdir):
+    def backup(i):
+        # a store object per thread, as with several modules and processes
+        BackupStore(str(tmpdir)).backup("test_parse", xml.replace("Lorem", "Lorem {}".format(i)),
+                                        "{:02d}".format(i))
+
+    threads = [threading.Thread(target=backup, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    store = BackupStore(str(tmpdir))
+    while any(thread.is_alive() for thread in threads):
+        store.collect_garbage()
+    for thread in threads:
+        thread.join()
+    for i in range(20):
+        assert store.restore("test_parse", "{:02d}".format(i)) == xml.replace("Lorem", "Lorem {}".format(i))
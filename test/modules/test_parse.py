@@ -7,18 +7,27 @@ run tests from web2py root directory with:
     python2.7 -m pytest -xvvs applications/grammateus3/test/modules/test_parse.py
 """
 
+from backup import BackupStore
 from collections import OrderedDict
+from datetime import timedelta
 import difflib
 import glob
+import hashlib
+import imp
 from lxml import etree
+import multiprocessing
 import os
 from parse import Text, Reading, W
-from parse import Book, BookManager
-from parse import ElementDoesNotExist, InvalidDIVPath, NotAllowedManuscript
+from parse import Book, BookCache, BookEditor, BookManager, BookValidator, DraftJournal, DraftSession
+from parse import validate_corpus
+from parse import ElementDoesNotExist, InvalidDIVPath, NotAllowedManuscript, RevisionDoesNotExist, StaleRevision
 from plugin_utils import check_path
 from pprint import pprint
+import pickle
 import pytest
+import shutil
 from StringIO import StringIO
+import time
 
 file_dir = os.path.join(os.path.dirname(__file__), os.pardir)
 PROJECT_ROOT = os.path.join(file_dir, os.pardir)
@@ -34,6 +43,8 @@ XML_DRAFT_FILE_BACKUP_STORAGE_PATH = check_path(os.path.join(PROJECT_ROOT,
 
 TEST_XML_FILE = check_path(os.path.join(PROJECT_ROOT, "test", "docs", "drafts",
                                         "test_parse.xml"))
+TEST_SMALL_XML_FILE = check_path(os.path.join(PROJECT_ROOT, "test", "docs",
+                                              "1En_test_2.xml"))
 TEST_DTD_FILE = check_path(os.path.join(PROJECT_ROOT, "static", "docs",
                                         "grammateus.dtd"))
 
@@ -69,18 +80,152 @@ def test_book_validation_w_dtd_invalid_doc():
 
 
 def test_book_validation_w_dtd_valid_and_semantically_invalid_doc(test_book):
-    expected_errors = ["<version title='Qumran Aramaic'>//<unit id='684'> has wrong id. It should be '1'.",
+    expected_errors = ["<version title='Ethiopic'>//<unit id='79'> has <reading> with wrong option. The options should be numbered from '0'.",
+                       "<version title='Qumran Aramaic'>//<unit id='684'> has wrong id. It should be '1'.",
+                       "<version title='Qumran Aramaic'>//<unit id='710'> has <reading> with wrong option. The options should be numbered from '0'.",
                        "<version title='Latin Fragments'> has missing manuscript definition(s) which are in use: CB185,TertullianB",
                        "<version title='Latin Fragments'>//<unit id='755'> has wrong id. It should be '1'.",
+                       "<version title='Latin Fragments'>//<unit id='769'> has <reading> with wrong option. The options should be numbered from '0'.",
                        "<version title='Greek'> has missing manuscript definition(s) which are in use: Gizeh*,Swete,F-R,Charles,Syncellus2,Black,Dindorf,Bonner,Lods,Ε,Goar,Dillman,Kenyon",
                        "<version title='Greek'>//<unit id='788'> has wrong id. It should be '1'.",
                        "<version title='Greek'/text/div number='107'> has <div> with not unique name (number)",
+                       "<version title='Greek'>//<unit id='1061'> has <reading> with wrong option. The options should be numbered from '0'.",
                        ]
     assert test_book.validate(open(TEST_DTD_FILE)) is False
     assert test_book.validation_errors == expected_errors
 
 
+SEMANTIC_TEST_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<book filename="Test" title="Test">
+  <version title="A" author="Anonymous">
+    <divisions><division label="Chapter"/><division label="Verse"/></divisions>
+    <manuscripts><ms abbrev="a" language="" show="yes"><name/></ms></manuscripts>
+    <text>
+      <div number="1">
+        <div number="1">
+          <unit id="1"><reading option="0" mss="a">x</reading><reading option="1" mss="a">y</reading></unit>
+        </div>
+        <div number="2">
+          <unit id="2"><reading option="0" mss="a">z</reading></unit>
+        </div>
+      </div>
+    </text>
+  </version>
+</book>"""
+
+
+@pytest.mark.parametrize("change,expected", [
+    (lambda book: None, []),
+    (lambda book: book.xpath("//unit")[1].set("id", ""),
+     ["<version title='A'>//<unit id=''> has wrong id. It should be '2'."]),
+    (lambda book: book.xpath("//reading")[1].set("mss", "b"),
+     ["<version title='A'> has missing manuscript definition(s) which are in use: b"]),
+    (lambda book: book.xpath("//div/div")[1].append(etree.Element("div", number="1")),
+     ["<version title='A'> has deeper <div> structure than in <divisions>. "
+      "For example: <text/div number='1'/div number='2'/div number='1'>"]),
+    (lambda book: book.xpath("//div/div")[1].set("number", "1"),
+     ["<version title='A'/text/div number='1'> has <div> with not unique name (number)"]),
+    (lambda book: book.xpath("//text/div")[0].append(book.xpath("//unit")[1]),
+     ["<version title='A'>//<unit id='2'> is not at the deepest level of the <div> structure: "
+      "<text/div number='1'>"]),
+    (lambda book: book.xpath("//reading")[1].set("option", "2"),
+     ["<version title='A'>//<unit id='1'> has <reading> with wrong option. "
+      "The options should be numbered from '0'."]),
+])
+def test_book_semantic_validation(change, expected):
+    book = Book(StringIO(SEMANTIC_TEST_XML))
+    change(book)
+    validator = BookValidator()
+    validator._validate_by_semantic(book)
+    assert validator.validation_errors == expected
+
+
+def test_book_validate_subtree_after_edit():
+    book = Book(StringIO(SEMANTIC_TEST_XML))
+    editor = BookEditor(book)
+    validator = BookValidator()
+    editor.add_unit("A", ["1", "1"])
+    assert editor.touched is book.xpath("//div/div")[0]
+    assert validator.validate_subtree(book, editor.touched) is True
+    editor.split_reading("A", "3", 0, 1)
+    assert validator.validate_subtree(book, editor.touched) is True
+    # the unit following the subtree is checked as well
+    book.xpath("//unit")[-1].set("id", "5")
+    assert validator.validate_subtree(book, book.xpath("//unit")[0]) is True
+    assert validator.validate_subtree(book, book.xpath("//div/div")[0]) is False
+    assert validator.validation_errors == ["<version title='A'>//<unit id='5'> has wrong id. It should be '3'."]
+    book.xpath("//unit")[-1].set("id", "3")
+    editor.update_div("A", ["1", "2"], "1")
+    assert validator.validate_subtree(book, editor.touched) is False
+    assert validator.validation_errors == \
+        ["<version title='A'/text/div number='1'> has <div> with not unique name (number)"]
+    editor.del_version("A")
+    assert validator.validate_subtree(book, editor.touched) is True
+
+
+def test_book_validator_compiles_dtd_once():
+    dtd = BookValidator._compiled_dtd(TEST_DTD_FILE)
+    assert BookValidator._compiled_dtd(TEST_DTD_FILE) is dtd
+    dtd_from_file = BookValidator._compiled_dtd(open(TEST_DTD_FILE))
+    assert BookValidator._compiled_dtd(StringIO(open(TEST_DTD_FILE).read())) is dtd_from_file
+    with pytest.raises(TypeError):
+        BookValidator._compiled_dtd(1)
+
+
+def test_validate_corpus():
+    missing_file = os.path.join(XML_FILE_STORAGE_PATH, "Xtest_parse.xml")
+    report = validate_corpus([TEST_XML_FILE, missing_file], TEST_DTD_FILE, processes=2)
+    assert report.keys() == [TEST_XML_FILE, missing_file]
+    assert report[TEST_XML_FILE]["valid"] is False
+    assert report[TEST_XML_FILE]["errors"]
+    assert report[TEST_XML_FILE]["parse_seconds"] > 0
+    assert report[missing_file]["error"].startswith("IOError")
+    assert report[missing_file]["valid"] is False
+
+
 # Testing RI
+def test_book_get_book_info_is_lazy():
+    book = Book(open(TEST_XML_FILE))
+    info = book.get_book_info()
+    assert book.get_book_info() is info
+    version_info = info["version"][0]
+    assert version_info["attributes"]["title"] == book._book.xpath("version/@title")[0]
+    manuscripts = version_info["manuscripts"]
+    assert version_info["manuscripts"] is manuscripts
+    assert "reference_list" not in version_info._computed
+    assert list(version_info.keys()) == ["attributes", "organisation_levels", "divisions",
+                                         "resources", "manuscripts", "reference_list"]
+    assert version_info["manuscripts"] is manuscripts
+    unpickled = pickle.loads(pickle.dumps(version_info))
+    assert type(unpickled) is OrderedDict
+    assert unpickled == version_info
+
+
+def test_book_reference_trie():
+    book = Book(open(TEST_XML_FILE))
+    refs = book.get_reference_trie("Greek")
+    greek = book._get("version", {"title": "Greek"})
+    assert book._reference_trie(greek) is refs
+    leaves = book._div_table(greek)["leaves"]
+    assert refs.paths == [leaf.div_path for leaf in leaves]
+    assert refs.references[0] == refs.format(refs.paths[0]) == u"{}:{}".format(*refs.paths[0])
+    assert refs.first() == refs.paths[0]
+    assert refs.last() == refs.paths[-1]
+    chapter = refs.paths[0][0]
+    chapter_paths = [path for path in refs.paths if path[0] == chapter]
+    assert refs.first([chapter]) == chapter_paths[0]
+    assert refs.last([chapter]) == chapter_paths[-1]
+    assert refs.span([chapter]) == (0, len(chapter_paths) - 1)
+    assert refs.paths[0] in refs
+    assert refs.references[-1] in refs
+    assert list(refs.paths[0][:1]) not in refs
+    assert ("nonexisting", ) not in refs
+    assert refs.first(["nonexisting"]) is None
+    # the trie is rebuilt after the divs are edited
+    BookEditor(book).add_div("Greek", "new", [chapter])
+    assert book.get_reference_trie("Greek").last([chapter]) == (chapter, u"new")
+
+
 @pytest.mark.parametrize("myref,mylength,expected", [
     ((1,),  # case 1 ----------------------------------------------------
      1,
@@ -522,6 +667,45 @@ def test_get_next_or_prev(test_book, myref, mylength, mylevel, mydir, expected):
         assert a == expected[idx]
 
 
+def test_book_div_table():
+    book = Book(open(TEST_XML_FILE))
+    version = book._get("version", {"title": "Greek"})
+    table = book._div_table(version)
+    leaf_divs = version.xpath("text//div[not(div)]")
+    assert [leaf.ordinal for leaf in table["leaves"]] == range(len(leaf_divs))
+    assert [leaf.element for leaf in table["leaves"]] == leaf_divs
+    assert [leaf.div_path for leaf in table["leaves"]] == [tuple(book._locate_div_path(div))
+                                                           for div in leaf_divs]
+    assert table["leaves"][-1].last_unit == len(version.xpath("text//unit")) - 1
+    first, last = table["spans"][version.xpath("text/div")[1]]
+    assert table["leaves"][first].element == version.xpath("text/div[2]/descendant::div[not(div)]")[0]
+    assert table["leaves"][last].element == version.xpath("text/div[2]/descendant::div[not(div)]")[-1]
+
+
+def test_book_get_synopsis():
+    book = Book(open(TEST_XML_FILE))
+    panes = [("Greek", "TestOne"), ("Ethiopic", "p"), ("Greek", "7QEnoch")]
+    synopsis = book.get_synopsis(panes, (1,), (2,))
+    for (version_title, text_type), pane in zip(panes, synopsis):
+        text_iterator, start_sel, end_sel = book.get_text(version_title, text_type, (1,), (2,))
+        assert pane == (list(text_iterator), start_sel, end_sel)
+    # the panes of one version are aligned unit by unit
+    assert [t.unit_id for t in synopsis[0][0]] == [t.unit_id for t in synopsis[2][0]]
+    with pytest.raises(ElementDoesNotExist):
+        book.get_synopsis([("Greek", "TestOne"), ("Greek", "XTestOne")], (1,))
+
+
+def test_book_get_text_holds_no_lxml_objects():
+    book = Book(open(TEST_XML_FILE))
+    text_iterator, start_sel, end_sel = book.get_text("Greek", "TestOne", (2, 2), (2, 2))
+    texts = [t for t in text_iterator if isinstance(t.text, tuple)]
+    words = [w for w in texts[0].text if isinstance(w, W)]
+    assert words[0] == W({"morph": "morph", "lex": "lex", "style": "style", "lang": "lang"}, "ipsum")
+    assert all(type(w.attributes) is dict for w in words)
+    assert all(type(k) in (str, unicode) and type(v) in (str, unicode)
+               for w in words for k, v in w.attributes.items())
+
+
 @pytest.mark.parametrize("mystartref,myendref,mynext,myprev,expected_start_sel,"
                          "expected_end_sel,expected_list", [
     ((107,),  # case 1 ----------------------------------------------------
@@ -801,6 +985,69 @@ def test_book_get_readings_w_invalid_unit_id(test_book):
     assert result == expected
 
 
+def test_book_unit_index_follows_editor_changes():
+    book = Book(StringIO(open(TEST_SMALL_XML_FILE).read()))
+    editor = BookEditor(book)
+    version = book._get("version", {"title": "Ethiopic"})
+    assert book._get_unit(version, 1) is version.xpath(".//unit")[0]
+    editor.add_unit("Ethiopic", ["1", "1"])
+    editor.split_unit("Ethiopic", 1, 0, 5)
+    units = version.xpath(".//unit")
+    assert [book._get_unit(version, unit_id) for unit_id in (1, "2", u"3")] == units
+    editor.del_unit("Ethiopic", 2)
+    assert [book._get_unit(version, unit_id) for unit_id in (1, 2)] == [units[0], units[2]]
+    with pytest.raises(ElementDoesNotExist):
+        book._get_unit(version, 3)
+
+
+def test_book_editor_renumbers_following_units_only():
+    book = Book(open(TEST_XML_FILE))
+    editor = BookEditor(book)
+    units = book.xpath("//unit")
+    units[0][0].set("option", "9")  # left alone, the unit isn't edited
+    greek = book._get("version", {"title": "Greek"})
+    editor.add_unit("Greek", ["1", "2"])
+    new_unit = greek.xpath("text/div[1]/div[2]/unit")[-1]
+    assert new_unit.get("id") == str(int(new_unit.getprevious().get("id")) + 1)
+    assert new_unit[0].get("option") == "0"
+    assert [u.get("id") for u in book.xpath("//unit")] == map(str, range(1, len(units) + 2))
+    assert units[0][0].get("option") == "9"
+    editor.del_unit("Greek", new_unit.get("id"))
+    assert [u.get("id") for u in book.xpath("//unit")] == map(str, range(1, len(units) + 1))
+    assert book._get_unit(greek, units[-1].get("id")) is units[-1]
+
+
+def test_book_editor_splits_last_unit():
+    book = Book(open(TEST_XML_FILE))
+    editor = BookEditor(book)
+    units = book.xpath("//unit")
+    units[0][0].set("option", "9")  # left alone, the split renumbers the following units only
+    last_unit = units[-1]
+    version = next(last_unit.iterancestors("version"))
+    text = last_unit[0].text
+    editor.split_unit(version.get("title"), last_unit.get("id"), 0, u"not in the reading")
+    assert book.xpath("//unit") == units
+    assert editor.touched is None
+    editor.split_unit(version.get("title"), last_unit.get("id"), 0, 2)
+    assert [u.get("id") for u in book.xpath("//unit")] == map(str, range(1, len(units) + 2))
+    new_unit = book._get_unit(version, str(len(units) + 1))
+    assert new_unit.getprevious() is last_unit
+    assert (last_unit[0].text, new_unit[0].text) == (text[:2].strip(), text[2:].strip())
+    assert units[0][0].get("option") == "9"
+    assert editor.touched is last_unit.getparent()
+
+
+def test_book_manuscript_index_follows_editor_changes():
+    book = Book(StringIO(open(TEST_SMALL_XML_FILE).read()))
+    version = book._get("version", {"title": "Ethiopic"})
+    assert sorted(book._manuscript_index(version).keys()) == ["Bertalotto", "p"]
+    result_iter, startsel, endsel = book.get_text("Ethiopic", "p1", None)
+    assert [item.text for item in result_iter] == [None]
+    BookEditor(book).update_unit("Ethiopic", "1", (("p1 p2", u"ቃለ፡"), ("p", u"በረከት፡")))
+    result_iter, startsel, endsel = book.get_text("Ethiopic", "p1", None)
+    assert [item.text for item in result_iter] == [u"ቃለ፡"]
+
+
 def test_book_get_unit_group(test_book):
     result = list(test_book.get_unit_group("Greek", 812))
     expected = [10, 14]
@@ -1162,6 +1409,26 @@ def test_bookman_get_unit_group():
     assert result["error"] == expected["error"]
 
 
+def test_bookman_batch_loads_each_book_once(monkeypatch):
+    loaded = []
+    load = BookManager._load
+
+    def counting_load(book_name):
+        loaded.append(book_name)
+        return load(book_name)
+
+    monkeypatch.setattr(BookManager, "_load", staticmethod(counting_load))
+    result = BookManager.get_unit_group([{"book": "test_parse", "version": "Greek", "unit_id": 812},
+                                         {"book": "Xtest_parse", "version": "Greek", "unit_id": 812},
+                                         {"book": "test_parse", "version": "Greek", "unit_id": 813}])
+    assert sorted(loaded) == ["Xtest_parse", "test_parse"]
+    assert result["result"] == [[10, 14], [14, 10]]
+    assert result["error"] == [None,
+                               "[Errno 2] No such file or directory: '{}/Xtest_parse.xml'".format(
+                                   XML_DRAFT_FILE_STORAGE_PATH),
+                               None]
+
+
 def test_bookman_get_group():
     result = BookManager.get_group([{"book": "test_parse", "version": "Greek", "unit_group": 14},
                                     {"book": "test_parse", "version": "Greek", "unit_group": 10}],
@@ -1287,6 +1554,309 @@ def test_bookman_get_group_as_gluon():
     assert result["error"] == expected["error"]
 
 
+# BookCache tests
+
+
+def test_book_cache_hit_and_miss(tmpdir):
+    book_file = str(tmpdir.join("1En.xml"))
+    shutil.copy(TEST_SMALL_XML_FILE, book_file)
+    cache = BookCache()
+    book = cache.get(book_file)
+    assert cache.get(book_file) is book
+    assert cache.get(os.path.relpath(book_file)) is book
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["books"]) == (2, 1, 1)
+    assert stats["size"] == os.path.getsize(book_file)
+    assert book.content_hash == hashlib.sha1(open(book_file).read()).hexdigest()
+
+
+def test_book_cache_reparses_changed_file(tmpdir):
+    book_file = str(tmpdir.join("1En.xml"))
+    shutil.copy(TEST_SMALL_XML_FILE, book_file)
+    cache = BookCache()
+    book = cache.get(book_file)
+    with open(book_file, "a") as f:
+        f.write("\n")
+    changed_book = cache.get(book_file)
+    assert changed_book is not book
+    assert cache.stats()["misses"] == 2
+    cache.invalidate(book_file)
+    assert cache.get(book_file) is not changed_book
+    assert cache.stats()["books"] == 1
+
+
+def test_book_cache_evicts_least_recently_used(tmpdir):
+    book_files = []
+    for name in ("A", "B", "C"):
+        book_files.append(str(tmpdir.join("{}.xml".format(name))))
+        shutil.copy(TEST_SMALL_XML_FILE, book_files[-1])
+    cache = BookCache(max_size=os.path.getsize(TEST_SMALL_XML_FILE) * 2)
+    book_a = cache.get(book_files[0])
+    cache.get(book_files[1])
+    cache.get(book_files[0])  # B is now the least recently used
+    cache.get(book_files[2])
+    assert cache.stats()["evictions"] == 1
+    assert cache.get(book_files[0]) is book_a
+    assert cache.stats()["misses"] == 3
+    cache.get(book_files[1])
+    assert cache.stats()["misses"] == 4
+
+
+def test_book_cache_w_missing_file():
+    with pytest.raises(IOError):
+        BookCache().get(os.path.join(XML_FILE_STORAGE_PATH, "Xtest_parse.xml"))
+
+
+def test_book_cache_warm_up():
+    cache = BookCache()
+    missing_file = os.path.join(XML_FILE_STORAGE_PATH, "Xtest_parse.xml")
+    report = cache.warm_up([TEST_XML_FILE, TEST_SMALL_XML_FILE, missing_file], processes=2)
+    assert report.keys() == [TEST_XML_FILE, TEST_SMALL_XML_FILE, missing_file]
+    assert report[TEST_XML_FILE]["error"] is None
+    assert report[missing_file]["error"].startswith("IOError")
+    assert cache.stats()["books"] == 2
+
+    book = cache.get(TEST_XML_FILE)
+    assert cache.stats()["hits"] == 1
+    assert book._structure_info == Book(open(TEST_XML_FILE)).get_book_info()
+    # the lookup tables built by the workers point to the elements of this book
+    fresh_book = Book(open(TEST_XML_FILE))
+    exported = [dict(tables, refs=None) for tables in book._export_version_indexes()]
+    assert exported == [dict(tables, refs=None) for tables in fresh_book._export_version_indexes()]
+    for version in book.xpath("version"):
+        index = book._version_index(version)
+        assert set(index) == {"units", "mss", "divs"}
+        for unit_id, units in index["units"].items():
+            assert all(unit.getroottree().getroot() is book._book for unit in units)
+            assert [unit.get("id") for unit in units] == [unit_id] * len(units)
+        for leaf in index["divs"]["leaves"]:
+            assert tuple(book._locate_div_path(leaf.element)) == leaf.div_path
+        assert index["divs"]["refs"].references == \
+            fresh_book.get_reference_trie(version.get("title")).references
+
+
+# DraftSession tests
+
+
+@pytest.fixture
+def draft_folder(tmpdir, monkeypatch):
+    drafts = tmpdir.mkdir("drafts")
+    backups = drafts.mkdir("backups")
+    shutil.copy(TEST_XML_FILE, str(drafts.join("test_parse.xml")))
+    monkeypatch.setattr(BookManager, "xml_draft_file_storage_path", str(drafts))
+    monkeypatch.setattr(BookManager, "xml_draft_file_backup_storage_path", str(backups))
+    yield drafts
+    DraftSession.close_all()
+
+
+def test_draft_session_writes_behind(draft_folder, monkeypatch):
+    monkeypatch.setattr(DraftSession, "flush_delay", 60)
+    book_file = str(draft_folder.join("test_parse.xml"))
+    original_xml = open(book_file).read()
+    unit_count = len(Book(open(book_file)).xpath("//unit"))
+    for i in range(5):
+        BookManager.add_unit("test_parse", "Greek", ["1", "2"], editor="me")
+    BookManager.update_unit("test_parse", "Ethiopic", "1", (("TestOne", u"λόγος"),), editor="me")
+    session = DraftSession.open("test_parse")
+    assert session.pending == 6
+    assert len(session.book.xpath("//unit")) == unit_count + 5
+    assert open(book_file).read() == original_xml
+
+    book = BookManager._load("test_parse")  # reading saves the changes first
+    assert len(book.xpath("//unit")) == unit_count + 5
+    assert (session.pending, session.saves) == (0, 1)
+    assert DraftJournal.open("test_parse").snapshots() == [0]
+
+
+def test_draft_session_saves_after_delay(draft_folder):
+    session = DraftSession("test_parse", flush_delay=0.05)
+    session.apply("add_unit", "Greek", ["1", "2"])
+    session.apply("del_unit", "Ethiopic", "1")
+    for i in range(100):
+        if not session.pending:
+            break
+        time.sleep(0.05)
+    assert session.saves == 1
+    assert Book(open(session.path)).xpath("//unit")[0].get("id") == "1"
+
+
+def test_draft_session_per_book(draft_folder, monkeypatch):
+    monkeypatch.setattr(DraftSession, "flush_delay", 60)
+    BookManager.add_unit("test_parse", "Greek", ["1", "2"], editor="me")
+    session = DraftSession.open("test_parse")
+    BookManager.add_unit("test_parse", "Greek", ["1", "2"], editor="you")
+    BookManager.add_unit("test_parse", "Greek", ["1", "2"], editor="me")
+    # the editors share the session, nothing is saved or parsed again
+    assert DraftSession.sessions("test_parse") == [session]
+    assert DraftSession.open("test_parse") is session
+    assert (session.pending, session.saves) == (3, 0)
+    assert [e["editor"] for e in DraftJournal.open("test_parse").entries()] == ["me", "you", "me"]
+
+
+def test_draft_journal_records_operations(draft_folder, monkeypatch):
+    monkeypatch.setattr(DraftSession, "flush_delay", 60)
+    BookManager.add_unit("test_parse", "Greek", ["1", "2"], editor="me")
+    BookManager.update_unit("test_parse", "Ethiopic", "1", (("TestOne", u"λόγος"),), editor="me")
+    BookManager.split_reading("test_parse", "Ethiopic", "1", 0, 2, editor="me")
+    DraftSession.save_all()
+    journal = DraftJournal.open("test_parse")
+    entries = journal.entries()
+    assert [(e["seq"], e["editor"], e["op"]) for e in entries] == \
+        [(1, "me", "add_unit"), (2, "me", "update_unit"), (3, "me", "split_reading")]
+    assert entries[1]["args"] == ["Ethiopic", "1", [["TestOne", u"λόγος"]]]
+    assert journal.snapshots() == [0]
+    assert draft_folder.join("backups").listdir(fil="*.xml") == []
+
+    def unit_texts(book):
+        return [r.text for r in book.xpath("version[@title='Ethiopic']//unit[@id='1']/reading")]
+
+    assert unit_texts(journal.reconstruct()) == [u"λό", u"γος"]
+    assert unit_texts(journal.reconstruct(seq=2)) == [u"λόγος"]
+    assert unit_texts(journal.reconstruct(seq=0)) == unit_texts(Book(open(TEST_XML_FILE)))
+    assert BookEditor(journal.reconstruct()).serialize() == \
+        BookEditor(Book(open(str(draft_folder.join("test_parse.xml"))))).serialize()
+
+
+def test_draft_journal_snapshots_and_compaction(draft_folder, monkeypatch):
+    monkeypatch.setattr(DraftJournal, "snapshot_interval", 2)
+    session = DraftSession("test_parse", flush_delay=60)
+    for i in range(5):
+        session.apply("add_unit", "Greek", ["1", "2"])
+        session.save()
+    journal = DraftJournal.open("test_parse")
+    assert journal.snapshots() == [0, 2, 4]
+    unit_count = len(journal.reconstruct().xpath("//unit"))
+    assert len(journal.reconstruct(seq=3).xpath("//unit")) == unit_count - 2
+
+    assert journal.compact(seq=3) == 3  # entries 1, 2 and snapshot 0
+    assert journal.snapshots() == [2, 4]
+    assert [e["seq"] for e in journal.entries()] == [3, 4, 5]
+    assert len(journal.reconstruct(seq=3).xpath("//unit")) == unit_count - 2
+    with pytest.raises(RevisionDoesNotExist):
+        journal.reconstruct(seq=1)
+    journal.compact()
+    assert journal.snapshots() == [4]
+    assert DraftJournal("test_parse", journal.folder).last_seq == 5
+
+
+def test_draft_journal_compacted_on_snapshot(draft_folder, monkeypatch):
+    monkeypatch.setattr(DraftJournal, "snapshot_interval", 2)
+    session = DraftSession("test_parse", flush_delay=60)
+    session.apply("add_unit", "Greek", ["1", "2"])
+    session.save()
+    journal = DraftJournal.open("test_parse")
+    monkeypatch.setattr(journal, "retention", timedelta(0))
+    for i in range(4):
+        session.apply("add_unit", "Greek", ["1", "2"])
+        session.save()
+    assert journal.snapshots() == [4]
+    assert [e["seq"] for e in journal.entries()] == [5]
+    assert len(journal.reconstruct().xpath("//unit")) == len(Book(open(session.path)).xpath("//unit"))
+
+
+def test_draft_journal_snapshots_apart_from_imported_backups(draft_folder, monkeypatch):
+    backups = draft_folder.join("backups")
+    shutil.copy(TEST_XML_FILE, str(backups.join("test_parse_20151114_163806_339095.xml")))
+    backup_script = imp.load_source("backups", os.path.join(PROJECT_ROOT, "bin", "backups.py"))
+    store = BackupStore(str(backups))
+    assert backup_script.import_files(store, str(backups)) == 1
+
+    monkeypatch.setattr(DraftSession, "flush_delay", 60)
+    BookManager.add_unit("test_parse", "Greek", ["1", "2"], editor="me")
+    DraftSession.save_all()
+    journal = DraftJournal.open("test_parse")
+    assert journal.snapshots() == [0]
+    assert store.backups("test_parse") == ["20151114_163806_339095"]
+    assert len(journal.reconstruct().xpath("//unit")) == \
+        len(Book(open(TEST_XML_FILE)).xpath("//unit")) + 1
+    journal.compact()
+    assert store.backups("test_parse") == ["20151114_163806_339095"]
+
+
+def test_draft_sessions_catch_up_and_keep_newest_save(draft_folder):
+    mine = DraftSession("test_parse", flush_delay=60)
+    theirs = DraftSession("test_parse", flush_delay=60)  # e.g. in another process
+    unit_count = len(mine.book.xpath("//unit"))
+    mine.apply("add_unit", "Greek", ["1", "2"])
+    theirs.apply("add_unit", "Greek", ["1", "1"])  # applies my edit first
+    assert (mine.revision, theirs.revision) == (1, 2)
+    assert len(theirs.book.xpath("//unit")) == unit_count + 2
+    theirs.save()
+    mine.save()  # revision 1 doesn't replace revision 2
+    assert len(Book(open(mine.path)).xpath("//unit")) == unit_count + 2
+    assert DraftJournal.open("test_parse").saved_revision() == 2
+    mine.apply("del_unit", "Greek", "1202")
+    assert mine.revision == 3
+    assert len(mine.book.xpath("//unit")) == unit_count + 1
+
+
+def test_publish_book_includes_edits_not_saved_by_other_processes(draft_folder, tmpdir, monkeypatch):
+    published = tmpdir.mkdir("published")
+    monkeypatch.setattr(BookManager, "xml_file_storage_path", str(published))
+    monkeypatch.setattr(BookManager, "xml_file_backup_storage_path", str(published.mkdir("backups")))
+    unit_count = len(Book(open(TEST_XML_FILE)).xpath("//unit"))
+    theirs = DraftSession("test_parse", flush_delay=60)  # e.g. in another process
+    theirs.apply("add_unit", "Greek", ["1", "2"])
+    theirs.apply("add_unit", "Greek", ["1", "1"])
+    BookManager.publish_book("test_parse")
+    assert len(Book(open(str(published.join("test_parse.xml")))).xpath("//unit")) == unit_count + 2
+    assert len(Book(open(theirs.path)).xpath("//unit")) == unit_count + 2
+    assert DraftJournal.open("test_parse").saved_revision() == 2
+    theirs.close()
+
+
+def test_bookman_load_includes_edits_not_saved_by_other_processes(draft_folder):
+    unit_count = len(BookManager._load("test_parse").xpath("//unit"))
+    theirs = DraftSession("test_parse", flush_delay=60)  # e.g. in another process
+    theirs.apply("add_unit", "Greek", ["1", "2"])
+    assert len(BookManager._load("test_parse").xpath("//unit")) == unit_count + 1
+    theirs.close()
+
+
+def test_bookman_load_leaves_no_trace_of_missing_books(draft_folder, monkeypatch):
+    monkeypatch.setattr(DraftJournal, "max_open", 2)
+    for book_name in ("Xtest_parse", "Ytest_parse", "Ztest_parse"):
+        with pytest.raises(IOError):
+            BookManager._load(book_name)
+    assert draft_folder.join("backups").listdir() == []
+    for book_name in ("test_parse", "Xtest_parse", "Ytest_parse"):
+        DraftJournal.open(book_name)
+    assert [key[1] for key in DraftJournal._journals] == ["Xtest_parse", "Ytest_parse"]
+
+
+def test_draft_rejects_stale_revision(draft_folder):
+    revision = BookManager.get_revision("test_parse")
+    BookManager.add_unit("test_parse", "Greek", ["1", "2"], editor="me", revision=revision)
+    assert BookManager.get_revision("test_parse") == revision + 1
+    with pytest.raises(StaleRevision):
+        BookManager.add_unit("test_parse", "Greek", ["1", "2"], editor="you", revision=revision)
+    assert BookManager.get_revision("test_parse") == revision + 1
+
+
+def _edit_in_process(editor, count):
+    for i in range(count):
+        BookManager.add_unit("test_parse", "Greek", ["1", "2"], editor=editor)
+    DraftSession.save_all()
+
+
+def test_draft_editing_across_processes(draft_folder):
+    unit_count = len(Book(open(TEST_XML_FILE)).xpath("//unit"))
+    processes = [multiprocessing.Process(target=_edit_in_process, args=(editor, 20))
+                 for editor in ("me", "you", "they")]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0, 0, 0]
+    journal = DraftJournal.open("test_parse")
+    journal.refresh()
+    assert [e["seq"] for e in journal.entries()] == range(1, 61)
+    session = DraftSession.open("test_parse")
+    assert session.revision == 60
+    assert len(session.book.xpath("//unit")) == unit_count + 60
+    assert [u.get("id") for u in session.book.xpath("//unit")] == map(str, range(1, unit_count + 61))
+
+
 # Testing EI
 
 
@@ -1840,7 +2410,13 @@ def test_bookman_create_publish_copy():
     # setup
     book_name = "MyNewBookTest"
     book_file_pattern = "{}_????????_??????_??????.xml"
-    files_to_remove = []
+    for backup_folder in [XML_DRAFT_FILE_BACKUP_STORAGE_PATH,
+                          XML_FILE_BACKUP_STORAGE_PATH]:
+        store = BackupStore(backup_folder)
+        for backup_id in store.backups(book_name):
+            store.delete(book_name, backup_id)
+        store.collect_garbage()
+    files_to_remove = glob.glob(os.path.join(XML_DRAFT_FILE_BACKUP_STORAGE_PATH, "{}.*".format(book_name)))
     for xml_folder in [XML_DRAFT_FILE_BACKUP_STORAGE_PATH,
                        XML_FILE_BACKUP_STORAGE_PATH]:
         files_to_remove += glob.glob(os.path.join(xml_folder, book_file_pattern.format(book_name)))
@@ -1869,10 +2445,11 @@ def test_bookman_create_publish_copy():
     BookManager.copy_book(book_name)
     result_xml = fix_doctype(open(os.path.join(XML_DRAFT_FILE_STORAGE_PATH, "{}.xml".format(book_name))).read())
     assert result_xml == expected_xml
-    assert len(glob.glob(os.path.join(XML_DRAFT_FILE_BACKUP_STORAGE_PATH, book_file_pattern.format(book_name)))) == 1
+    assert DraftJournal.open(book_name).snapshots() == [0]
 
     # edit (add version)
     BookManager.add_version(book_name, "MyVersion", "MyLanguage", "Me")
+    DraftSession.save_all(book_name)
     result_xml = fix_doctype(open(os.path.join(XML_DRAFT_FILE_STORAGE_PATH, "{}.xml".format(book_name))).read())
     expected_xml = "<?xml version='1.0' encoding='UTF-8' standalone='no'?>\n" \
                    "<!DOCTYPE book SYSTEM 'grammateus.dtd'>\n" \
@@ -1884,16 +2461,23 @@ def test_bookman_create_publish_copy():
                    '  </version>\n' \
                    '</book>\n'.format(book_name)
     assert result_xml == expected_xml
-    assert len(glob.glob(os.path.join(XML_DRAFT_FILE_BACKUP_STORAGE_PATH, book_file_pattern.format(book_name)))) == 2
+    assert [e["op"] for e in DraftJournal.open(book_name).entries()] == ["add_version"]
 
     # publish
     BookManager.publish_book(book_name)
     result_xml = fix_doctype(open(os.path.join(XML_FILE_STORAGE_PATH, "{}.xml".format(book_name))).read())
     assert result_xml == expected_xml
-    assert len(glob.glob(os.path.join(XML_FILE_BACKUP_STORAGE_PATH, book_file_pattern.format(book_name)))) == 1
+    assert len(BackupStore(XML_FILE_BACKUP_STORAGE_PATH).backups(book_name)) == 1
 
     # teardown
-    files_to_remove = []
+    DraftSession.close_all(book_name)
+    for backup_folder in [XML_DRAFT_FILE_BACKUP_STORAGE_PATH,
+                          XML_FILE_BACKUP_STORAGE_PATH]:
+        store = BackupStore(backup_folder)
+        for backup_id in store.backups(book_name):
+            store.delete(book_name, backup_id)
+        store.collect_garbage()
+    files_to_remove = glob.glob(os.path.join(XML_DRAFT_FILE_BACKUP_STORAGE_PATH, "{}.*".format(book_name)))
     for xml_folder in [XML_DRAFT_FILE_BACKUP_STORAGE_PATH,
                        XML_FILE_BACKUP_STORAGE_PATH]:
         files_to_remove += glob.glob(os.path.join(xml_folder, book_file_pattern.format(book_name)))
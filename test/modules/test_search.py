@@ -0,0 +1,118 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+"""
+run tests from web2py root directory with:
+
+    python2.7 -m pytest -xvvs applications/grammateus3/test/modules/test_search.py
+"""
+
+import os
+from plugin_utils import check_path
+import pytest
+import shutil
+import threading
+from search import BookIndex, Concordance, SearchIndex, normalize, tokenize
+
+file_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+PROJECT_ROOT = os.path.join(file_dir, os.pardir)
+
+XML_DRAFT_FILE_STORAGE_PATH = check_path(os.path.join(PROJECT_ROOT, "test",
+                                                      "docs", "drafts"))
+
+
+@pytest.fixture
+def search_index(tmpdir):
+    return SearchIndex(xml_path=XML_DRAFT_FILE_STORAGE_PATH,
+                       index_path=str(tmpdir.join("search")))
+
+
+def test_tokenize():
+    assert normalize(u"Λόγος") == u"λογος"
+    assert tokenize(u"Λόγος Ἐνώχ, εὐλογίας.") == [u"λογος", u"ενωχ", u"ευλογιας"]
+    assert tokenize(u"ቃለ፡​በረከት፡") == [u"ቃለ", u"በረከት"]
+
+
+def test_search(search_index):
+    hits = search_index.search(u"ipsum Dolor")
+    assert [(h.book, h.version, h.unit_id, h.div_path, h.mss) for h in hits] == \
+        [("test_parse", "Greek", "828", ("2", "2"), ("TestOne",))]
+    assert hits[0].text == u"Lorem ipsum dolor sit amet"
+    assert search_index.search(u"ipsum nonexistentword") == []
+
+
+def test_search_w_filters(search_index):
+    assert search_index.search(u"ipsum", languages=["Greek"])
+    assert search_index.search(u"ipsum", versions=["Greek"], manuscripts=["TestOne"])
+    assert search_index.search(u"ipsum", books=["Xtest_parse"]) == []
+    assert search_index.search(u"ipsum", versions=["Ethiopic"]) == []
+    assert search_index.search(u"ipsum", manuscripts=["TestTwo"]) == []
+
+
+def test_search_index_is_persistent(search_index, tmpdir):
+    search_index.refresh(force=True)
+    index_file = os.path.join(search_index.index_path, "test_parse.idx")
+    assert os.path.isfile(index_file)
+    book_index = BookIndex.load(index_file)
+    assert book_index.stamp == search_index.update("test_parse").stamp
+    assert book_index.postings[u"ipsum"]
+
+
+def test_search_index_rebuilds_changed_book(tmpdir):
+    xml_path = str(tmpdir.join("docs"))
+    os.mkdir(xml_path)
+    xml_file = os.path.join(xml_path, "test_parse.xml")
+    shutil.copy(os.path.join(XML_DRAFT_FILE_STORAGE_PATH, "test_parse.xml"), xml_file)
+    search_index = SearchIndex(xml_path=xml_path, index_path=str(tmpdir.join("search")))
+    assert search_index.search(u"ipsum")
+
+    with open(xml_file) as f:
+        xml = f.read().replace("ipsum", "loremipsum")
+    with open(xml_file, "w") as f:
+        f.write(xml)
+    search_index.update("test_parse")
+    assert search_index.search(u"ipsum") == []
+    assert search_index.search(u"loremipsum")
+
+
+def test_search_goes_on_while_a_book_is_reindexed(tmpdir, monkeypatch):
+    xml_path = str(tmpdir.join("docs"))
+    os.mkdir(xml_path)
+    xml_file = os.path.join(xml_path, "test_parse.xml")
+    shutil.copy(os.path.join(XML_DRAFT_FILE_STORAGE_PATH, "test_parse.xml"), xml_file)
+    search_index = SearchIndex(xml_path=xml_path, index_path=str(tmpdir.join("search")))
+    assert search_index.search(u"ipsum")
+
+    with open(xml_file) as f:
+        xml = f.read().replace("ipsum", "loremipsum")
+    with open(xml_file, "w") as f:
+        f.write(xml)
+    building = threading.Event()
+    release = threading.Event()
+    build = BookIndex.build
+
+    def slow_build(path):
+        building.set()
+        release.wait(10)
+        return build(path)
+
+    monkeypatch.setattr(BookIndex, "build", staticmethod(slow_build))
+    update = threading.Thread(target=search_index.update, args=("test_parse",))
+    update.start()
+    assert building.wait(10)
+    assert search_index.search(u"ipsum")  # the old index, not blocked by the update
+    release.set()
+    update.join()
+    assert search_index.search(u"ipsum") == []
+    assert search_index.search(u"loremipsum")
+
+
+def test_concordance(search_index):
+    lines = search_index.concordance(lex="lex", context=1)
+    assert lines == [Concordance("test_parse", "Greek", ("TestOne",), "828", ("2", "2"), 1,
+                                 u"Lorem", u"ipsum", u"dolor", "lex", "morph")]
+    assert search_index.concordance(lex="lex", morph="morph", context=1) == lines
+    assert search_index.concordance(lex="lex")[0].right == u"dolor sit amet"
+    assert search_index.concordance(lex="lex", morph="xmorph") == []
+    assert search_index.concordance(lex="lex", manuscripts=["TestTwo"]) == []
+    assert search_index.concordance(lex="xlex") == []